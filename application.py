@@ -1,62 +1,97 @@
-from flask import Flask, request, Response, session, url_for, redirect
+from flask import Flask, request, Response, session, url_for, redirect, stream_with_context, g
 import json
 import logging
-import os
-from passlib.hash import sha256_crypt
+import math
+import threading
+import time
 import middlewares.security as security
 import middlewares.notification as notification
+import middlewares.rate_limiter as rate_limiter
 import database_access.user_access as user_access
 import tools.address_verification as address_verification
-from authlib.integrations.flask_client import OAuth
-from authlib.integrations.base_client.errors import OAuthError
-from cryptography.fernet import Fernet
-
+import tools.password_hashing as password_hashing
+import tools.bulk_import as bulk_import
+import tools.request_logging as request_logging
+import tools.instrumentation as instrumentation
+import tools.google_identity as google_identity
+import tools.response_encoding as response_encoding
+from settings import settings
+from common import catalog_url, default_page_size, max_page_size, max_batch_ids, duplicate_messages, user_plan, \
+    fernet, client_ip, metric_gauges, parse_fields, parse_search, parse_ids
+
+request_logging.configure_logging()
 application = Flask(__name__)
-catalog_url = os.environ["CATALOG_URL"]
 app = application
 logger = logging.getLogger()
-app.secret_key = os.urandom(24)
-oauth = OAuth(app)
-secret = os.environ['TOKEN_SECRET'].encode('utf-8')
-google = oauth.register(
-    name="google",
-    client_id=os.environ["OAUTH2_CLIENT_ID"],
-    client_secret=os.environ["OAUTH2_CLIENT_SECRET"],
-    access_token_url="https://accounts.google.com/o/oauth2/token",
-    access_token_params=None,
-    authorize_url="https://accounts.google.com/o/oauth2/auth",
-    authorize_params=None,
-    api_base_url="https://www.googleapis.com/oauth2/v1/",
-    client_kwargs={"scope": "openid profile email"}
-)
-
-
-# Get each field from request
+app.secret_key = settings.session_secret
+# Google OAuth client, authlib is imported and google registered on first use, then the client is reused
+google = None
+google_lock = threading.Lock()
+
+
+def google_client():
+    global google
+    if google is None:
+        with google_lock:
+            if google is None:
+                from authlib.integrations.flask_client import OAuth
+                registry = OAuth(app)
+                registry.register(
+                    name="google",
+                    client_id=settings.oauth2_client_id,
+                    client_secret=settings.oauth2_client_secret,
+                    access_token_url="https://accounts.google.com/o/oauth2/token",
+                    access_token_params=None,
+                    authorize_url="https://accounts.google.com/o/oauth2/auth",
+                    authorize_params=None,
+                    api_base_url="https://www.googleapis.com/oauth2/v1/",
+                    client_kwargs={"scope": "openid profile email"}
+                )
+                google = registry.create_client("google")
+    return google
+
+
+# Open the database connections and build the SNS, SmartyStreets and Google clients and the hashing pool before
+# the first request needs them. Runs on a background thread when WARM_CLIENTS is set, so it never delays boot
+def warm_clients():
+    for name, warm in [("database pool", user_access.pool.warm), ("replica pools", user_access.router.warm),
+                       ("sns", notification.publisher.warm),
+                       ("smartystreets", address_verification.get_client), ("google", google_client),
+                       ("google signing keys", google_identity.warm),
+                       ("password hashing pool", password_hashing.get_executor)]:
+        try:
+            warm()
+        except Exception as e:
+            logger.warning("Warming the {} failed: {}".format(name, e))
+
+
+if settings.warm_clients:
+    threading.Thread(target=warm_clients, name="warm-clients", daemon=True).start()
+
+
+# Get each field from request. They are parsed and logged once per request and kept on flask.g for the hooks and
+# the handler, path params are added to a copy so the cached inputs stay the same for every caller
 def log_and_extract_input(path_params=None):
-    path = request.path
-    args = dict(request.args)
-    headers = dict(request.headers)
-    method = request.method
-
-    try:
-        if request.data is not None:
-            data = request.json
-        else:
-            data = None
-    except Exception as e:
-        # This would fail the request in a more real solution.
-        logger.error("You sent something but I could not get JSON out of it.")
-        data = ""
-
-    inputs = {
-        "path": path,
-        "method": method,
-        "path_params": path_params,
-        "query_params": args,
-        "headers": headers,
-        "body": data
-    }
-    print(inputs)
+    inputs = g.get("inputs")
+    if inputs is None:
+        try:
+            # Only JSON bodies are read here, other bodies such as bulk imports are streamed by their handler
+            data = request.get_json() if request.is_json else None
+        except Exception:
+            # This would fail the request in a more real solution.
+            logger.error("You sent something but I could not get JSON out of it.")
+            data = ""
+        inputs = g.inputs = {
+            "path": request.path,
+            "method": request.method,
+            "path_params": None,
+            "query_params": request.args.to_dict(),
+            "headers": request.headers,
+            "body": data
+        }
+        request_logging.log_request(inputs)
+    if path_params is not None:
+        return dict(inputs, path_params=path_params)
     return inputs
 
 
@@ -66,21 +101,75 @@ def create_error_res(error_msg, code):
                     status=code, content_type="application/json")
 
 
-# Create successful response by its json payload and status code
-def create_res(json_msg, code):
-    return Response(json.dumps(json_msg, default=str),
-                    status=code, content_type="application/json")
+# Create the 400 response for a username or email that is already taken
+def create_duplicate_error_res(field):
+    return create_error_res(duplicate_messages.get(field, "User is duplicate"), 400)
+
+
+# Create the 429 response for a throttled client, retry_after in seconds
+def create_throttled_res(retry_after):
+    response = create_error_res("Too many login attempts, try again later", 429)
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+# Create successful response by its json payload and status code, encoded through user_plan.
+# With etag, a GET gets an ETag and an empty 304 when the client already has the same body
+def create_res(json_msg, code, etag=False):
+    body, status, headers = response_encoding.encode_response(json_msg, code, request.headers, user_plan,
+                                                              etag and request.method == "GET")
+    response = Response(body, status=status, headers=headers, content_type="application/json")
+    if status == 304:
+        del response.headers["Content-Type"]
+    # Keep the payload so notification can read it without parsing the body again
+    response.payload = json_msg
+    return response
+
+
+# Start timing the request, and profiling it when sampled, before authorization runs
+@app.before_request
+def start_request_timer():
+    g.profiler = instrumentation.start_profile()
+    if instrumentation.enabled or g.profiler is not None:
+        g.request_start = time.perf_counter()
+
+
+# Record the request time per route template once notify has run, streamed bodies are timed up to their headers
+@app.after_request
+def record_request_time(response):
+    start = g.get("request_start")
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    if instrumentation.enabled:
+        instrumentation.observe_request(route, request.method, response.status_code, elapsed)
+    if g.profiler is not None:
+        instrumentation.stop_profile(g.profiler, route, elapsed)
+    return response
+
+
+# Send the reads of a client that just wrote to the primary, see user_access.router. The deadline travels in the
+# session so it holds when the next request lands on another worker
+@app.before_request
+def start_replica_routing():
+    user_access.router.start_request(session.get("primary_until", 0.0))
+
+
+@app.after_request
+def keep_replica_routing(response):
+    primary_until = user_access.router.primary_until()
+    if primary_until > session.get("primary_until", 0.0):
+        session["primary_until"] = primary_until
+    return response
 
 
 # Authorization check. If it's for login, go ahead by returning none. The other request can only be done by support role
 @app.before_request
 def authorization():
     inputs = log_and_extract_input()
-    # To enable user registration, the permission of update opens to any role.
-    if inputs["path"].startswith("/api/users") and inputs["method"] == "PUT":
-        res = security.authorize(inputs, {"support", "ip"})
-    else:
-        res = security.authorize(inputs, {"support"})
+    # Roles allowed for the path and method come from security.role_rules
+    res = security.authorize(inputs)
     # Pass through while_list without any action
     if not res:
         return None
@@ -101,6 +190,13 @@ def notify(response):
     notification.notify(inputs, response)
     return response
 
+
+# Latency histograms and gauges in the Prometheus text format
+@app.route('/internal/metrics', methods=['GET'])
+def internal_metrics():
+    return Response(instrumentation.render(metric_gauges()), status=200,
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
 # # Verify if the token is valid
 # @app.route('/api/verify_token', methods=['POST'])
 # def verify_token():
@@ -121,11 +217,21 @@ def login():
     user = inputs["body"]
     if "username" not in user or "password" not in user:
         return create_error_res("Username or password is empty", 400)
-    users = user_access.query_users({"username": user["username"]})
+    # Throttle before the database lookup and the password hash, the expensive parts of a login
+    ip = client_ip(request.headers, request.remote_addr)
+    retry_after = rate_limiter.login_limiter.check(user["username"], ip)
+    if retry_after:
+        return create_throttled_res(retry_after)
+    users = user_access.query_users({"username": user["username"]}, cached=False)
     if not users or len(users) == 0:
         return create_error_res("Username does not exist", 400)
     queried_user = users[0]
-    if sha256_crypt.verify(user["password"], queried_user["password"]):
+    matched, new_hash = password_hashing.verify_password(user["password"], queried_user["password"])
+    if matched:
+        rate_limiter.login_limiter.succeeded(user["username"], ip)
+        # The stored hash uses fewer rounds than configured, replace it while we know the password
+        if new_hash:
+            user_access.update_password_hash(queried_user["user_id"], new_hash)
         if queried_user["status"] != "active":
             return create_error_res("User is not activated via email", 400)
         return create_res({"token": security.create_token(queried_user),
@@ -137,39 +243,37 @@ def login():
 # Login endpoint for goolge users. If successful, it will redirect to g_authorize for further user information.
 @app.route("/api/g_login", methods=['GET'])
 def g_login():
-    google = oauth.create_client("google")  # create the google oauth client
+    google = google_client()  # create the google oauth client
     redirect_uri = url_for("g_authorize", _external=True)
     return google.authorize_redirect(redirect_uri)
 
 
-# Access the user_info and if that email does not exist, we will create a new user based on that email.
+# Verify the google user from the id_token of the token response and sign in the user with that email, created
+# on the first login
 @app.route("/api/g_authorize")
 def g_authorize():
-    google = oauth.create_client("google")  # create the google oauth client
-    # Use code passed in query parameter to find token and then use token to get user info
+    from authlib.integrations.base_client.errors import OAuthError
+    google = google_client()  # create the google oauth client
+    # Use code passed in query parameter to get the tokens, the id_token says who the user is
     if "code" not in request.args:
         return create_error_res("Not authorized google user", 400)
     try:
-        token = google.authorize_access_token()  # Access token from google (needed to get user info)
-    except OAuthError:
+        token = google.authorize_access_token()
+        # Nonce sent by authorize_redirect, kept in the session by authlib
+        nonce = google.framework.get_session_data(request, "nonce")
+        if not nonce:
+            raise google_identity.IdentityError("No nonce in the session, the login did not start at g_login")
+        claims = google_identity.verify_id_token(token, settings.oauth2_client_id, nonce)
+    except (OAuthError, google_identity.IdentityError) as e:
+        logger.warning("Google login rejected: {}".format(e))
         return create_error_res("Invalid google code", 401)
-    resp = google.get("userinfo", token=token)  # userinfo contains stuff u specificed in the scrope
-    user_info = resp.json()
-    email = user_info["email"]
-    # If there does not exist a duplicate user with such email, create a new one
-    if not user_access.exist_duplicate_user_with_field({"email": email}):
-        created_user = user_access.create_user({"username": email, "email": email, "status": "active", "role": "ip"},
-                                               ["username", "email", "status", "role", "created_date"])
-        if not created_user:
-            return create_error_res("Internal Server Error", 500)
-    users = user_access.query_users({"email": email})
-    # Query the user with that email address
+    email = claims["email"]
+    users = user_access.upsert_user_by_email({"username": email, "email": email, "status": "active", "role": "ip"},
+                                             ["username", "email", "status", "role", "created_date"])
     if not users or len(users) != 1:
         return create_error_res("Internal Server Error", 500)
-    user = users[0]
     # Create a token and access the main page by the token
-    token = security.create_token(user)
-    fernet = Fernet(secret)
+    token = security.create_token(users[0])
     return redirect(catalog_url + "?token=" + fernet.encrypt(token.encode("utf-8")).decode("utf-8"))
 
 
@@ -178,11 +282,136 @@ def g_authorize():
 def query_users():
     inputs = log_and_extract_input()
     user = inputs["query_params"]
-    users = user_access.query_users(user)
+    # Projection with fields=username,email, password hashes are left out unless asked for
+    columns = parse_fields(user.get("fields"))
+    if columns is None:
+        return create_error_res("Invalid fields", 400)
+    # Lookup by ids=1,2,3
+    if "ids" in user:
+        return query_users_by_ids(user["ids"].split(","), columns)
+    # Keyset pagination, pass an empty cursor for the first page and next_cursor for the following ones
+    if "cursor" in user:
+        return query_users_by_cursor(user, columns)
+    if "limit" in user and "offset" in user:
+        users = user_access.query_users(user, columns)
+        if users is None:
+            return create_error_res("Internal Server Error", 500)
+        else:
+            return create_res({"data": users, "message": "Query successfully"}, 200, etag=True)
+    # Without paging the result can be any size, so it is streamed from a server-side cursor
+    users = user_access.stream_users(user, columns)
     if users is None:
         return create_error_res("Internal Server Error", 500)
-    else:
-        return create_res({"data": users, "message": "Query successfully"}, 200)
+    if user.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson":
+        return Response(stream_with_context(stream_ndjson(users)), status=200, content_type="application/x-ndjson")
+    return Response(stream_with_context(stream_json(users, "Query successfully")), status=200,
+                    content_type="application/json")
+
+
+# Encode rows as {"data": [...], "message": message} a few rows at a time
+def stream_json(rows, message, rows_per_chunk=100):
+    yield b'{"data": ['
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(response_encoding.dumps(user_plan.apply(row)))
+        if len(chunk) == rows_per_chunk:
+            yield (b"" if first else b", ") + b", ".join(chunk)
+            chunk, first = [], False
+    if chunk:
+        yield (b"" if first else b", ") + b", ".join(chunk)
+    yield '], "message": {}}}'.format(json.dumps(message)).encode("utf-8")
+
+
+# Encode rows as one json document per line, a few rows at a time
+def stream_ndjson(rows, rows_per_chunk=100):
+    chunk = []
+    for row in rows:
+        chunk.append(response_encoding.dumps(user_plan.apply(row)) + b"\n")
+        if len(chunk) == rows_per_chunk:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
+
+
+def query_users_by_cursor(user, columns=None):
+    try:
+        limit = int(user.get("limit", default_page_size))
+    except ValueError:
+        return create_error_res("Invalid limit", 400)
+    if limit < 1 or limit > max_page_size:
+        return create_error_res("Limit should be between 1 and {}".format(max_page_size), 400)
+    try:
+        res = user_access.query_users_by_cursor(user, limit, user["cursor"], columns)
+    except ValueError:
+        return create_error_res("Invalid cursor", 400)
+    if res is None:
+        return create_error_res("Internal Server Error", 500)
+    users, next_cursor = res
+    return create_res({"data": users, "next_cursor": next_cursor, "message": "Query successfully"}, 200, etag=True)
+
+
+# Endpoint to search users by prefix, value list and creation date range, e.g.
+# /api/users/search?email_prefix=ann&role=ip,support&created_after=2021-01-01&sort=-created_date&limit=20
+# Pass next_cursor as cursor to get the following page
+@app.route('/api/users/search', methods=['GET'])
+def search_users():
+    inputs = log_and_extract_input()
+    params = inputs["query_params"]
+    columns = parse_fields(params.get("fields"))
+    if columns is None:
+        return create_error_res("Invalid fields", 400)
+    search = parse_search(params)
+    if isinstance(search, str):
+        return create_error_res(search, 400)
+    try:
+        res = user_access.search_users(*search, params.get("cursor"), columns)
+    except ValueError:
+        return create_error_res("Invalid cursor", 400)
+    if res is None:
+        return create_error_res("Internal Server Error", 500)
+    users, next_cursor = res
+    return create_res({"data": users, "next_cursor": next_cursor, "message": "Query successfully"}, 200, etag=True)
+
+
+# Look up many users in one query, the result follows the order of ids and marks the ones not found as missing
+def query_users_by_ids(ids, columns=None):
+    ids = parse_ids(ids)
+    if ids is None:
+        return create_error_res("ids should be a list of at most {} user ids".format(max_batch_ids), 400)
+    users = user_access.query_users_by_ids(ids, columns)
+    if users is None:
+        return create_error_res("Internal Server Error", 500)
+    data = [users.get(id, {"user_id": id, "missing": True}) for id in ids]
+    return create_res({"data": data, "message": "Query successfully"}, 200, etag=True)
+
+
+# Endpoint to look up many users by ids in the body, like {"ids": [1, 2, 3]}
+@app.route('/api/users/batch_lookup', methods=['POST'])
+def batch_lookup_users():
+    inputs = log_and_extract_input()
+    body = inputs["body"] or {}
+    columns = parse_fields(inputs["query_params"].get("fields"))
+    if columns is None:
+        return create_error_res("Invalid fields", 400)
+    return query_users_by_ids(body.get("ids") if isinstance(body, dict) else None, columns)
+
+
+# Endpoint to delete many users by ids in the body, like {"ids": [1, 2, 3]}
+@app.route('/api/users/batch_delete', methods=['POST'])
+def batch_delete_users():
+    inputs = log_and_extract_input()
+    body = inputs["body"] or {}
+    ids = parse_ids(body.get("ids") if isinstance(body, dict) else None)
+    if ids is None:
+        return create_error_res("ids should be a list of at most {} user ids".format(max_batch_ids), 400)
+    deleted = user_access.delete_users_by_ids(ids)
+    if deleted is None:
+        return create_error_res("Internal Server Error", 500)
+    deleted = set(deleted)
+    data = [{"user_id": id, "deleted": id in deleted} for id in ids]
+    return create_res({"data": data, "message": "Delete successfully"}, 200)
 
 
 # Endpoint to query a user by its id
@@ -192,7 +421,7 @@ def query_user_by_id(user_id):
     if user is None:
         return create_error_res("Internal Server Error", 500)
     else:
-        return create_res({"data": user, "message": "Query successfully"}, 200)
+        return create_res({"data": user, "message": "Query successfully"}, 200, etag=True)
 
 
 # Create a new user and its password is hashed
@@ -205,20 +434,32 @@ def create_user():
     # Check all the fields are not none
     if not user or not all(user.values()):
         return create_error_res("Invalid data", 400)
-    if user_access.exist_duplicate_user_with_field({"username": user["username"]}):
-        return create_error_res("Username is duplicate", 400)
-    if user_access.exist_duplicate_user_with_field({"email": user["email"]}):
-        return create_error_res("Email is duplicate", 400)
+    # Check username and email in one query unless the unique indexes are trusted to reject duplicates
+    if not user_access.rely_on_unique_index:
+        duplicates = user_access.find_duplicate_user_fields({"username": user["username"], "email": user["email"]})
+        if duplicates:
+            return create_duplicate_error_res(duplicates[0])
     # Check if the address is valid
     if "address" in user and not address_verification.verify(user["address"]):
         return create_error_res("Address is invalid", 400)
-    created_user = user_access.create_user(user)
+    try:
+        created_user = user_access.create_user(user)
+    except user_access.DuplicateUserError as e:
+        return create_duplicate_error_res(e.field)
     if not created_user:
         return create_error_res("Internal Server Error", 500)
     else:
         return create_res({"data": created_user, "message": "Create successfully"}, 201)
 
 
+# Import users in bulk from an NDJSON body (one user per line) or a CSV body with a header row.
+# Results are streamed back as NDJSON, one line per input record followed by a summary
+@app.route('/api/users/bulk', methods=['POST'])
+def import_users():
+    results = bulk_import.import_users(request.stream, request.mimetype)
+    return Response(stream_with_context(results), status=200, content_type="application/x-ndjson")
+
+
 # Update a existing user by its id. Hash the password if updated
 @app.route('/api/users/<id>', methods=['PUT'])
 def update_users_by_id(id):
@@ -226,11 +467,15 @@ def update_users_by_id(id):
     user = inputs["body"]
     if not user or not all(user.values()):
         return create_error_res("Invalid data", 400)
-    if "username" in user and user_access.exist_duplicate_user_with_field({"username": user["username"]}):
-        return create_error_res("Username is duplicate", 400)
+    if "username" in user and not user_access.rely_on_unique_index and \
+            user_access.exist_duplicate_user_with_field({"username": user["username"]}):
+        return create_duplicate_error_res("username")
     if "address" in user and not address_verification.verify(user["address"]):
         return create_error_res("Address is invalid", 400)
-    updated_user = user_access.update_users_by_id(user, id)
+    try:
+        updated_user = user_access.update_users_by_id(user, id)
+    except user_access.DuplicateUserError as e:
+        return create_duplicate_error_res(e.field)
     if not updated_user:
         return create_error_res("Internal Server Error", 500)
     else:
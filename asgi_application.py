@@ -0,0 +1,427 @@
+from quart import Quart, request, Response, session, url_for, redirect, g
+import asyncio
+import json
+import logging
+import math
+import time
+import middlewares.security as security
+import middlewares.notification as notification
+import middlewares.rate_limiter as rate_limiter
+import database_access.user_access as user_access
+import database_access.async_user_access as async_user_access
+import tools.async_address_verification as address_verification
+import tools.password_hashing as password_hashing
+import tools.request_logging as request_logging
+import tools.instrumentation as instrumentation
+import tools.google_identity as google_identity
+import tools.response_encoding as response_encoding
+from settings import settings
+from common import parse_fields, parse_ids, parse_search, duplicate_messages, default_page_size, \
+    max_page_size, max_batch_ids, catalog_url, fernet, metric_gauges, client_ip, user_plan
+
+# ASGI entry point serving the routes of application.py with async handlers, run it with
+# hypercorn asgi_application:app. MySQL, SmartyStreets and Google are reached without blocking the event loop,
+# password hashing runs in the hashing pool and SNS messages go through the background publisher of notification.
+# Bulk import stays on the Flask application.
+
+request_logging.configure_logging()
+application = Quart(__name__)
+app = application
+logger = logging.getLogger()
+app.secret_key = settings.session_secret
+
+google_authorize_url = "https://accounts.google.com/o/oauth2/auth"
+google_token_url = "https://accounts.google.com/o/oauth2/token"
+google = None
+
+
+# authlib is imported on the first google login rather than at startup, the client and its connections are then
+# reused. The redirect uri depends on the request so it is passed on each call
+def google_client():
+    global google
+    if google is None:
+        from authlib.integrations.httpx_client import AsyncOAuth2Client
+        google = AsyncOAuth2Client(client_id=settings.oauth2_client_id,
+                                   client_secret=settings.oauth2_client_secret,
+                                   scope="openid profile email")
+    return google
+
+
+# Get each field from request, parsed and logged once per request, see application.log_and_extract_input
+async def log_and_extract_input(path_params=None):
+    inputs = g.get("inputs")
+    if inputs is None:
+        try:
+            data = await request.get_json() if request.is_json else None
+        except Exception:
+            logger.error("You sent something but I could not get JSON out of it.")
+            data = ""
+        inputs = g.inputs = {
+            "path": request.path,
+            "method": request.method,
+            "path_params": None,
+            "query_params": request.args.to_dict(),
+            "headers": request.headers,
+            "body": data
+        }
+        request_logging.log_request(inputs)
+    if path_params is not None:
+        return dict(inputs, path_params=path_params)
+    return inputs
+
+
+# Create error response by error message string and its status code
+def create_error_res(error_msg, code):
+    return Response(json.dumps({"message": error_msg}), status=code, content_type="application/json")
+
+
+def create_duplicate_error_res(field):
+    return create_error_res(duplicate_messages.get(field, "User is duplicate"), 400)
+
+
+def create_throttled_res(retry_after):
+    response = create_error_res("Too many login attempts, try again later", 429)
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+# Create successful response by its json payload and status code
+def create_res(json_msg, code, etag=False):
+    body, status, headers = response_encoding.encode_response(json_msg, code, request.headers, user_plan,
+                                                              etag and request.method == "GET")
+    response = Response(body, status=status, headers=headers, content_type="application/json")
+    if status == 304:
+        del response.headers["Content-Type"]
+    response.payload = json_msg
+    return response
+
+
+# Request timing and profiling, see application.start_request_timer and application.record_request_time
+@app.before_request
+async def start_request_timer():
+    g.profiler = instrumentation.start_profile()
+    if instrumentation.enabled or g.profiler is not None:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+async def record_request_time(response):
+    start = g.get("request_start")
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    if instrumentation.enabled:
+        instrumentation.observe_request(route, request.method, response.status_code, elapsed)
+    if g.profiler is not None:
+        instrumentation.stop_profile(g.profiler, route, elapsed)
+    return response
+
+
+# See application.start_replica_routing and application.keep_replica_routing
+@app.before_request
+async def start_replica_routing():
+    user_access.router.start_request(session.get("primary_until", 0.0))
+
+
+@app.after_request
+async def keep_replica_routing(response):
+    primary_until = user_access.router.primary_until()
+    if primary_until > session.get("primary_until", 0.0):
+        session["primary_until"] = primary_until
+    return response
+
+
+# Same rules as the Flask application, see application.authorization
+@app.before_request
+async def authorization():
+    inputs = await log_and_extract_input()
+    res = security.authorize(inputs)
+    if not res:
+        return None
+    if res[1] == 200:
+        session["user_id"] = res[0]["user_id"]
+        session["role"] = res[0]["role"]
+        session["email"] = res[0]["email"]
+        return None
+    else:
+        return create_error_res(res[0], res[1])
+
+
+# Notification only queues messages, so it never waits on SNS
+@app.after_request
+async def notify(response):
+    inputs = await log_and_extract_input()
+    notification.notify(inputs, response)
+    return response
+
+
+@app.after_serving
+async def close_clients():
+    await async_user_access.close_pool()
+    await address_verification.close_client()
+    if google is not None:
+        await google.aclose()
+
+
+@app.route('/internal/metrics', methods=['GET'])
+async def internal_metrics():
+    return Response(instrumentation.render(metric_gauges(async_mysql_pool=async_user_access.pool_metrics())),
+                    status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/api/registration', methods=['POST'])
+async def register():
+    return await create_user()
+
+
+@app.route('/api/login', methods=['POST'])
+async def login():
+    inputs = await log_and_extract_input()
+    user = inputs["body"]
+    if not user or "username" not in user or "password" not in user:
+        return create_error_res("Username or password is empty", 400)
+    ip = client_ip(request.headers, request.remote_addr)
+    retry_after = rate_limiter.login_limiter.check(user["username"], ip)
+    if retry_after:
+        return create_throttled_res(retry_after)
+    users = await async_user_access.query_users({"username": user["username"]}, cached=False)
+    if not users:
+        return create_error_res("Username does not exist", 400)
+    queried_user = users[0]
+    matched, new_hash = await password_hashing.verify_password_async(user["password"], queried_user["password"])
+    if not matched:
+        return create_error_res("Password is incorrect", 400)
+    rate_limiter.login_limiter.succeeded(user["username"], ip)
+    if new_hash:
+        await async_user_access.update_password_hash(queried_user["user_id"], new_hash)
+    if queried_user["status"] != "active":
+        return create_error_res("User is not activated via email", 400)
+    return create_res({"token": security.create_token(queried_user), "message": "Login successfully"}, 200)
+
+
+@app.route("/api/g_login", methods=['GET'])
+async def g_login():
+    from authlib.common.security import generate_token
+    nonce = generate_token(20)
+    uri, state = google_client().create_authorization_url(
+        google_authorize_url, redirect_uri=url_for("g_authorize", _external=True), nonce=nonce)
+    session["google_state"] = state
+    session["google_nonce"] = nonce
+    return redirect(uri)
+
+
+@app.route("/api/g_authorize")
+async def g_authorize():
+    from authlib.common.errors import AuthlibBaseError
+    if "code" not in request.args:
+        return create_error_res("Not authorized google user", 400)
+    # Both are set by g_login, a login that did not start there is rejected
+    nonce = session.pop("google_nonce", None)
+    state = session.pop("google_state", None)
+    if not nonce or not state or request.args.get("state") != state:
+        return create_error_res("Invalid google code", 401)
+    try:
+        token = await google_client().fetch_token(google_token_url, code=request.args["code"],
+                                                  redirect_uri=url_for("g_authorize", _external=True))
+        # Only a key refresh goes to the network, which happens on a worker thread
+        claims = await asyncio.get_running_loop().run_in_executor(
+            None, google_identity.verify_id_token, token, settings.oauth2_client_id, nonce)
+    except (AuthlibBaseError, google_identity.IdentityError) as e:
+        logger.warning("Google login rejected: {}".format(e))
+        return create_error_res("Invalid google code", 401)
+    email = claims["email"]
+    users = await async_user_access.upsert_user_by_email(
+        {"username": email, "email": email, "status": "active", "role": "ip"},
+        ["username", "email", "status", "role", "created_date"])
+    if not users or len(users) != 1:
+        return create_error_res("Internal Server Error", 500)
+    token = security.create_token(users[0])
+    return redirect(catalog_url + "?token=" + fernet.encrypt(token.encode("utf-8")).decode("utf-8"))
+
+
+@app.route('/api/users', methods=['GET'])
+async def query_users():
+    inputs = await log_and_extract_input()
+    user = inputs["query_params"]
+    columns = parse_fields(user.get("fields"))
+    if columns is None:
+        return create_error_res("Invalid fields", 400)
+    if "ids" in user:
+        return await query_users_by_ids(user["ids"].split(","), columns)
+    if "cursor" in user:
+        return await query_users_by_cursor(user, columns)
+    if "limit" in user and "offset" in user:
+        users = await async_user_access.query_users(user, columns)
+        if users is None:
+            return create_error_res("Internal Server Error", 500)
+        return create_res({"data": users, "message": "Query successfully"}, 200, etag=True)
+    users = await async_user_access.stream_users(user, columns)
+    if users is None:
+        return create_error_res("Internal Server Error", 500)
+    if user.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson":
+        return Response(stream_ndjson(users), status=200, content_type="application/x-ndjson")
+    return Response(stream_json(users, "Query successfully"), status=200, content_type="application/json")
+
+
+# Async versions of application.stream_json and application.stream_ndjson
+async def stream_json(rows, message, rows_per_chunk=100):
+    yield b'{"data": ['
+    chunk = []
+    first = True
+    async for row in rows:
+        chunk.append(response_encoding.dumps(user_plan.apply(row)))
+        if len(chunk) == rows_per_chunk:
+            yield (b"" if first else b", ") + b", ".join(chunk)
+            chunk, first = [], False
+    if chunk:
+        yield (b"" if first else b", ") + b", ".join(chunk)
+    yield '], "message": {}}}'.format(json.dumps(message)).encode("utf-8")
+
+
+async def stream_ndjson(rows, rows_per_chunk=100):
+    chunk = []
+    async for row in rows:
+        chunk.append(response_encoding.dumps(user_plan.apply(row)) + b"\n")
+        if len(chunk) == rows_per_chunk:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
+
+
+async def query_users_by_cursor(user, columns=None):
+    try:
+        limit = int(user.get("limit", default_page_size))
+    except ValueError:
+        return create_error_res("Invalid limit", 400)
+    if limit < 1 or limit > max_page_size:
+        return create_error_res("Limit should be between 1 and {}".format(max_page_size), 400)
+    try:
+        res = await async_user_access.query_users_by_cursor(user, limit, user["cursor"], columns)
+    except ValueError:
+        return create_error_res("Invalid cursor", 400)
+    if res is None:
+        return create_error_res("Internal Server Error", 500)
+    users, next_cursor = res
+    return create_res({"data": users, "next_cursor": next_cursor, "message": "Query successfully"}, 200, etag=True)
+
+
+@app.route('/api/users/search', methods=['GET'])
+async def search_users():
+    inputs = await log_and_extract_input()
+    params = inputs["query_params"]
+    columns = parse_fields(params.get("fields"))
+    if columns is None:
+        return create_error_res("Invalid fields", 400)
+    search = parse_search(params)
+    if isinstance(search, str):
+        return create_error_res(search, 400)
+    try:
+        res = await async_user_access.search_users(*search, params.get("cursor"), columns)
+    except ValueError:
+        return create_error_res("Invalid cursor", 400)
+    if res is None:
+        return create_error_res("Internal Server Error", 500)
+    users, next_cursor = res
+    return create_res({"data": users, "next_cursor": next_cursor, "message": "Query successfully"}, 200, etag=True)
+
+
+async def query_users_by_ids(ids, columns=None):
+    ids = parse_ids(ids)
+    if ids is None:
+        return create_error_res("ids should be a list of at most {} user ids".format(max_batch_ids), 400)
+    users = await async_user_access.query_users_by_ids(ids, columns)
+    if users is None:
+        return create_error_res("Internal Server Error", 500)
+    data = [users.get(id, {"user_id": id, "missing": True}) for id in ids]
+    return create_res({"data": data, "message": "Query successfully"}, 200, etag=True)
+
+
+@app.route('/api/users/batch_lookup', methods=['POST'])
+async def batch_lookup_users():
+    inputs = await log_and_extract_input()
+    body = inputs["body"] or {}
+    columns = parse_fields(inputs["query_params"].get("fields"))
+    if columns is None:
+        return create_error_res("Invalid fields", 400)
+    return await query_users_by_ids(body.get("ids") if isinstance(body, dict) else None, columns)
+
+
+@app.route('/api/users/batch_delete', methods=['POST'])
+async def batch_delete_users():
+    inputs = await log_and_extract_input()
+    body = inputs["body"] or {}
+    ids = parse_ids(body.get("ids") if isinstance(body, dict) else None)
+    if ids is None:
+        return create_error_res("ids should be a list of at most {} user ids".format(max_batch_ids), 400)
+    deleted = await async_user_access.delete_users_by_ids(ids)
+    if deleted is None:
+        return create_error_res("Internal Server Error", 500)
+    deleted = set(deleted)
+    return create_res({"data": [{"user_id": id, "deleted": id in deleted} for id in ids],
+                       "message": "Delete successfully"}, 200)
+
+
+@app.route('/api/users/<user_id>', methods=['GET'])
+async def query_user_by_id(user_id):
+    user = await async_user_access.query_user_by_id(user_id)
+    if user is None:
+        return create_error_res("Internal Server Error", 500)
+    return create_res({"data": user, "message": "Query successfully"}, 200, etag=True)
+
+
+@app.route('/api/users', methods=['POST'])
+async def create_user():
+    inputs = await log_and_extract_input()
+    user = inputs["body"]
+    if not user or not user_access.required_field_exist(user):
+        return create_error_res("Some fields are missing", 400)
+    if not all(user.values()):
+        return create_error_res("Invalid data", 400)
+    if not user_access.rely_on_unique_index:
+        duplicates = await async_user_access.find_duplicate_user_fields({"username": user["username"],
+                                                                         "email": user["email"]})
+        if duplicates:
+            return create_duplicate_error_res(duplicates[0])
+    if "address" in user and not await address_verification.verify(user["address"]):
+        return create_error_res("Address is invalid", 400)
+    try:
+        created_user = await async_user_access.create_user(user)
+    except user_access.DuplicateUserError as e:
+        return create_duplicate_error_res(e.field)
+    if not created_user:
+        return create_error_res("Internal Server Error", 500)
+    return create_res({"data": created_user, "message": "Create successfully"}, 201)
+
+
+@app.route('/api/users/<id>', methods=['PUT'])
+async def update_users_by_id(id):
+    inputs = await log_and_extract_input()
+    user = inputs["body"]
+    if not user or not all(user.values()):
+        return create_error_res("Invalid data", 400)
+    if "username" in user and not user_access.rely_on_unique_index and \
+            await async_user_access.exist_duplicate_user_with_field({"username": user["username"]}):
+        return create_duplicate_error_res("username")
+    if "address" in user and not await address_verification.verify(user["address"]):
+        return create_error_res("Address is invalid", 400)
+    try:
+        updated_user = await async_user_access.update_users_by_id(user, id)
+    except user_access.DuplicateUserError as e:
+        return create_duplicate_error_res(e.field)
+    if not updated_user:
+        return create_error_res("Internal Server Error", 500)
+    return create_res({"data": user, "message": "Update successfully"}, 200)
+
+
+@app.route('/api/users/<id>', methods=['DELETE'])
+async def delete_users_by_id(id):
+    user_id = await async_user_access.delete_users_by_id(id)
+    if not user_id:
+        return create_error_res("Internal Server Error", 500)
+    return create_res({"message": "Delete successfully"}, 200)
+
+
+if __name__ == '__main__':
+    application.run(debug=True, port=8080)
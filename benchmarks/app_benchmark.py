@@ -0,0 +1,222 @@
+import argparse
+import itertools
+import json
+import random
+import statistics
+import threading
+import time
+import timeit
+from benchmarks import stand_ins
+
+# Drive the Flask application in process against the local stand-ins with a mix of login, registration, query,
+# pagination and update requests at a fixed concurrency, and time the hot helpers on their own. Results are
+# printed as json so runs can be compared to catch regressions:
+#   python -m benchmarks.app_benchmark --concurrency 8 --duration 10 > before.json
+
+stand_ins.set_default_environment()
+
+import application  # noqa: E402
+import database_access.user_access as user_access  # noqa: E402
+import middlewares.notification as notification  # noqa: E402
+import middlewares.security as security  # noqa: E402
+import middlewares.rate_limiter as rate_limiter  # noqa: E402
+import tools.password_hashing as password_hashing  # noqa: E402
+import tools.google_identity as google_identity  # noqa: E402
+import tools.response_encoding as response_encoding  # noqa: E402
+from benchmarks.load_test import percentile  # noqa: E402
+from settings import settings  # noqa: E402
+
+password = "benchmark-password"
+default_mix = "login=2,registration=1,query_by_id=4,query_by_field=2,pagination=2,update=1"
+
+
+def create_seed_users(count):
+    password_hash = password_hashing.hash_password(password)
+    users = [{
+        "username": "user{}".format(i),
+        "password": password_hash,
+        "email": "user{}@example.com".format(i),
+        "phone": "555-{:04d}".format(i % 10000),
+        "slack_id": "U{}".format(i),
+        "role": "ip",
+        "status": "active",
+        "address": "{} Main St, New York NY".format(i),
+    } for i in range(count)]
+    for start in range(0, count, 1000):
+        user_access.create_users(users[start:start + 1000])
+
+
+class Scenarios:
+    def __init__(self, users):
+        self.users = users
+        self.registrations = itertools.count()
+        token = security.create_token({"user_id": 0, "role": "support", "email": "support@example.com"})
+        self.headers = {"Authorization": "Bearer " + token}
+
+    def login(self, client):
+        i = random.randrange(self.users)
+        return client.post("/api/login", json={"username": "user{}".format(i), "password": password})
+
+    # Half of the google logins are first logins creating the user
+    # g_login puts the nonce of the ID token in the session, then g_authorize signs the user in
+    def google_login(self, client):
+        i = random.randrange(self.users * 2)
+        client.get("/api/g_login")
+        return client.get("/api/g_authorize?code=google{}@example.com".format(i))
+
+    def registration(self, client):
+        i = next(self.registrations)
+        return client.post("/api/registration", json={
+            "username": "new{}".format(i), "password": password, "email": "new{}@example.com".format(i),
+            "phone": "555-0000", "slack_id": "N{}".format(i), "role": "ip", "status": "pending",
+            "address": "{} Broadway, New York NY".format(i % 50),
+        })
+
+    def query_by_id(self, client):
+        return client.get("/api/users/{}".format(random.randint(1, self.users)), headers=self.headers)
+
+    def query_by_field(self, client):
+        return client.get("/api/users?limit=10&offset=0&role=ip&status=active", headers=self.headers)
+
+    def pagination(self, client):
+        response = client.get("/api/users?cursor=&limit=20", headers=self.headers)
+        next_cursor = response.get_json()["next_cursor"]
+        if next_cursor:
+            response = client.get("/api/users?limit=20&cursor=" + next_cursor, headers=self.headers)
+        return response
+
+    def update(self, client):
+        user_id = random.randint(1, self.users)
+        return client.put("/api/users/{}".format(user_id), json={"phone": "555-{:04d}".format(user_id % 10000)},
+                          headers=self.headers)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = int(weight)
+    return weights
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / elapsed,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+    }
+
+
+def run_mix(scenarios, weights, concurrency, duration):
+    names = list(weights)
+    latencies = {name: [] for name in names}
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = application.app.test_client()
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, [weights[name] for name in names])[0]
+            start = time.perf_counter()
+            status = getattr(scenarios, name)(client).status_code
+            latency = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies[name].append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    result = summarize([latency for values in latencies.values() for latency in values], elapsed)
+    result["statuses"] = {str(status): count for status, count in sorted(statuses.items())}
+    result["scenarios"] = {name: summarize(values, elapsed) for name, values in latencies.items()}
+    return result
+
+
+# Microseconds per call of the helpers every request goes through
+def time_hot_paths(scenarios, number):
+    inputs = {"path": "/api/users/1", "method": "GET", "path_params": None, "query_params": {},
+              "headers": scenarios.headers, "body": None}
+    query = {"role": "ip", "status": "active", "limit": "10", "offset": "0"}
+    # Buckets that never run out and drained ones, so every check is an allowed or a rejected login attempt
+    generous = rate_limiter.LoginRateLimiter(rate_limiter.LocalBucketStore(), user_burst=10 ** 9,
+                                             user_per_minute=10 ** 9, ip_burst=10 ** 9, ip_per_minute=10 ** 9)
+    limiter = rate_limiter.LoginRateLimiter(rate_limiter.LocalBucketStore(), user_burst=1, user_per_minute=0.001,
+                                            ip_burst=1, ip_per_minute=0.001)
+    limiter.check("user0", "10.0.0.1")
+    attempts = itertools.count()
+    id_token = {"id_token": application.google_client().provider.id_token("google0@example.com")}
+    page = {"data": user_access.query_users({"limit": 20, "offset": 0}), "message": "Query successfully"}
+    # Time routing a read of a client that has not written lately
+    user_access.router.start_request()
+    calls = {
+        "create_select_statement": lambda: user_access.create_select_statement(
+            user_access.user_table_name, user_access.user_fields, query),
+        "authorize": lambda: security.authorize(inputs),
+        "notification_match": lambda: notification.rule_table.match("/api/users/1", "PUT", 200),
+        "encode_user_page": lambda: response_encoding.encode_response(page, 200, {}, application.user_plan, True),
+        "verify_id_token": lambda: google_identity.verify_id_token(id_token, settings.oauth2_client_id),
+        "login_rate_limit_allowed": lambda: generous.check("user0", "10.0.0.1"),
+        "login_rate_limit_rejected": lambda: limiter.check("user0", "10.0.0.1"),
+        "login_rate_limit_new_keys": lambda: limiter.check("user0", str(next(attempts))),
+        "route_read": user_access.router.candidates,
+    }
+    return {name: min(timeit.repeat(call, number=number, repeat=5)) / number * 1e6 for name, call in calls.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000, help="users created before the run")
+    parser.add_argument("--mix", default=default_mix, help="scenario=weight pairs")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--sns-latency-ms", type=float, default=0.0)
+    parser.add_argument("--smarty-latency-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--micro-number", type=int, default=10000)
+    parser.add_argument("--replicas", type=int, default=0, help="replica stand-ins serving the reads")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = stand_ins.install(application, args.sns_latency_ms / 1000, args.smarty_latency_ms / 1000,
+                               args.replicas)
+    create_seed_users(args.users)
+    scenarios = Scenarios(args.users)
+    weights = parse_mix(args.mix)
+    unknown = [name for name in weights if not hasattr(Scenarios, name)]
+    if unknown:
+        parser.error("unknown scenarios: {}".format(", ".join(unknown)))
+
+    if args.warmup > 0:
+        run_mix(scenarios, weights, args.concurrency, args.warmup)
+    result = {
+        "users": args.users,
+        "mix": weights,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "password_hash_rounds": password_hashing.rounds,
+        "mix_result": run_mix(scenarios, weights, args.concurrency, args.duration),
+        "replica_router": user_access.router.metrics(),
+        "statements": dict({"primary": server.statements},
+                           **{name: replica.statements for name, replica in server.replicas.items()}),
+        "hot_paths_us": time_hot_paths(scenarios, args.micro_number),
+    }
+    notification.publisher.flush()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
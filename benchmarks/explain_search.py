@@ -0,0 +1,105 @@
+import argparse
+import itertools
+import json
+import sys
+from datetime import datetime, timedelta
+import database_access.user_access as user_access
+
+# EXPLAIN every search the /api/users/search endpoint can build, each combination of filters with each sort, on the
+# first and on a following page, and fail if one of them scans the whole table. Run it from the repository root with
+# the USER_SERVICE_* variables set, after database_access/migrations, against a copy of production sized data since
+# MySQL prefers a table scan on small tables:
+#   python -m benchmarks.explain_search
+# tests/test_search_indexes.py runs the same check when EXPLAIN_SEARCH is set. On an empty database, such as the one
+# of CI built from database_access/schema.sql, load synthetic users first with:
+#   python -m benchmarks.explain_search --load-users 200000
+
+now = datetime.now().replace(microsecond=0)
+# A value for every filter of user_access.search_filters
+sample_filters = {
+    "username_prefix": "a",
+    "email_prefix": "a",
+    "role": ["ip", "support"],
+    "status": ["active"],
+    "created_after": now - timedelta(days=30),
+    "created_before": now,
+}
+# The (sort value, user_id) of the last row of a page
+sample_after = {
+    "user_id": (None, 1000),
+    "created_date": (str(now - timedelta(days=7)), 1000),
+    "username": ("m", 1000),
+    "email": ("m", 1000),
+}
+
+
+# Spread of the synthetic users, so that each role and status value matches a part of the table
+roles = ["ip", "support", "admin", "partner"]
+statuses = ["active", "pending", "disabled"]
+
+
+# Insert count synthetic users created over the last two years and refresh the index statistics
+def load_users(count, batch_size=5000):
+    sql = ("INSERT INTO {} (username, password, email, phone, slack_id, role, status, address, created_date) "
+           "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)").format(user_access.user_table_name)
+    with user_access.router.write_connection() as conn, conn.cursor() as cursor:
+        for start in range(0, count, batch_size):
+            rows = [("load{}".format(i), "x", "load{}@example.com".format(i), "2125550100", "U{}".format(i),
+                     roles[i % len(roles)], statuses[i % len(statuses)], "{} Main St, New York NY".format(i),
+                     now - timedelta(minutes=i * 5)) for i in range(start, min(start + batch_size, count))]
+            cursor.executemany(sql, rows)
+            user_access.commit(conn)
+        cursor.execute("ANALYZE TABLE {}".format(user_access.user_table_name))
+
+
+def search_cases(max_filters):
+    parameters = [parameter for parameter, _, _ in user_access.search_filters]
+    for count in range(max_filters + 1):
+        for chosen in itertools.combinations(parameters, count):
+            filters = {parameter: sample_filters[parameter] for parameter in chosen}
+            for sort, descending, paged in itertools.product(user_access.search_sort_fields, (False, True),
+                                                             (False, True)):
+                yield filters, sort, descending, sample_after[sort] if paged else None
+
+
+# Return the searches whose plan scans the whole table, with their sql and plan
+def full_scan_searches(max_filters, limit=20):
+    cases = 0
+    failures = []
+    for filters, sort, descending, after in search_cases(max_filters):
+        sql, sql_args = user_access.create_search_statement(user_access.user_table_name, filters, sort, descending,
+                                                            after, limit)
+        plan = user_access.explain(sql, sql_args)
+        cases += 1
+        if user_access.full_scans(plan):
+            failures.append({
+                "filters": sorted(filters),
+                "sort": ("-" if descending else "") + sort,
+                "paged": after is not None,
+                "sql": sql,
+                "plan": [{key: row.get(key) for key in ("table", "type", "possible_keys", "key", "rows", "Extra")}
+                         for row in plan],
+            })
+    return cases, failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-filters", type=int, default=len(user_access.search_filters),
+                        help="largest number of filters combined in one search")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--load-users", type=int, default=0,
+                        help="insert this many synthetic users and exit, for an empty database")
+    args = parser.parse_args()
+
+    if args.load_users:
+        load_users(args.load_users)
+        return
+
+    cases, failures = full_scan_searches(args.max_filters, args.limit)
+    print(json.dumps({"searches": cases, "full_scans": len(failures), "failures": failures}, indent=2, default=str))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import httpx
+
+# Drive a running service at a fixed concurrency and report throughput and latency percentiles, e.g. to compare
+# the Flask and ASGI applications on one process each:
+#   gunicorn -w 1 --threads 8 -b :8000 application:app
+#   hypercorn -w 1 -b :8001 asgi_application:app
+#   python -m benchmarks.load_test --url http://localhost:8000 --path /api/users/1 --token <jwt>
+#   python -m benchmarks.load_test --url http://localhost:8001 --path /api/users/1 --token <jwt>
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def worker(client, args, deadline, latencies, statuses):
+    headers = {"Authorization": "Bearer " + args.token} if args.token else {}
+    body = json.loads(args.body) if args.body else None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await client.request(args.method, args.path, headers=headers, json=body)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = "error"
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[status] = statuses.get(status, 0) + 1
+
+
+async def run(args):
+    latencies = []
+    statuses = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*[worker(client, args, deadline, latencies, statuses) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "url": args.url + args.path,
+        "method": args.method,
+        "concurrency": args.concurrency,
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / elapsed,
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "latency_ms": {
+            "mean": statistics.mean(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--path", default="/api/users/1")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--body", help="json body to send with every request")
+    parser.add_argument("--token", help="JWT sent as a bearer token")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
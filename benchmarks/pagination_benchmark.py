@@ -0,0 +1,60 @@
+import argparse
+import json
+import statistics
+import time
+import database_access.user_access as user_access
+
+# Compare LIMIT/OFFSET paging with keyset (cursor) paging at growing depths on the configured database.
+# Run from the repository root with the USER_SERVICE_* variables set: python -m benchmarks.pagination_benchmark
+
+
+# Find the user_id of the row right before depth so the cursor page starts where the offset page does
+def cursor_at_depth(depth):
+    if depth == 0:
+        return ""
+    with user_access.pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT user_id FROM {} ORDER BY user_id LIMIT 1 OFFSET %s".format(user_access.user_table_name),
+                       (depth - 1,))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return user_access.encode_cursor(row["user_id"])
+
+
+def time_call(call, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"p50_ms": statistics.median(timings), "min_ms": min(timings), "max_ms": max(timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--depths", type=int, nargs="+", default=[10, 1000, 100000])
+    args = parser.parse_args()
+
+    # Paging never hits the user cache, but keep it out of the picture anyway
+    user_access.user_cache.ttl = 0
+    results = []
+    for depth in args.depths:
+        # The offset parameter counts pages, so both modes start at the page boundary nearest to depth
+        page = depth // args.limit
+        depth = page * args.limit
+        page_cursor = cursor_at_depth(depth)
+        if page_cursor is None:
+            results.append({"depth": depth, "skipped": "table has fewer rows"})
+            continue
+        results.append({
+            "depth": depth,
+            "offset": time_call(lambda: user_access.query_users({"limit": args.limit, "offset": page}), args.repeat),
+            "cursor": time_call(lambda: user_access.query_users_by_cursor({}, args.limit, page_cursor), args.repeat),
+        })
+    print(json.dumps({"limit": args.limit, "repeat": args.repeat, "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import json
+import threading
+import time
+import tools.password_hashing as password_hashing
+
+# Measure password verifications (the cost of a login) per second for different pool sizes and rounds,
+# with several request threads verifying at once: python -m benchmarks.password_hashing_benchmark
+
+
+def logins_per_second(password_hash, threads, duration):
+    count = [0] * threads
+    deadline = time.perf_counter() + duration
+
+    def login(i):
+        while time.perf_counter() < deadline:
+            password_hashing.verify_password("password", password_hash)
+            count[i] += 1
+
+    workers = [threading.Thread(target=login, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(count) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--rounds", type=int, nargs="+", default=[5000, 100000, 535000])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    results = []
+    for rounds in args.rounds:
+        password_hashing.configure(new_pool_size=0, new_rounds=rounds)
+        password_hash = password_hashing.hash_password("password")
+        for pool_size in args.pool_sizes:
+            password_hashing.configure(new_pool_size=pool_size)
+            # Start the workers before measuring
+            password_hashing.verify_password("password", password_hash)
+            results.append({"rounds": rounds, "pool_size": pool_size,
+                            "logins_per_second": logins_per_second(password_hash, args.threads, args.duration)})
+    password_hashing.shutdown()
+    print(json.dumps({"threads": args.threads, "duration": args.duration, "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import io
+import json
+import logging
+import time
+from flask import request
+import application
+import tools.request_logging as request_logging
+
+# Measure the per request cost of input extraction and request logging, before (inputs rebuilt and printed by
+# authorization, the handler and notify) and after (parsed once, kept on flask.g, logged through the queue):
+#   python -m benchmarks.request_overhead_benchmark
+
+body = {"username": "alice", "email": "alice@example.com", "password": "secret", "address": "1 Main St, Town CA"}
+headers = {"Authorization": "Bearer " + "x" * 200, "User-Agent": "benchmark", "Accept": "application/json"}
+
+
+# The extraction as it was, run by each of the three callers of a request
+def legacy_extract_input(out):
+    inputs = {
+        "path": request.path,
+        "method": request.method,
+        "path_params": None,
+        "query_params": dict(request.args),
+        "headers": dict(request.headers),
+        "body": request.json if request.is_json else None
+    }
+    print(inputs, file=out)
+    return inputs
+
+
+# Microseconds per request spent in extract, net of building the request context
+def overhead_us(extract, duration, calls=3):
+    count = 0
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        with application.app.test_request_context("/api/users?limit=10&offset=0", method="POST", json=body,
+                                                  headers=headers):
+            for _ in range(calls):
+                extract()
+        count += 1
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--sample-rates", type=float, nargs="+", default=[1.0, 0.1, 0.0])
+    args = parser.parse_args()
+
+    # Both variants write to memory so the terminal is not part of the measurement
+    out = io.StringIO()
+    request_logging.stop_logging()
+    logging.getLogger().handlers = []
+    request_logging.configure_logging(out)
+
+    context_us = overhead_us(lambda: None, args.duration)
+    results = [{"variant": "legacy",
+                "overhead_us": overhead_us(lambda: legacy_extract_input(out), args.duration) - context_us}]
+    for rate in args.sample_rates:
+        request_logging.request_log_sample_rate = rate
+        results.append({"variant": "cached", "sample_rate": rate,
+                        "overhead_us": overhead_us(application.log_and_extract_input, args.duration) - context_us})
+    request_logging.stop_logging()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import pymysql
+from flask import redirect, request, session
+from smartystreets_python_sdk.us_street.candidate import Candidate
+
+# Local stand-ins for MySQL, SNS, SmartyStreets and Google OAuth so the application runs without any external
+# service. Call set_default_environment before importing application and install after.
+
+# Values for the settings application needs at import, only used when the variable is not set
+default_environment = {
+    "CATALOG_URL": "http://localhost/catalog",
+    "TOKEN_SECRET": "Yp3nN6nC8mTq4sX0mZC7l2V0mYqO8c3w0lHc1KjXy0E=",
+    "SESSION_SECRET": "benchmark",
+    "OAUTH2_CLIENT_ID": "benchmark",
+    "OAUTH2_CLIENT_SECRET": "benchmark",
+    "USER_SERVICE_HOST": "localhost",
+    "USER_SERVICE_USER": "benchmark",
+    "USER_SERVICE_PASSWORD": "benchmark",
+    "USER_SERVICE_PORT": "3306",
+    "SNS_ARN": "arn:aws:sns:us-east-1:000000000000:benchmark",
+    "JWT_SECRET": "benchmark",
+    "JWT_ALGO": "HS256",
+    "JWT_EXP": "3600",
+    "SMARTY_AUTH_ID": "benchmark",
+    "SMARTY_AUTH_TOKEN": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "LOG_LEVEL": "WARNING",
+    # Production rounds would make every login and registration measure sha256_crypt only
+    "PASSWORD_HASH_ROUNDS": "1000",
+    # Every simulated login comes from one address, the limiter is timed on its own by app_benchmark
+    "LOGIN_RATE_LIMIT_IP_BURST": "0",
+    "LOGIN_RATE_LIMIT_USER_BURST": "0",
+}
+
+user_table_schema = """CREATE TABLE signals.users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE,
+    password TEXT,
+    email TEXT UNIQUE,
+    phone TEXT,
+    slack_id TEXT,
+    role TEXT,
+    status TEXT,
+    address TEXT,
+    created_date TEXT
+)"""
+
+
+def set_default_environment():
+    for name, value in default_environment.items():
+        os.environ.setdefault(name, value)
+
+
+# One in-memory SQLite database behind a lock plays the MySQL server, statements from user_access are translated
+# from the pymysql paramstyle and SQLite errors are raised as the pymysql errors user_access handles.
+# A server built with a source plays a replica of it: it reads the same database, reports lag seconds behind it to
+# SHOW SLAVE STATUS and refuses connections while down
+class SqliteServer:
+    def __init__(self, source=None):
+        self.source = source
+        if source is None:
+            self.db = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+            self.db.execute("ATTACH DATABASE ':memory:' AS signals")
+            self.db.execute(user_table_schema)
+            # Held for a whole transaction, so concurrent transactions run one after another as with row locks
+            self.lock = threading.RLock()
+        else:
+            self.db = source.db
+            self.lock = source.lock
+        self.lag = 0.0
+        self.down = False
+        self.statements = 0
+
+    def connect(self, **kwargs):
+        if self.down:
+            raise pymysql.OperationalError(2003, "Can't connect to MySQL server")
+        return SqliteConnection(self, kwargs.get("autocommit", True))
+
+    # Answer SHOW SLAVE STATUS / SHOW REPLICA STATUS, a server without a source does not replicate
+    def replica_status(self):
+        if self.source is None:
+            return []
+        return [{"Seconds_Behind_Master": self.lag, "Seconds_Behind_Source": self.lag}]
+
+
+class SqliteConnection:
+    def __init__(self, server, autocommit):
+        self.server = server
+        self.autocommit = autocommit
+        self.in_transaction = False
+        self.open = True
+
+    def cursor(self, cursor_class=None):
+        return SqliteCursor(self)
+
+    def begin(self):
+        self.server.lock.acquire()
+        self.server.db.execute("BEGIN")
+        self.in_transaction = True
+
+    def commit(self):
+        self.end("COMMIT")
+
+    def rollback(self):
+        self.end("ROLLBACK")
+
+    def end(self, statement):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.server.db.execute(statement)
+            self.server.lock.release()
+
+    def get_autocommit(self):
+        return self.autocommit
+
+    def ping(self, reconnect=False):
+        return None
+
+    def close(self):
+        self.rollback()
+        self.open = False
+
+
+class SqliteCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, sql, args=None):
+        server = self.connection.server
+        if server.down:
+            raise pymysql.OperationalError(2013, "Lost connection to MySQL server during query")
+        server.statements += 1
+        if sql.startswith(("SHOW SLAVE STATUS", "SHOW REPLICA STATUS")):
+            self.rows = server.replica_status()
+            self.rowcount = len(self.rows)
+            return self.rowcount
+        sql = sql.replace("%s", "?").replace(" FOR UPDATE", "").replace(" ON DUPLICATE KEY UPDATE user_id = user_id",
+                                                                       " ON CONFLICT DO NOTHING")
+        # Backslash is the default LIKE escape character of MySQL only
+        sql = sql.replace(" LIKE ?", " LIKE ? ESCAPE '\\'")
+        args = tuple(str(arg) if isinstance(arg, datetime) else arg for arg in (args or ()))
+        with server.lock:
+            try:
+                cursor = server.db.execute(sql, args)
+            except sqlite3.IntegrityError as e:
+                key = str(e).rsplit(": ", 1)[-1]
+                raise pymysql.IntegrityError(1062, "Duplicate entry for key '{}'".format(key))
+            except sqlite3.Error as e:
+                raise pymysql.ProgrammingError(1064, str(e))
+            names = [column[0] for column in cursor.description or ()]
+            self.rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+            self.rowcount = cursor.rowcount if cursor.description is None else len(self.rows)
+            self.lastrowid = cursor.lastrowid
+        return self.rowcount
+
+    def executemany(self, sql, seq_args):
+        count = sum(max(self.execute(sql, args), 0) for args in seq_args)
+        self.rowcount = count
+        return count
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        while self.rows:
+            yield self.rows.pop(0)
+
+    def close(self):
+        self.rows = []
+
+
+# Answers publish and publish_batch like SNS, after an optional latency
+class StubSns:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def publish(self, TopicArn, Message, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.published += 1
+        return {"MessageId": str(self.published)}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        time.sleep(self.latency)
+        with self.lock:
+            self.published += len(PublishBatchRequestEntries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in PublishBatchRequestEntries], "Failed": []}
+
+
+# SmartyStreets US Street client finding a zipcode for every street except the ones containing "invalid"
+class StubSmartyClient:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def send_lookup(self, lookup):
+        time.sleep(self.latency)
+        self.answer(lookup)
+
+    def send_batch(self, batch):
+        time.sleep(self.latency)
+        for lookup in batch:
+            self.answer(lookup)
+
+    @staticmethod
+    def answer(lookup):
+        if "invalid" in lookup.street.lower():
+            lookup.result = []
+        else:
+            lookup.result = [Candidate({"components": {"zipcode": "10001"}})]
+
+
+# Google as an OpenID provider: serves the discovery document and signing keys to tools.google_identity and signs
+# ID tokens with a key generated on start
+class FakeIdentityProvider:
+    issuer = "https://accounts.google.com"
+    jwks_uri = "https://www.googleapis.com/oauth2/v3/certs"
+
+    def __init__(self, client_id):
+        from authlib.jose import JsonWebKey
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        self.client_id = client_id
+        self.kid = "stand-in"
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        public_key = JsonWebKey.import_key(self.key.public_key(), {"kty": "RSA"}).as_dict()
+        public_key.update({"kid": self.kid, "use": "sig", "alg": "RS256"})
+        self.jwks = {"keys": [public_key]}
+        self.fetches = 0
+
+    def fetch_json(self, url):
+        self.fetches += 1
+        if url == self.jwks_uri:
+            return self.jwks
+        return {"issuer": self.issuer, "jwks_uri": self.jwks_uri}
+
+    # Sign an ID token for email, overrides replace or add claims
+    def id_token(self, email, nonce=None, email_verified=True, **overrides):
+        from authlib.jose import jwt
+        now = int(time.time())
+        claims = {"iss": self.issuer, "aud": self.client_id, "sub": "google-" + email, "email": email,
+                  "email_verified": email_verified, "iat": now, "exp": now + 3600}
+        if nonce is not None:
+            claims["nonce"] = nonce
+        claims.update(overrides)
+        return jwt.encode({"alg": "RS256", "kid": self.kid}, claims, self.key).decode("utf-8")
+
+
+class StubSessionFramework:
+    @staticmethod
+    def get_session_data(request, key):
+        return session.pop("_google_authlib_{}_".format(key), None)
+
+
+# Google OAuth client of application.g_login and application.g_authorize. The authorization code is taken as the
+# email of the google user, so /api/g_authorize?code=someone@example.com signs in someone@example.com
+class StubGoogleClient:
+    framework = StubSessionFramework()
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def authorize_redirect(self, redirect_uri):
+        session["_google_authlib_nonce_"] = "nonce-" + str(time.time())
+        return redirect(redirect_uri + "?code=google-user@example.com")
+
+    def authorize_access_token(self):
+        nonce = session.get("_google_authlib_nonce_")
+        return {"access_token": "stand-in", "token_type": "Bearer",
+                "id_token": self.provider.id_token(request.args["code"], nonce)}
+
+
+# Point the application at the stand-ins, return the SQLite server holding the users. With replicas, reads are
+# routed to that many replica servers of it, kept in server.replicas by name
+def install(application, sns_latency=0.0, smarty_latency=0.0, replicas=0):
+    import database_access.user_access as user_access
+    import middlewares.notification as notification
+    import tools.address_verification as address_verification
+    import tools.google_identity as google_identity
+    from database_access.connection_pool import ConnectionPool
+    from database_access.replica_routing import ReplicaRouter
+    from settings import settings
+    server = SqliteServer()
+    user_access.pool.close()
+    user_access.pool._connect = server.connect
+    server.replicas = {"replica-{}:3306".format(i + 1): SqliteServer(server) for i in range(replicas)}
+    if replicas:
+        user_access.router.close()
+        replica_pools = {}
+        for name, replica in server.replicas.items():
+            replica_pools[name] = ConnectionPool(user_access.c_info, min_size=user_access.pool.min_size,
+                                                 max_size=user_access.pool.max_size,
+                                                 timeout=user_access.pool.timeout,
+                                                 idle_timeout=user_access.pool.idle_timeout,
+                                                 connect=replica.connect)
+        user_access.router = ReplicaRouter(user_access.pool, replica_pools, max_lag=settings.replica_max_lag,
+                                           sticky_seconds=settings.replica_sticky_seconds,
+                                           lag_check_interval=settings.replica_lag_check_interval,
+                                           retry_interval=settings.replica_retry_interval,
+                                           status_statement=settings.replica_status_statement)
+    user_access.user_cache.backend.clear()
+    notification.publisher.client = StubSns(sns_latency)
+    address_verification.client = StubSmartyClient(smarty_latency)
+    provider = FakeIdentityProvider(settings.oauth2_client_id)
+    google_identity.fetch_json = provider.fetch_json
+    google_identity.jwks_uri = google_identity.key_set = None
+    google = StubGoogleClient(provider)
+    application.google_client = lambda: google
+    return server
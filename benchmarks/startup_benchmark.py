@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from benchmarks import stand_ins
+
+# Measure how long a fresh worker takes to import the application, broken down by import with python -X importtime,
+# and how long it takes to answer its first request:
+#   python -m benchmarks.startup_benchmark --module application --runs 5
+
+first_request = """
+import time
+start = time.perf_counter()
+import {module} as module
+imported = time.perf_counter()
+module.app.test_client().get("/api/users/1")
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+# Return {module: (self us, cumulative us, depth)} from the stderr of python -X importtime
+def parse_importtime(output):
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return imports
+
+
+def run_once(module, environment):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", first_request.format(module=module)],
+                            env=environment, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    import_s, first_request_s = (float(value) for value in result.stdout.split()[-2:])
+    return wall, import_s, first_request_s, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="application", help="application or asgi_application")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="number of imports listed by cumulative time")
+    args = parser.parse_args()
+
+    environment = dict(os.environ)
+    for name, value in stand_ins.default_environment.items():
+        environment.setdefault(name, value)
+    environment["PYTHONPATH"] = os.getcwd() + os.pathsep + environment.get("PYTHONPATH", "")
+
+    runs = [run_once(args.module, environment) for _ in range(args.runs)]
+    # Per import medians over the runs, only direct imports of the module and the top level ones are listed
+    names = set.intersection(*(set(imports) for _, _, _, imports in runs))
+    breakdown = []
+    for name in names:
+        depth = runs[0][3][name][2]
+        if depth > 1 and not name.split(".")[0] in ("database_access", "middlewares", "tools"):
+            continue
+        breakdown.append({
+            "module": name,
+            "cumulative_ms": statistics.median(imports[name][1] for _, _, _, imports in runs) / 1000,
+            "self_ms": statistics.median(imports[name][0] for _, _, _, imports in runs) / 1000,
+        })
+    breakdown.sort(key=lambda entry: entry["cumulative_ms"], reverse=True)
+    print(json.dumps({
+        "module": args.module,
+        "runs": args.runs,
+        "process_wall_ms": statistics.median(run[0] for run in runs) * 1000,
+        "import_ms": statistics.median(run[1] for run in runs) * 1000,
+        "first_request_ms": statistics.median(run[2] for run in runs) * 1000,
+        "imports": breakdown[:args.top],
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
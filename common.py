@@ -0,0 +1,115 @@
+import database_access.user_access as user_access
+import middlewares.notification as notification
+import middlewares.rate_limiter as rate_limiter
+import middlewares.security as security
+import tools.address_verification as address_verification
+import tools.google_identity as google_identity
+import tools.response_encoding as response_encoding
+from datetime import datetime
+from cryptography.fernet import Fernet
+from settings import settings
+
+# Values and request parsing shared by application.py and asgi_application.py, so neither entry point has to import
+# the other
+
+# Fail at boot with every missing setting, not on the first request needing one
+settings.require_all()
+catalog_url = settings.catalog_url
+secret = settings.token_secret
+default_page_size = settings.default_page_size
+max_page_size = settings.max_page_size
+max_batch_ids = settings.max_batch_ids
+# Number of proxies in front of the service that append the client address to X-Forwarded-For
+trusted_proxies = settings.trusted_proxies
+duplicate_messages = {"username": "Username is duplicate", "email": "Email is duplicate"}
+# User rows in responses never carry the password hash
+user_plan = response_encoding.FieldPlan(secret_fields=["password"],
+                                        converters={"created_date": response_encoding.datetime_text})
+# Login tokens handed to the catalog are encrypted with this
+fernet = Fernet(secret)
+
+
+# Address of the client, the one added by the closest trusted proxy to X-Forwarded-For when there are some
+def client_ip(headers, remote_addr):
+    if trusted_proxies:
+        forwarded = [ip.strip() for ip in headers.get("X-Forwarded-For", "").split(",") if ip.strip()]
+        if len(forwarded) >= trusted_proxies:
+            return forwarded[-trusted_proxies]
+    return remote_addr
+
+
+# Counters and sizes of the pools, caches and publisher, keyed by gauge name
+def metric_gauges(**extra_sources):
+    sources = {
+        "mysql_pool": user_access.pool.metrics(),
+        "replica_router": user_access.router.metrics(),
+        "statement_cache": user_access.statement_cache.metrics(),
+        "user_cache": user_access.user_cache.metrics(),
+        "authorizer": security.authorizer_metrics(),
+        "sns_publisher": notification.publisher.metrics(),
+        "address_verification": address_verification.metrics,
+        "login_rate_limiter": rate_limiter.login_limiter.metrics(),
+        "google_identity": google_identity.metrics,
+    }
+    sources.update(extra_sources)
+    return {"user_service_{}_{}".format(source, stat): {(): value}
+            for source, stats in sources.items() for stat, value in stats.items()
+            if isinstance(value, (int, float))}
+
+
+# Return the columns named in a fields query parameter, the public ones without it and None if one is unknown
+# or secret
+def parse_fields(fields):
+    if not fields:
+        return user_access.public_user_fields
+    columns = [field.strip() for field in fields.split(",") if field.strip()]
+    if not columns or any(column not in user_access.public_user_fields for column in columns):
+        return None
+    return columns
+
+
+# Return the (filters, sort, descending, limit) of a search, or the error message if a parameter is invalid
+def parse_search(params):
+    filters = {}
+    for parameter, column, kind in user_access.search_filters:
+        value = params.get(parameter)
+        if value is None or value == "":
+            continue
+        if kind == "in":
+            values = sorted(set(item.strip() for item in value.split(",") if item.strip()))
+            if not values or len(values) > max_batch_ids:
+                return "{} should list at most {} values".format(parameter, max_batch_ids)
+            filters[parameter] = values
+        elif kind == "prefix":
+            filters[parameter] = value
+        else:
+            try:
+                filters[parameter] = datetime.fromisoformat(value)
+            except ValueError:
+                return "{} should be a date like 2021-01-31 or 2021-01-31T12:00:00".format(parameter)
+    sort = params.get("sort") or "user_id"
+    descending = sort.startswith("-")
+    sort = sort.lstrip("-")
+    if sort not in user_access.search_sort_fields:
+        return "sort should be one of {}, prefixed by - for descending order".format(
+            ", ".join(user_access.search_sort_fields))
+    try:
+        limit = int(params.get("limit", default_page_size))
+    except ValueError:
+        return "Invalid limit"
+    if limit < 1 or limit > max_page_size:
+        return "Limit should be between 1 and {}".format(max_page_size)
+    return filters, sort, descending, limit
+
+
+# Parse a list of user ids, return None if one is not a positive integer or there are too many of them
+def parse_ids(ids):
+    if not isinstance(ids, list) or not ids or len(ids) > max_batch_ids:
+        return None
+    try:
+        parsed = [int(id) for id in ids]
+    except (TypeError, ValueError):
+        return None
+    if any(id < 1 for id in parsed):
+        return None
+    return parsed
@@ -0,0 +1,409 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import aiomysql
+import pymysql
+import database_access.user_access as user_access
+import tools.password_hashing as password_hashing
+from tools.instrumentation import timed
+from database_access.replica_routing import replica_lag
+from database_access.user_access import user_table_name, user_fields, user_cache, cache_lookup, \
+    create_select_statement, create_select_after_statement, create_select_by_id_statement, \
+    create_select_by_ids_statement, create_delete_by_id_statement, create_delete_by_ids_statement, \
+    create_insert_statement, create_insert_ignore_duplicate_statement, create_update_by_id_statement, \
+    create_exists_statement, create_written_user, decode_cursor, encode_cursor, is_duplicate_key_error, \
+    duplicate_user_error, create_search_statement, decode_search_cursor, encode_search_cursor
+
+# Async counterparts of the user_access functions for the ASGI application. They share the statement builders,
+# the statement cache and the user cache with user_access and run on an aiomysql pool built from the same c_info.
+# Reads go to aiomysql pools of the replicas where user_access.router sends them.
+
+logger = logging.getLogger()
+
+pool = None
+# Created in the running event loop by get_pool_lock, a lock made at import would belong to another loop on
+# Python < 3.10
+pool_lock = None
+# Replica pools by the name of user_access.replica_c_infos
+replica_pools = {}
+
+
+async def create_pool(c_info):
+    connect_kwargs = dict(c_info)
+    connect_kwargs["cursorclass"] = aiomysql.DictCursor
+    connect_kwargs.setdefault("autocommit", True)
+    return await aiomysql.create_pool(minsize=user_access.pool.min_size,
+                                      maxsize=user_access.pool.max_size,
+                                      pool_recycle=user_access.pool.idle_timeout,
+                                      **connect_kwargs)
+
+
+def get_pool_lock():
+    global pool_lock
+    if pool_lock is None:
+        pool_lock = asyncio.Lock()
+    return pool_lock
+
+
+# The pool belongs to the running event loop, so it is created on first use
+async def get_pool():
+    global pool
+    if pool is None:
+        async with get_pool_lock():
+            if pool is None:
+                pool = await create_pool(user_access.c_info)
+    return pool
+
+
+async def get_replica_pool(name):
+    if name not in replica_pools:
+        async with get_pool_lock():
+            if name not in replica_pools:
+                replica_pools[name] = await create_pool(user_access.replica_c_infos[name])
+    return replica_pools[name]
+
+
+async def close_pool():
+    global pool, pool_lock
+    for db in [pool] + list(replica_pools.values()):
+        if db is not None:
+            db.close()
+            await db.wait_closed()
+    pool = None
+    replica_pools.clear()
+    pool_lock = None
+
+
+# Connection for a read, see user_access.router.read_connection
+@asynccontextmanager
+async def read_connection():
+    router = user_access.router
+    for name in router.candidates():
+        try:
+            db = await get_replica_pool(name)
+        except (pymysql.Error, OSError, asyncio.TimeoutError) as e:
+            router.mark_down(name, e)
+            continue
+        # A full pool waits for a free connection as long as the sync pool does and is then busy, not down. Otherwise
+        # the time goes to opening a connection, which is what an unreachable replica times out on
+        full = db.freesize == 0 and db.size >= db.maxsize
+        context = db.acquire()
+        try:
+            conn = await asyncio.wait_for(context.__aenter__(), user_access.pool.timeout)
+        except (pymysql.Error, OSError, asyncio.TimeoutError) as e:
+            if full and isinstance(e, asyncio.TimeoutError):
+                router.busy(name)
+            else:
+                router.mark_down(name, e)
+            continue
+        usable = True
+        try:
+            if router.lag_check_due(name):
+                async with conn.cursor() as cursor:
+                    await cursor.execute(router.status_statement)
+                    usable = router.record_lag(name, replica_lag(await cursor.fetchone()))
+        except pymysql.Error as e:
+            await context.__aexit__(type(e), e, e.__traceback__)
+            router.mark_down(name, e)
+            continue
+        if not usable:
+            await context.__aexit__(None, None, None)
+            continue
+        router.read_from(name)
+        try:
+            yield conn
+        except BaseException as e:
+            if isinstance(e, (pymysql.OperationalError, pymysql.InterfaceError)):
+                router.mark_down(name, e)
+            if not await context.__aexit__(type(e), e, e.__traceback__):
+                raise
+        else:
+            await context.__aexit__(None, None, None)
+        return
+    router.read_from(None)
+    db = await get_pool()
+    async with db.acquire() as conn:
+        yield conn
+
+
+# Connection for a write, reads that follow it in the same request or session go to the primary
+@asynccontextmanager
+async def write_connection():
+    db = await get_pool()
+    try:
+        async with db.acquire() as conn:
+            yield conn
+    finally:
+        user_access.router.wrote()
+
+
+def pool_metrics():
+    if pool is None:
+        return {"size": 0, "idle": 0, "in_use": 0}
+    return {"size": pool.size, "idle": pool.freesize, "in_use": pool.size - pool.freesize,
+            "max_size": pool.maxsize, "min_size": pool.minsize}
+
+
+# Run a read and return all its rows, None if it fails
+async def fetch_all(sql, args):
+    async with read_connection() as conn, conn.cursor() as cursor:
+        try:
+            await cursor.execute(sql, args)
+            return await cursor.fetchall()
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
+            return None
+
+
+# See user_access.find_duplicate_user_fields
+@timed("mysql")
+async def find_duplicate_user_fields(field_dic):
+    sql, args = create_exists_statement(user_table_name, user_fields, field_dic)
+    if not sql:
+        return []
+    rows = await fetch_all(sql, args)
+    if rows is None:
+        duplicates = set(field_dic)
+    else:
+        duplicates = {field for field, exists in rows[0].items() if exists}
+    return [field for field in user_fields if field in duplicates]
+
+
+async def exist_duplicate_user_with_field(field_dic):
+    return len(await find_duplicate_user_fields(field_dic)) != 0
+
+
+@timed("mysql")
+async def query_users(user, columns=None, cached=True):
+    lookup = cache_lookup(user) if columns is None else None
+    if lookup and cached:
+        users = user_cache.get(*lookup)
+        if users:
+            return users
+    users = await fetch_all(*create_select_statement(user_table_name, user_fields, user, columns))
+    if lookup and users and user_access.router.cacheable():
+        user_cache.set(users)
+    return users
+
+
+@timed("mysql")
+async def query_users_by_cursor(user, limit, page_cursor, columns=None):
+    after_id = decode_cursor(page_cursor)
+    if after_id is None:
+        raise ValueError("Invalid cursor")
+    if columns and "user_id" not in columns:
+        columns = ["user_id"] + list(columns)
+    users = await fetch_all(*create_select_after_statement(user_table_name, user_fields, user, after_id, limit,
+                                                           columns))
+    if users is None:
+        return None
+    if len(users) > limit:
+        users = users[:limit]
+        return users, encode_cursor(users[-1]["user_id"])
+    return users, None
+
+
+# See user_access.search_users
+@timed("mysql")
+async def search_users(filters, sort, descending, limit, page_cursor, columns=None):
+    after = decode_search_cursor(page_cursor, sort, descending)
+    if columns:
+        columns = list(columns) + [column for column in ("user_id", sort) if column not in columns]
+    users = await fetch_all(*create_search_statement(user_table_name, filters, sort, descending, after, limit,
+                                                     columns))
+    if users is None:
+        return None
+    if len(users) > limit:
+        users = users[:limit]
+        return users, encode_search_cursor(sort, descending, users[-1])
+    return users, None
+
+
+# Stream users from a server-side cursor, see user_access.stream_users. Return an async iterator or None
+@timed("mysql")
+async def stream_users(user, columns=None):
+    rows = iterate_users(user, columns)
+    try:
+        first = await rows.__anext__()
+    except StopAsyncIteration:
+        return empty_rows()
+    except (pymysql.Error, pymysql.Warning) as e:
+        logger.error(e)
+        return None
+    return chain_rows(first, rows)
+
+
+async def iterate_users(user, columns):
+    sql, args = create_select_statement(user_table_name, user_fields, user, columns)
+    async with read_connection() as conn:
+        cursor = await conn.cursor(aiomysql.SSDictCursor)
+        try:
+            await cursor.execute(sql, args)
+            while True:
+                row = await cursor.fetchone()
+                if row is None:
+                    return
+                yield row
+        except (GeneratorExit, asyncio.CancelledError):
+            # The response stopped early, closed or cancelled when the client went away
+            abandon_unbuffered(conn, cursor)
+            raise
+        finally:
+            await cursor.close()
+
+
+# Async counterpart of user_access.abandon_unbuffered, aiomysql cursors keep their connection in _connection and
+# the pool drops a closed connection when it is released
+def abandon_unbuffered(conn, cursor):
+    cursor._connection = None
+    conn.close()
+
+
+async def empty_rows():
+    return
+    yield
+
+
+async def chain_rows(first, rows):
+    yield first
+    async for row in rows:
+        yield row
+
+
+@timed("mysql")
+async def query_user_by_id(id):
+    users = user_cache.get("user_id", id)
+    if users:
+        return users
+    users = await fetch_all(*create_select_by_id_statement(user_table_name, id))
+    if users and user_access.router.cacheable():
+        user_cache.set(users)
+    return users
+
+
+@timed("mysql")
+async def query_users_by_ids(ids, columns=None):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    if columns and "user_id" not in columns:
+        columns = ["user_id"] + list(columns)
+    users = await fetch_all(*create_select_by_ids_statement(user_table_name, ids, columns))
+    if users is None:
+        return None
+    return {user["user_id"]: user for user in users}
+
+
+@timed("mysql")
+async def create_user(user, parameters=None):
+    if parameters is None:
+        parameters = user_fields
+    password_hash = await password_hashing.hash_password_async(user["password"]) if "password" in user else None
+    sql, args = create_insert_statement(user_table_name, parameters, user, password_hash)
+    sql_fields = [parameter for parameter in parameters if parameter != "created_date" and parameter in user]
+    sql_fields.append("created_date")
+    async with write_connection() as conn, conn.cursor() as cursor:
+        try:
+            await cursor.execute(sql, args)
+            created_user = create_written_user(sql_fields, args, cursor.lastrowid)
+        except (pymysql.Error, pymysql.Warning) as e:
+            if is_duplicate_key_error(e):
+                raise duplicate_user_error(e)
+            logger.error(e)
+            return None
+    user_cache.invalidate(usernames=[user.get("username")], emails=[user.get("email")])
+    return created_user
+
+
+# See user_access.upsert_user_by_email
+@timed("mysql")
+async def upsert_user_by_email(user, parameters=None):
+    users = user_cache.get("email", user["email"])
+    if users:
+        return users
+    if parameters is None:
+        parameters = user_fields
+    sql, args = create_insert_ignore_duplicate_statement(user_table_name, parameters, user)
+    async with write_connection() as conn, conn.cursor() as cursor:
+        try:
+            await cursor.execute(sql, args)
+            await cursor.execute(*create_select_statement(user_table_name, user_fields, {"email": user["email"]}))
+            users = await cursor.fetchall()
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
+            return None
+    user_cache.invalidate(usernames=[user.get("username")], emails=[user["email"]])
+    if not users:
+        return None
+    user_cache.set(users)
+    return users
+
+
+@timed("mysql")
+async def update_users_by_id(user, id):
+    password_hash = await password_hashing.hash_password_async(user["password"]) if "password" in user else None
+    sql, args = create_update_by_id_statement(user_table_name, user_fields, user, id, password_hash)
+    if not sql:
+        return await query_user_by_id(id) or None
+    async with write_connection() as conn, conn.cursor() as cursor:
+        try:
+            if await cursor.execute(sql, args) == 0:
+                return None
+            return [dict(zip([field for field in user_fields if field in user], args), user_id=id)]
+        except (pymysql.Error, pymysql.Warning) as e:
+            if is_duplicate_key_error(e):
+                raise duplicate_user_error(e)
+            logger.error(e)
+            return None
+        finally:
+            user_cache.invalidate(id, usernames=[user.get("username")], emails=[user.get("email")])
+
+
+@timed("mysql")
+async def update_password_hash(id, password_hash):
+    sql, args = create_update_by_id_statement(user_table_name, ["password"], {"password": None}, id, password_hash)
+    async with write_connection() as conn, conn.cursor() as cursor:
+        try:
+            await cursor.execute(sql, args)
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
+            return None
+        finally:
+            user_cache.invalidate(id)
+    return id
+
+
+@timed("mysql")
+async def delete_users_by_id(id):
+    sql, args = create_delete_by_id_statement(user_table_name, id)
+    async with write_connection() as conn, conn.cursor() as cursor:
+        try:
+            await cursor.execute(sql, args)
+            user_cache.invalidate(id)
+            return id
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
+            return None
+
+
+@timed("mysql")
+async def delete_users_by_ids(ids):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    async with write_connection() as conn, conn.cursor() as cursor:
+        try:
+            await conn.begin()
+            await cursor.execute(*create_select_by_ids_statement(user_table_name, ids, ["user_id"], for_update=True))
+            deleted = [row["user_id"] for row in await cursor.fetchall()]
+            if deleted:
+                await cursor.execute(*create_delete_by_ids_statement(user_table_name, deleted))
+            await conn.commit()
+        except (pymysql.Error, pymysql.Warning) as e:
+            await conn.rollback()
+            logger.error(e)
+            return None
+        finally:
+            for id in ids:
+                user_cache.invalidate(id)
+    return deleted
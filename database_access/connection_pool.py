@@ -0,0 +1,205 @@
+import pymysql
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+# A bounded, thread-safe pool of pymysql connections built from a c_info style dictionary.
+# Connections are created lazily up to max_size, checked with ping on checkout and closed when idle for too long
+# (never below min_size).
+class ConnectionPool:
+    def __init__(self, connect_kwargs, min_size=1, max_size=10, timeout=5.0, idle_timeout=300.0,
+                 health_check_interval=30.0, connect=pymysql.connect):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size, min {} max {}".format(min_size, max_size))
+        self.connect_kwargs = dict(connect_kwargs)
+        # Reads should always see fresh data, so a pooled connection never keeps a transaction open.
+        self.connect_kwargs.setdefault("autocommit", True)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._connect = connect
+        # Idle connections as (connection, last_used) with the most recently used at the end
+        self._idle = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._metrics = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "created": 0,
+            "closed": 0,
+            "health_check_failures": 0,
+            "idle_evictions": 0,
+            "wait_time_total": 0.0,
+        }
+
+    # Open min_size connections ahead of the first request
+    def warm(self):
+        connections = []
+        try:
+            while True:
+                with self._lock:
+                    if self._size + len(connections) >= self.min_size:
+                        break
+                connections.append(self._create())
+        finally:
+            for conn in connections:
+                self._release(conn, discard=False)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        discard = False
+        try:
+            yield conn
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            discard = True
+            raise
+        except BaseException:
+            # Make sure a failed write does not leak a half done transaction to the next user
+            try:
+                conn.rollback()
+            except (pymysql.Error, pymysql.Warning):
+                discard = True
+            raise
+        finally:
+            self._release(conn, discard)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["size"] = self._size
+            metrics["idle"] = len(self._idle)
+            metrics["in_use"] = self._size - len(self._idle)
+            metrics["max_size"] = self.max_size
+            metrics["min_size"] = self.min_size
+        return metrics
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._metrics["closed"] += len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    # Connections failing their health check are closed and the checkout goes on within the same deadline
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        start = time.monotonic()
+        with self._lock:
+            self._metrics["checkouts"] += 1
+        while True:
+            with self._lock:
+                expired = self._evict_idle()
+                while True:
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        # Reserve the slot, the connection is opened outside the lock
+                        self._size += 1
+                        conn, last_used = None, None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._metrics["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            "Timed out after {}s waiting for a database connection".format(self.timeout))
+                    if not waited:
+                        waited = True
+                        self._metrics["waits"] += 1
+                    self._available.wait(remaining)
+            for idle_conn in expired:
+                self._close(idle_conn)
+            if conn is None:
+                try:
+                    conn = self._connect(**self.connect_kwargs)
+                except BaseException:
+                    with self._lock:
+                        self._size -= 1
+                        self._available.notify()
+                    raise
+                with self._lock:
+                    self._metrics["created"] += 1
+                break
+            if time.monotonic() - last_used < self.health_check_interval or self._healthy(conn):
+                break
+            with self._lock:
+                self._metrics["health_check_failures"] += 1
+                self._metrics["closed"] += 1
+                self._size -= 1
+                self._available.notify()
+            self._close(conn)
+        if waited:
+            with self._lock:
+                self._metrics["wait_time_total"] += time.monotonic() - start
+        return conn
+
+    def _release(self, conn, discard):
+        if not discard and not conn.open:
+            discard = True
+        with self._lock:
+            if discard:
+                self._size -= 1
+                self._metrics["closed"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._available.notify()
+        if discard:
+            self._close(conn)
+
+    def _create(self):
+        with self._lock:
+            if self._size >= self.max_size:
+                raise PoolTimeoutError("Pool is full")
+            self._size += 1
+            self._metrics["created"] += 1
+        try:
+            return self._connect(**self.connect_kwargs)
+        except BaseException:
+            with self._lock:
+                self._size -= 1
+            raise
+
+    # Remove connections idle for longer than idle_timeout, oldest first, keeping at least min_size.
+    # Must be called with the lock held; the caller closes the returned connections.
+    def _evict_idle(self):
+        expired = []
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] >= self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            expired.append(conn)
+            self._size -= 1
+            self._metrics["idle_evictions"] += 1
+            self._metrics["closed"] += 1
+        return expired
+
+    @staticmethod
+    def _healthy(conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.warning("Discard unhealthy database connection: {}".format(e))
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except (pymysql.Error, pymysql.Warning):
+            pass
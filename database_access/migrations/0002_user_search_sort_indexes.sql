@@ -0,0 +1,14 @@
+-- Indexes for a role or status filter combined with each sort of GET /api/users/search, see
+-- user_access.search_sort_fields. Without them MySQL reads the whole role or status range and sorts it before
+-- returning the first page. The user_id sort uses the single column indexes since InnoDB appends user_id to them.
+-- Check the plans after applying it with: python -m benchmarks.explain_search
+
+ALTER TABLE signals.users
+    ADD INDEX users_role (role),
+    ADD INDEX users_role_created_date (role, created_date),
+    ADD INDEX users_role_username (role, username),
+    ADD INDEX users_role_email (role, email),
+    ADD INDEX users_status (status),
+    ADD INDEX users_status_username (status, username),
+    ADD INDEX users_status_email (status, email),
+    ALGORITHM=INPLACE, LOCK=NONE;
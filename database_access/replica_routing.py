@@ -0,0 +1,200 @@
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import pymysql
+from database_access.connection_pool import PoolTimeoutError
+
+logger = logging.getLogger()
+
+
+class ReplicaLagging(Exception):
+    pass
+
+
+# Seconds a replica is behind its source from the row of SHOW REPLICA STATUS / SHOW SLAVE STATUS, None when it does
+# not replicate
+def replica_lag(row):
+    if not row:
+        return None
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    return float(lag) if lag is not None else None
+
+
+# Send reads to replicas, round robin, and writes to the primary. Reads go to the primary instead:
+#  * for sticky_seconds after a write of the same request or session, so a client reads its own writes
+#  * when every replica is down, retried after retry_interval, or more than max_lag seconds behind, checked on a
+#    replica connection at most every lag_check_interval
+# replicas maps a name to a ConnectionPool, the same kind of pool as primary. The async application keeps its own
+# aiomysql pools and asks the router where to read through candidates, lag_check_due, record_lag, busy and
+# mark_down.
+class ReplicaRouter:
+    def __init__(self, primary, replicas=None, max_lag=5.0, sticky_seconds=5.0, lag_check_interval=1.0,
+                 retry_interval=10.0, status_statement="SHOW SLAVE STATUS"):
+        self.primary = primary
+        self.replicas = dict(replicas or {})
+        self.names = list(self.replicas)
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self.lag_check_interval = lag_check_interval
+        self.retry_interval = retry_interval
+        self.status_statement = status_statement
+        # Wall clock time of the last write of this process, rows read from a replica before it may be stale
+        self.last_write = 0.0
+        # name: {"down_until", "lag", "checked_at"}, lag is None until the first check and when not replicating
+        self._state = {name: {"down_until": 0.0, "lag": None, "checked_at": None} for name in self.names}
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        # Wall clock time reads of the current request or session go to the primary until, kept in the session
+        # between requests so it holds across workers
+        self._primary_until = ContextVar("primary_until", default=0.0)
+        # Replica the last read of the current context went to, None for the primary
+        self._read_from = ContextVar("read_from", default=None)
+        self._metrics = {"replica_reads": 0, "primary_reads": 0, "sticky_reads": 0, "fallbacks": 0,
+                         "lag_checks": 0, "lagging": 0, "failures": 0, "busy": 0}
+
+    # Called when a request starts with the primary_until saved in its session, 0 without one
+    def start_request(self, primary_until=0.0):
+        self._primary_until.set(primary_until or 0.0)
+        self._read_from.set(None)
+
+    def primary_until(self):
+        return self._primary_until.get()
+
+    def wrote(self):
+        now = time.time()
+        self.last_write = now
+        self._primary_until.set(now + self.sticky_seconds)
+
+    # Replicas to try for a read in order, empty when the read has to go to the primary
+    def candidates(self):
+        if not self.names:
+            return []
+        if time.time() < self._primary_until.get():
+            self._metrics["sticky_reads"] += 1
+            return []
+        start = next(self._next)
+        now = time.monotonic()
+        with self._lock:
+            names = [self.names[(start + i) % len(self.names)] for i in range(len(self.names))]
+            names = [name for name in names if self._state[name]["down_until"] <= now and
+                     (self._within_max_lag(self._state[name]) or self._lag_check_due(self._state[name], now))]
+        if not names:
+            self._metrics["fallbacks"] += 1
+        return names
+
+    def lag_check_due(self, name):
+        with self._lock:
+            return self._lag_check_due(self._state[name], time.monotonic())
+
+    def _lag_check_due(self, state, now):
+        return state["checked_at"] is None or now - state["checked_at"] >= self.lag_check_interval
+
+    def _within_max_lag(self, state):
+        return state["lag"] is not None and state["lag"] <= self.max_lag
+
+    # Record the lag measured on a replica, return whether it may serve reads
+    def record_lag(self, name, lag):
+        with self._lock:
+            state = self._state[name]
+            state["lag"] = lag
+            state["checked_at"] = time.monotonic()
+            usable = self._within_max_lag(state)
+        self._metrics["lag_checks"] += 1
+        if not usable:
+            self._metrics["lagging"] += 1
+            logger.warning("Replica {} is {} behind, reading from the primary".format(
+                name, "{}s".format(lag) if lag is not None else "not replicating"))
+        return usable
+
+    def mark_down(self, name, error):
+        with self._lock:
+            self._state[name]["down_until"] = time.monotonic() + self.retry_interval
+        self._metrics["failures"] += 1
+        logger.warning("Replica {} is unavailable for {}s: {}".format(name, self.retry_interval, error))
+
+    # A replica without a free connection is busy, not unhealthy, the read goes to the next replica or the primary
+    def busy(self, name):
+        self._metrics["busy"] += 1
+
+    def read_from(self, name):
+        self._read_from.set(name)
+        self._metrics["replica_reads" if name is not None else "primary_reads"] += 1
+
+    # Whether rows from the last read may be cached: not when they came from a replica that may not have a write
+    # this process made yet
+    def cacheable(self):
+        return self._read_from.get() is None or time.time() - self.last_write > self.max_lag
+
+    def check_lag(self, name, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(self.status_statement)
+            row = cursor.fetchone()
+        if not self.record_lag(name, replica_lag(row)):
+            raise ReplicaLagging(name)
+
+    # Connection for a read, from a replica when one can serve it and from the primary otherwise
+    @contextmanager
+    def read_connection(self):
+        for name in self.candidates():
+            context = self.replicas[name].connection()
+            try:
+                conn = context.__enter__()
+            except PoolTimeoutError:
+                self.busy(name)
+                continue
+            except pymysql.Error as e:
+                self.mark_down(name, e)
+                continue
+            try:
+                if self.lag_check_due(name):
+                    self.check_lag(name, conn)
+            except (pymysql.Error, ReplicaLagging) as e:
+                context.__exit__(type(e), e, e.__traceback__)
+                if not isinstance(e, ReplicaLagging):
+                    self.mark_down(name, e)
+                continue
+            self.read_from(name)
+            try:
+                yield conn
+            except BaseException as e:
+                if isinstance(e, (pymysql.OperationalError, pymysql.InterfaceError)):
+                    self.mark_down(name, e)
+                if not context.__exit__(type(e), e, e.__traceback__):
+                    raise
+            else:
+                context.__exit__(None, None, None)
+            return
+        self.read_from(None)
+        with self.primary.connection() as conn:
+            yield conn
+
+    # Connection for a write, reads that follow it in the same request or session go to the primary
+    @contextmanager
+    def write_connection(self):
+        try:
+            with self.primary.connection() as conn:
+                yield conn
+        finally:
+            self.wrote()
+
+    def warm(self):
+        for pool in self.replicas.values():
+            pool.warm()
+
+    def close(self):
+        for pool in self.replicas.values():
+            pool.close()
+
+    def metrics(self):
+        metrics = dict(self._metrics)
+        metrics["replicas"] = len(self.names)
+        with self._lock:
+            now = time.monotonic()
+            metrics["replicas_down"] = sum(1 for state in self._state.values() if state["down_until"] > now)
+            lags = [state["lag"] for state in self._state.values() if state["lag"] is not None]
+        if lags:
+            metrics["max_replica_lag"] = max(lags)
+        return metrics
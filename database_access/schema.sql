@@ -0,0 +1,21 @@
+-- signals.users as it is before database_access/migrations, for creating a new database such as the one of CI.
+-- Apply the migrations in order after it. Duplicate detection relies on the username and email unique keys, see
+-- user_access.duplicate_user_error.
+
+CREATE DATABASE IF NOT EXISTS signals;
+
+CREATE TABLE IF NOT EXISTS signals.users (
+    user_id INT NOT NULL AUTO_INCREMENT,
+    username VARCHAR(255) NOT NULL,
+    password VARCHAR(255) NOT NULL,
+    email VARCHAR(255) NOT NULL,
+    phone VARCHAR(32),
+    slack_id VARCHAR(64),
+    role VARCHAR(32) NOT NULL,
+    status VARCHAR(32) NOT NULL,
+    address VARCHAR(255),
+    created_date DATETIME NOT NULL,
+    PRIMARY KEY (user_id),
+    UNIQUE KEY username (username),
+    UNIQUE KEY email (email)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
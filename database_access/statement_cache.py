@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+
+
+# LRU cache of parameterized sql templates keyed by the shape of a request, e.g. ("select", table, ("email",), True).
+# Values are never part of the key, they are passed to cursor.execute as bind parameters.
+class StatementCache:
+    def __init__(self, max_size=256):
+        if max_size < 1:
+            raise ValueError("Invalid statement cache size {}".format(max_size))
+        self.max_size = max_size
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    # Return the template for key, building it with build() on a miss
+    def get(self, key, build):
+        with self._lock:
+            sql = self._statements.get(key)
+            if sql is not None:
+                self._statements.move_to_end(key)
+                self._hits += 1
+                return sql
+            self._misses += 1
+        sql = build()
+        with self._lock:
+            self._statements[key] = sql
+            self._statements.move_to_end(key)
+            while len(self._statements) > self.max_size:
+                self._statements.popitem(last=False)
+                self._evictions += 1
+        return sql
+
+    def metrics(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "size": len(self._statements),
+                "hit_ratio": self._hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
@@ -1,106 +1,377 @@
 import pymysql
+from pymysql.constants import CLIENT
 import logging
+import base64
+import binascii
+import json
 from datetime import datetime
-import os
-from passlib.hash import sha256_crypt
+import tools.password_hashing as password_hashing
+from tools.instrumentation import timed
+from database_access.connection_pool import ConnectionPool
+from database_access.replica_routing import ReplicaRouter
+from database_access.statement_cache import StatementCache
+from database_access.user_cache import UserCache, create_backend
+from settings import settings
 
 logger = logging.getLogger()
 
 c_info = {
-    "host": os.environ['USER_SERVICE_HOST'],
-    "user": os.environ['USER_SERVICE_USER'],
-    "password": os.environ['USER_SERVICE_PASSWORD'],
-    "port": int(os.environ["USER_SERVICE_PORT"]),
+    "host": settings.db_host,
+    "user": settings.db_user,
+    "password": settings.db_password,
+    "port": settings.db_port,
     "cursorclass": pymysql.cursors.DictCursor,
+    # Report matched rather than changed rows for UPDATE so an unchanged row still counts as found
+    "client_flag": CLIENT.FOUND_ROWS,
 }
 
+# Shared by every function below, connections are opened lazily on first use
+pool = ConnectionPool(c_info,
+                      min_size=settings.pool_min_size,
+                      max_size=settings.pool_max_size,
+                      timeout=settings.pool_timeout,
+                      idle_timeout=settings.pool_idle_timeout)
+
+# Connection settings of each read replica by host:port, the primary also serves reads when there are none
+replica_c_infos = {"{}:{}".format(host, port or settings.db_port): dict(c_info, host=host, port=port or settings.db_port)
+                   for host, port in settings.db_replicas}
+router = ReplicaRouter(pool,
+                       {name: ConnectionPool(info,
+                                             min_size=settings.pool_min_size,
+                                             max_size=settings.pool_max_size,
+                                             timeout=settings.pool_timeout,
+                                             idle_timeout=settings.pool_idle_timeout)
+                        for name, info in replica_c_infos.items()},
+                       max_lag=settings.replica_max_lag,
+                       sticky_seconds=settings.replica_sticky_seconds,
+                       lag_check_interval=settings.replica_lag_check_interval,
+                       retry_interval=settings.replica_retry_interval,
+                       status_statement=settings.replica_status_statement)
+
+# Parameterized sql templates keyed by the set of fields in a request
+statement_cache = StatementCache(settings.statement_cache_size)
+
+# Read-through cache of single user lookups, a TTL of 0 disables it
+user_cache = UserCache(create_backend(settings.user_cache_backend, settings.user_cache_max_size),
+                       ttl=settings.user_cache_ttl)
+
+# Skip duplicate pre-checks and let the unique indexes on username and email reject the write instead
+rely_on_unique_index = settings.rely_on_unique_index
+ER_DUP_ENTRY = 1062
+
 user_table_name = "signals.users"
 # Date should be the last one
 user_fields = ["username", "password", "email", "phone",
                "slack_id", "role", "status", "address", "created_date"]
 required_user_fields = ["username", "password", "email", "phone",
                         "slack_id", "role", "status", "address"]
+# Columns a client may select, and the ones returned when it does not choose
+selectable_user_fields = ["user_id"] + user_fields
+public_user_fields = [field for field in selectable_user_fields if field != "password"]
 
-# Create a sql statement to insert data according to parameters into a table by its table_name
-def create_insert_statement(table_name, parameters, data):
+# Create a sql statement to insert data according to parameters into a table by its table_name.
+# Return the cached template and its bind values. Pass password_hash when the password is already hashed
+def create_insert_statement(table_name, parameters, data, password_hash=None):
     if data is None or len(data) == 0:
-        return ""
-    sql = """INSERT INTO {} ({}) """.format(table_name, ', '.join(parameters))
-    sql += """ VALUES ("""
-    for parameter in parameters:
-        # Suppose every parameter is a string
-        if parameter != "created_date" and parameter in data:
-            if parameter == "password":
-                # Encrypt password
-                sql += """'{}', """.format(sha256_crypt.hash(data[parameter]))
-            else:
-                sql += """'{}', """.format(data[parameter])
+        return "", ()
+    fields = tuple(parameter for parameter in parameters if parameter != "created_date" and parameter in data)
+    sql = create_insert_template(table_name, fields)
+    args = [bind_value(data, field, password_hash) for field in fields]
     # Handle case for created_date
-    sql += """'{}')""".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    return sql
+    args.append(datetime.now().replace(microsecond=0))
+    return sql, tuple(args)
 
 
-# Create a sql statement to update a row by its id and table_name with data and its parameters
-def create_update_by_id_statement(table_name, parameters, data, id):
+# Value to bind for a field, the password is stored hashed
+def bind_value(data, field, password_hash=None):
+    if field != "password":
+        return data[field]
+    if password_hash is not None:
+        return password_hash
+    return password_hashing.hash_password(data[field])
+
+
+# Insert template for the given fields followed by created_date, shared by single and multi-row inserts
+def create_insert_template(table_name, fields):
+    return statement_cache.get(("insert", table_name, fields), lambda: """INSERT INTO {} ({}) VALUES ({})""".format(
+        table_name, ", ".join(fields + ("created_date",)), ", ".join(["%s"] * (len(fields) + 1))))
+
+
+# Insert statement that leaves the row in place when a unique key already holds one of the values
+def create_insert_ignore_duplicate_statement(table_name, parameters, data):
     if data is None or len(data) == 0:
-        return ""
-    sql = """UPDATE {} SET """.format(table_name)
-    for parameter in parameters:
-        if parameter in data:
-            if parameter == "password":
-                # Encrypt password
-                sql += """{} = "{}", """.format(parameter, sha256_crypt.hash(data[parameter]))
-            else:
-                sql += """{} = "{}", """.format(parameter, data[parameter])
-    sql = sql[:-2]
-    sql += """ WHERE user_id = {}""".format(id)
-    return sql
+        return "", ()
+    fields = tuple(parameter for parameter in parameters if parameter != "created_date" and parameter in data)
+    sql = statement_cache.get(("insert_ignore_duplicate", table_name, fields),
+                              lambda: create_insert_template(table_name, fields) +
+                              " ON DUPLICATE KEY UPDATE user_id = user_id")
+    args = [bind_value(data, field) for field in fields]
+    args.append(datetime.now().replace(microsecond=0))
+    return sql, tuple(args)
 
 
-def create_select_statement(table_name, parameters, data):
-    # Select all
-    sql = """SELECT * FROM {} """.format(table_name)
+# Create a sql statement to update a row by its id and table_name with data and its parameters
+def create_update_by_id_statement(table_name, parameters, data, id, password_hash=None):
     if data is None or len(data) == 0:
-        return sql
-    if ("limit" not in data and "offset" not in data) or ("limit" in data and "offset" in data and len(data) > 2):
-        sql += "WHERE "
-    for parameter in parameters:
-        if parameter in data:
-            sql += """ {} = "{}" AND """.format(parameter, data[parameter])
-    if ("limit" not in data and "offset" not in data) or (
-            "limit" in data and "offset" in data and len(data) > 2):
-        sql = sql[:-4]
-    if "limit" in data and "offset" in data:
-        sql += " LIMIT {} OFFSET {}".format(int(data["limit"]), int(data["limit"])*int(data["offset"]))
-    print(sql)
+        return "", ()
+    fields = tuple(parameter for parameter in parameters if parameter in data)
+    if not fields:
+        return "", ()
+    sql = statement_cache.get(("update_by_id", table_name, fields), lambda: """UPDATE {} SET {} WHERE user_id = %s""".format(
+        table_name, ", ".join("{} = %s".format(field) for field in fields)))
+    args = [bind_value(data, field, password_hash) for field in fields]
+    args.append(id)
+    return sql, tuple(args)
+
+
+# Create a sql statement to select rows matching every field of data, paged when both limit and offset are given
+# Only the given columns are selected, all of them by default
+def create_select_statement(table_name, parameters, data, columns=None):
+    if data is None:
+        data = {}
+    fields = tuple(parameter for parameter in parameters if parameter in data)
+    paged = "limit" in data and "offset" in data
+    columns = tuple(columns) if columns else None
+    sql = statement_cache.get(("select", table_name, fields, paged, columns),
+                              lambda: build_select_statement(table_name, fields, paged, columns))
+    args = [data[field] for field in fields]
+    if paged:
+        args.extend([int(data["limit"]), int(data["limit"]) * int(data["offset"])])
+    return sql, tuple(args)
+
+
+def build_select_statement(table_name, fields, paged, columns=None):
+    sql = """SELECT {} FROM {}""".format(", ".join(columns) if columns else "*", table_name)
+    if fields:
+        sql += " WHERE " + " AND ".join("{} = %s".format(field) for field in fields)
+    if paged:
+        sql += " LIMIT %s OFFSET %s"
     return sql
 
 
+# Create a keyset paged select: rows matching data with user_id after after_id, in user_id order.
+# One extra row is fetched to tell if there is a next page
+def create_select_after_statement(table_name, parameters, data, after_id, limit, columns=None):
+    if data is None:
+        data = {}
+    fields = tuple(parameter for parameter in parameters if parameter in data)
+    columns = tuple(columns) if columns else None
+    sql = statement_cache.get(("select_after", table_name, fields, columns),
+                              lambda: build_select_after_statement(table_name, fields, columns))
+    args = [data[field] for field in fields]
+    args.extend([after_id, limit + 1])
+    return sql, tuple(args)
+
+
+def build_select_after_statement(table_name, fields, columns=None):
+    conditions = ["{} = %s".format(field) for field in fields] + ["user_id > %s"]
+    return """SELECT {} FROM {} WHERE {} ORDER BY user_id LIMIT %s""".format(
+        ", ".join(columns) if columns else "*", table_name, " AND ".join(conditions))
+
+
+# Opaque cursor pointing after the given user_id
+def encode_cursor(user_id):
+    return base64.urlsafe_b64encode(json.dumps({"user_id": user_id}).encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+# Return the user_id in a cursor, 0 for an empty cursor (first page) and None if it is invalid
+def decode_cursor(cursor):
+    if not cursor:
+        return 0
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        user_id = payload["user_id"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(user_id, int) or isinstance(user_id, bool) or user_id < 0:
+        return None
+    return user_id
+
+
+# Filters of the search, as (query parameter, column, kind). Each one can be served by an index, see
+# database_access/migrations/0001_user_search_indexes.sql, and benchmarks/explain_search.py checks that none
+# of them scans the table
+search_filters = [
+    ("username_prefix", "username", "prefix"),
+    ("email_prefix", "email", "prefix"),
+    ("role", "role", "in"),
+    ("status", "status", "in"),
+    ("created_after", "created_date", "from"),
+    ("created_before", "created_date", "before"),
+]
+# Columns a search can be sorted by, ties are broken by user_id
+search_sort_fields = ["user_id", "created_date", "username", "email"]
+
+
+# Escape the LIKE wildcards of a prefix
+def like_prefix(prefix):
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+# Create a keyset paged search: rows matching every filter, ordered by sort and then user_id, after the
+# (sort value, user_id) in after when given. filters maps the parameters of search_filters to a value, a list of
+# values for the "in" ones. One extra row is fetched to tell if there is a next page
+def create_search_statement(table_name, filters, sort, descending, after, limit, columns=None):
+    shape = tuple((parameter, len(filters[parameter]) if kind == "in" else None)
+                  for parameter, _, kind in search_filters if parameter in filters)
+    columns = tuple(columns) if columns else None
+    sql = statement_cache.get(("search", table_name, shape, sort, descending, after is not None, columns),
+                              lambda: build_search_statement(table_name, dict(shape), sort, descending,
+                                                             after is not None, columns))
+    args = []
+    for parameter, _, kind in search_filters:
+        if parameter not in filters:
+            continue
+        if kind == "in":
+            args.extend(filters[parameter])
+        elif kind == "prefix":
+            args.append(like_prefix(filters[parameter]))
+        else:
+            args.append(filters[parameter])
+    if after is not None:
+        args.extend([after[1]] if sort == "user_id" else [after[0], after[0], after[1]])
+    args.append(limit + 1)
+    return sql, tuple(args)
+
+
+def build_search_statement(table_name, shape, sort, descending, paged, columns=None):
+    conditions = []
+    for parameter, column, kind in search_filters:
+        if parameter not in shape:
+            continue
+        if kind == "in":
+            conditions.append("{} IN ({})".format(column, ", ".join(["%s"] * shape[parameter])))
+        elif kind == "prefix":
+            conditions.append("{} LIKE %s".format(column))
+        else:
+            conditions.append("{} {} %s".format(column, ">=" if kind == "from" else "<"))
+    after = "<" if descending else ">"
+    if paged and sort == "user_id":
+        conditions.append("user_id {} %s".format(after))
+    elif paged:
+        conditions.append("({0} {1} %s OR ({0} = %s AND user_id {1} %s))".format(sort, after))
+    direction = " DESC" if descending else ""
+    order = ["user_id" + direction] if sort == "user_id" else [sort + direction, "user_id" + direction]
+    sql = """SELECT {} FROM {}""".format(", ".join(columns) if columns else "*", table_name)
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql + " ORDER BY {} LIMIT %s".format(", ".join(order))
+
+
+# Opaque search cursor holding the sort and the (sort value, user_id) of the last row of a page
+def encode_search_cursor(sort, descending, row):
+    after = [str(row[sort]) if isinstance(row[sort], datetime) else row[sort], row["user_id"]]
+    payload = {"sort": ("-" if descending else "") + sort, "after": after}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+# Return the (sort value, user_id) in a search cursor, None for an empty cursor (first page).
+# Raise ValueError if it is invalid or was made for another sort
+def decode_search_cursor(cursor, sort, descending):
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        value, user_id = payload["after"]
+        same_sort = payload["sort"] == ("-" if descending else "") + sort
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor") from None
+    if not same_sort or not isinstance(user_id, int) or isinstance(user_id, bool) or \
+            not isinstance(value, (str, int)) or isinstance(value, bool):
+        raise ValueError("Invalid cursor")
+    return value, user_id
+
+
 def create_select_by_id_statement(table_name, id):
-    return """SELECT * FROM {} WHERE user_id = {}""".format(table_name, id)
+    sql = statement_cache.get(("select_by_id", table_name),
+                              lambda: """SELECT * FROM {} WHERE user_id = %s""".format(table_name))
+    return sql, (id,)
+
+
+# Select the users with any of the ids, the template is cached per number of ids
+def create_select_by_ids_statement(table_name, ids, columns=None, for_update=False):
+    columns = tuple(columns) if columns else None
+    sql = statement_cache.get(("select_by_ids", table_name, len(ids), columns, for_update),
+                              lambda: """SELECT {} FROM {} WHERE user_id IN ({}){}""".format(
+                                  ", ".join(columns) if columns else "*", table_name, ", ".join(["%s"] * len(ids)),
+                                  " FOR UPDATE" if for_update else ""))
+    return sql, tuple(ids)
+
+
+def create_delete_by_ids_statement(table_name, ids):
+    sql = statement_cache.get(("delete_by_ids", table_name, len(ids)),
+                              lambda: """DELETE FROM {} WHERE user_id IN ({})""".format(
+                                  table_name, ", ".join(["%s"] * len(ids))))
+    return sql, tuple(ids)
 
 
 def create_delete_by_id_statement(table_name, id):
-    return """DELETE FROM {} WHERE user_id = {}""".format(table_name, id)
+    sql = statement_cache.get(("delete_by_id", table_name),
+                              lambda: """DELETE FROM {} WHERE user_id = %s""".format(table_name))
+    return sql, (id,)
 
 
-# Check if there is a duplicate username
-def exist_duplicate_user_with_field(field_dic):
-    sql = create_select_statement(user_table_name, user_fields, field_dic)
-    conn = pymysql.connect(**c_info)
-    with conn.cursor() as cursor:
+# Return the (field, value) to look up in user_cache if the query is on a single username or email
+def cache_lookup(field_dic):
+    if field_dic and len(field_dic) == 1:
+        field, value = next(iter(field_dic.items()))
+        if field in ("username", "email"):
+            return field, value
+    return None
+
+
+# Raised by writes when rely_on_unique_index is set and a unique index rejects the row, field is the colliding column
+class DuplicateUserError(Exception):
+    def __init__(self, field, message):
+        super().__init__(message)
+        self.field = field
+
+
+# Create a single statement telling for each field whether a user already has that value
+def create_exists_statement(table_name, parameters, data):
+    fields = tuple(parameter for parameter in parameters if parameter in data)
+    sql = statement_cache.get(("exists", table_name, fields), lambda: "SELECT " + ", ".join(
+        """EXISTS(SELECT 1 FROM {} WHERE {} = %s) AS {}""".format(table_name, field, field) for field in fields))
+    return sql, tuple(data[field] for field in fields)
+
+
+# Return the fields of field_dic, e.g. {"username": "a", "email": "b"}, whose value is already taken, in user_fields order.
+# Every field counts as taken if the check itself fails. The user cache is not consulted: it is per process, so a
+# username freed by another worker could still look taken
+@timed("mysql")
+def find_duplicate_user_fields(field_dic):
+    sql, args = create_exists_statement(user_table_name, user_fields, field_dic)
+    if not sql:
+        return []
+    duplicates = set()
+    with router.read_connection() as conn, conn.cursor() as cursor:
         try:
-            cursor.execute(sql)
-            users = cursor.fetchall()
-            if len(users) != 0:
-                return True
+            cursor.execute(sql, args)
+            row = cursor.fetchone()
+            duplicates.update(field for field, exists in row.items() if exists)
         except (pymysql.Error, pymysql.Warning) as e:
             logger.error(e)
-            conn.rollback()
-            return True
-        finally:
-            conn.close()
-    return False
+            duplicates.update(field_dic)
+    return [field for field in user_fields if field in duplicates]
+
+
+# Check if there is a duplicate username
+def exist_duplicate_user_with_field(field_dic):
+    return len(find_duplicate_user_fields(field_dic)) != 0
+
+
+# Map a duplicate key error like "Duplicate entry 'a' for key 'users.username'" to the colliding field
+def duplicate_user_error(e):
+    key = str(e.args[1] if len(e.args) > 1 else e).rsplit(" for key ", 1)[-1].strip("'\" ")
+    key = key.rsplit(".", 1)[-1]
+    for field in ("username", "email"):
+        if field in key:
+            return DuplicateUserError(field, str(e))
+    return DuplicateUserError(None, str(e))
+
+
+def is_duplicate_key_error(e):
+    return isinstance(e, pymysql.IntegrityError) and len(e.args) > 0 and e.args[0] == ER_DUP_ENTRY
 
 
 # Check if all fields required are in user
@@ -112,78 +383,318 @@ def required_field_exist(user):
 
 
 # Endpoint to query users from a given user dictionary
-def query_users(user):
-    sql = create_select_statement(user_table_name, user_fields, user)
-    conn = pymysql.connect(**c_info)
-    with conn.cursor() as cursor:
+# Pass columns to select only those, e.g. public_user_fields. Pass cached=False to read the row from the database
+# even when it is cached, as login does: another worker may have changed the password or status since
+@timed("mysql")
+def query_users(user, columns=None, cached=True):
+    # Only full rows are cached
+    lookup = cache_lookup(user) if columns is None else None
+    if lookup and cached:
+        users = user_cache.get(*lookup)
+        if users:
+            return users
+    sql, args = create_select_statement(user_table_name, user_fields, user, columns)
+    with router.read_connection() as conn, conn.cursor() as cursor:
         try:
-            cursor.execute(sql)
+            cursor.execute(sql, args)
             users = cursor.fetchall()
+            if lookup and router.cacheable():
+                user_cache.set(users)
             return users
         except (pymysql.Error, pymysql.Warning) as e:
             logger.error(e)
             return None
+
+
+# Return the usernames and emails among the given ones that are already taken, in one query
+@timed("mysql")
+def find_existing_usernames_and_emails(usernames, emails):
+    usernames, emails = list(usernames), list(emails)
+    if not usernames and not emails:
+        return set(), set()
+    sql = statement_cache.get(("exists_in", user_table_name, len(usernames), len(emails)),
+                              lambda: build_exists_in_statement(user_table_name, len(usernames), len(emails)))
+    with router.read_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(sql, usernames + emails)
+        rows = cursor.fetchall()
+    taken_usernames = set(usernames).intersection(row["username"] for row in rows)
+    taken_emails = set(emails).intersection(row["email"] for row in rows)
+    return taken_usernames, taken_emails
+
+
+def build_exists_in_statement(table_name, username_count, email_count):
+    conditions = []
+    if username_count:
+        conditions.append("username IN ({})".format(", ".join(["%s"] * username_count)))
+    if email_count:
+        conditions.append("email IN ({})".format(", ".join(["%s"] * email_count)))
+    return """SELECT username, email FROM {} WHERE {}""".format(table_name, " OR ".join(conditions))
+
+
+# Insert users whose password is already hashed with one multi-row INSERT.
+# Return an error message per user, None for the created ones. If the batch is rejected, for example by a duplicate
+# inserted concurrently, the users are inserted one by one so every row gets its own outcome
+@timed("mysql")
+def create_users(users):
+    if not users:
+        return []
+    fields = tuple(required_user_fields)
+    sql = create_insert_template(user_table_name, fields)
+    created_date = datetime.now().replace(microsecond=0)
+    rows = [tuple(user[field] for field in fields) + (created_date,) for user in users]
+    with router.write_connection() as conn, conn.cursor() as cursor:
+        try:
+            conn.begin()
+            # PyMySQL turns executemany on INSERT ... VALUES into multi-row inserts
+            cursor.executemany(sql, rows)
+            conn.commit()
+            errors = [None] * len(users)
+        except (pymysql.Error, pymysql.Warning) as e:
+            conn.rollback()
+            logger.warning("Bulk insert of {} users failed, insert one by one: {}".format(len(users), e))
+            errors = create_users_one_by_one(conn, cursor, sql, rows)
+    user_cache.invalidate(usernames=[user["username"] for user in users], emails=[user["email"] for user in users])
+    return errors
+
+
+def create_users_one_by_one(conn, cursor, sql, rows):
+    errors = []
+    for row in rows:
+        try:
+            cursor.execute(sql, row)
+            commit(conn)
+            errors.append(None)
+        except (pymysql.Error, pymysql.Warning) as e:
+            conn.rollback()
+            if is_duplicate_key_error(e):
+                field = duplicate_user_error(e).field
+                errors.append("{} is duplicate".format(field.capitalize()) if field else "User is duplicate")
+            else:
+                logger.error(e)
+                errors.append("Internal Server Error")
+    return errors
+
+
+# Query a page of users after the cursor, return the users and the cursor of the next page (None on the last page)
+@timed("mysql")
+def query_users_by_cursor(user, limit, page_cursor, columns=None):
+    after_id = decode_cursor(page_cursor)
+    if after_id is None:
+        raise ValueError("Invalid cursor")
+    # The next cursor is built from user_id
+    if columns and "user_id" not in columns:
+        columns = ["user_id"] + list(columns)
+    sql, args = create_select_after_statement(user_table_name, user_fields, user, after_id, limit, columns)
+    with router.read_connection() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute(sql, args)
+            users = cursor.fetchall()
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
+            return None
+    if len(users) > limit:
+        users = users[:limit]
+        return users, encode_cursor(users[-1]["user_id"])
+    return users, None
+
+
+# Search users with the filters of search_filters, sorted by one of search_sort_fields. Return (users, next cursor),
+# the cursor is None on the last page. Raise ValueError if page_cursor is invalid, return None if the query fails
+@timed("mysql")
+def search_users(filters, sort, descending, limit, page_cursor, columns=None):
+    after = decode_search_cursor(page_cursor, sort, descending)
+    # The next cursor is built from the sort column and user_id
+    if columns:
+        columns = list(columns) + [column for column in ("user_id", sort) if column not in columns]
+    sql, args = create_search_statement(user_table_name, filters, sort, descending, after, limit, columns)
+    with router.read_connection() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute(sql, args)
+            users = cursor.fetchall()
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
+            return None
+    if len(users) > limit:
+        users = users[:limit]
+        return users, encode_search_cursor(sort, descending, users[-1])
+    return users, None
+
+
+# Return the EXPLAIN rows of a statement, e.g. to check which index a search uses
+def explain(sql, args):
+    with router.read_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("EXPLAIN " + sql, args)
+        return cursor.fetchall()
+
+
+# Tables an EXPLAIN reads in full, with the ALL access type
+def full_scans(plan):
+    return [row.get("table") for row in plan if row.get("type") == "ALL"]
+
+
+# Stream users matching user row by row from a server-side cursor, so memory use does not grow with the result.
+# Return an iterator of rows or None if the query fails. The connection is held until the iterator is exhausted or
+# closed
+@timed("mysql")
+def stream_users(user, columns=None):
+    rows = iterate_users(user, columns)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return iter(())
+    except (pymysql.Error, pymysql.Warning) as e:
+        logger.error(e)
+        return None
+    return chain_rows(first, rows)
+
+
+# Unlike itertools.chain, closing it closes rows
+def chain_rows(first, rows):
+    yield first
+    yield from rows
+
+
+def iterate_users(user, columns):
+    sql, args = create_select_statement(user_table_name, user_fields, user, columns)
+    with router.read_connection() as conn:
+        cursor = conn.cursor(pymysql.cursors.SSDictCursor)
+        try:
+            cursor.execute(sql, args)
+            for row in cursor:
+                yield row
+        except GeneratorExit:
+            # The reader stopped early, e.g. the client went away in the middle of an export
+            abandon_unbuffered(conn, cursor)
+            raise
         finally:
-            conn.close()
+            cursor.close()
+
+
+# Close the connection of an unbuffered cursor whose remaining rows are not wanted. Closing the cursor would read
+# every one of them first, while the pool discards a closed connection instead of returning it
+def abandon_unbuffered(conn, cursor):
+    cursor.connection = None
+    try:
+        conn.close()
+    except (pymysql.Error, pymysql.Warning):
+        pass
 
 
 # Endpoint to query users limit and page
+@timed("mysql")
 def query_users_by_page(offset, page):
-    sql = select_by_pagination.format(offset, page*offset)
-    conn = pymysql.connect(**c_info)
-    with conn.cursor() as cursor:
+    sql, args = create_select_statement(user_table_name, user_fields, {"limit": offset, "offset": page})
+    with router.read_connection() as conn, conn.cursor() as cursor:
         try:
-            cursor.execute(sql)
+            cursor.execute(sql, args)
             users = cursor.fetchall()
             return users
         except (pymysql.Error, pymysql.Warning) as e:
             logger.error(e)
             return None
-        finally:
-            conn.close()
 
 
 # Endpoint to query a user by its id
+@timed("mysql")
 def query_user_by_id(id):
-    sql = create_select_by_id_statement(user_table_name, id)
-    conn = pymysql.connect(**c_info)
-    with conn.cursor() as cursor:
+    users = user_cache.get("user_id", id)
+    if users:
+        return users
+    sql, args = create_select_by_id_statement(user_table_name, id)
+    with router.read_connection() as conn, conn.cursor() as cursor:
         try:
-            cursor.execute(sql)
-            return cursor.fetchall()
+            cursor.execute(sql, args)
+            users = cursor.fetchall()
+            if router.cacheable():
+                user_cache.set(users)
+            return users
         except (pymysql.Error, pymysql.Warning) as e:
             logger.error(e)
             return None
-        finally:
-            conn.close()
 
 
-# Create a new user and its password is hashed, return the new user with id if created successfully
-def create_user(user, parameters=None):
+# Build the rows a write produced from the values it sent, columns it did not write are None
+def create_written_user(sql_fields, args, user_id):
+    written_user = dict.fromkeys(user_fields)
+    written_user.update(zip(sql_fields, args))
+    written_user["user_id"] = user_id
+    return [written_user]
+
+
+# Commit unless the connection already runs in autocommit, which pooled connections do by default
+def commit(conn):
+    if not conn.get_autocommit():
+        conn.commit()
+
+
+# Create a new user and its password is hashed, return the new user with id if created successfully.
+# The row is built from the inserted values, pass read_back to select it back inside the same transaction instead
+@timed("mysql")
+def create_user(user, parameters=None, read_back=False):
     if parameters is None:
         parameters = user_fields
-    sql = create_insert_statement(user_table_name, parameters, user)
-    conn = pymysql.connect(**c_info)
-    with conn.cursor() as cursor:
+    sql, args = create_insert_statement(user_table_name, parameters, user)
+    sql_fields = [parameter for parameter in parameters if parameter != "created_date" and parameter in user]
+    sql_fields.append("created_date")
+    with router.write_connection() as conn, conn.cursor() as cursor:
         try:
-            cursor.execute(sql)
-            conn.commit()
+            if read_back:
+                conn.begin()
+            cursor.execute(sql, args)
+            created_user = create_written_user(sql_fields, args, cursor.lastrowid)
+            if read_back:
+                cursor.execute(*create_select_by_id_statement(user_table_name, cursor.lastrowid))
+                created_user = cursor.fetchall()
+                conn.commit()
+            else:
+                commit(conn)
         except (pymysql.Error, pymysql.Warning) as e:
-            logger.error(e)
             conn.rollback()
+            if is_duplicate_key_error(e):
+                raise duplicate_user_error(e)
+            logger.error(e)
             return None
-        finally:
-            conn.close()
-        created_user = query_users({"username": user["username"]})
-        if not created_user:
+    user_cache.invalidate(usernames=[user.get("username")], emails=[user.get("email")])
+    if not created_user:
+        return None
+    if read_back:
+        user_cache.set(created_user)
+    return created_user
+
+
+# Create the user unless one already has its email and return the row holding that email, found in the cache or
+# written and read back on one connection instead of checking, inserting and querying on three.
+# Return None if it fails or another unique key, like a taken username, kept the row out
+@timed("mysql")
+def upsert_user_by_email(user, parameters=None):
+    users = user_cache.get("email", user["email"])
+    if users:
+        return users
+    if parameters is None:
+        parameters = user_fields
+    sql, args = create_insert_ignore_duplicate_statement(user_table_name, parameters, user)
+    with router.write_connection() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute(sql, args)
+            cursor.execute(*create_select_statement(user_table_name, user_fields, {"email": user["email"]}))
+            users = cursor.fetchall()
+            commit(conn)
+        except (pymysql.Error, pymysql.Warning) as e:
+            conn.rollback()
+            logger.error(e)
             return None
-        else:
-            return created_user
+    user_cache.invalidate(usernames=[user.get("username")], emails=[user["email"]])
+    if not users:
+        return None
+    user_cache.set(users)
+    return users
 
 
-# Update a existing user by its id. Hash the password if updated
-def update_users_by_id(user, id):
-    sql = create_update_by_id_statement(user_table_name, user_fields, user, id)
+# Update a existing user by its id. Hash the password if updated.
+# Return the user id with the written values, or the full row selected in the same transaction with read_back
+@timed("mysql")
+def update_users_by_id(user, id, read_back=False):
+    sql, args = create_update_by_id_statement(user_table_name, user_fields, user, id)
     # Nothing to update, return originated user
     if not sql:
         updated_user = query_user_by_id(id)
@@ -191,34 +702,107 @@ def update_users_by_id(user, id):
             return None
         else:
             return updated_user
-    conn = pymysql.connect(**c_info)
-    with conn.cursor() as cursor:
+    with router.write_connection() as conn, conn.cursor() as cursor:
         try:
-            cursor.execute(sql)
-            conn.commit()
+            if read_back:
+                conn.begin()
+            # Without a matching row there is nothing to return
+            if cursor.execute(sql, args) == 0:
+                updated_user = None
+            elif read_back:
+                cursor.execute(*create_select_by_id_statement(user_table_name, id))
+                updated_user = cursor.fetchall()
+            else:
+                updated_user = [dict(zip([field for field in user_fields if field in user], args), user_id=id)]
+            if read_back:
+                conn.commit()
+            else:
+                commit(conn)
         except (pymysql.Error, pymysql.Warning) as e:
+            conn.rollback()
+            if is_duplicate_key_error(e):
+                raise duplicate_user_error(e)
             logger.error(e)
             return None
         finally:
-            conn.close()
-        updated_user = query_user_by_id(id)
-        if not updated_user:
+            # Drop the cached row even if the outcome of the write is unknown
+            user_cache.invalidate(id, usernames=[user.get("username")], emails=[user.get("email")])
+    if not updated_user:
+        return None
+    return updated_user
+
+
+# Replace the stored password hash of a user, e.g. after a rehash on login with more rounds
+@timed("mysql")
+def update_password_hash(id, password_hash):
+    sql = statement_cache.get(("update_password_hash", user_table_name),
+                              lambda: """UPDATE {} SET password = %s WHERE user_id = %s""".format(user_table_name))
+    with router.write_connection() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute(sql, (password_hash, id))
+            commit(conn)
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
             return None
-        else:
-            return updated_user
+        finally:
+            user_cache.invalidate(id)
+    return id
+
+
+# Query the users with the given ids in one query, return them keyed by user_id or None if the query fails
+@timed("mysql")
+def query_users_by_ids(ids, columns=None):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    if columns and "user_id" not in columns:
+        columns = ["user_id"] + list(columns)
+    sql, args = create_select_by_ids_statement(user_table_name, ids, columns)
+    with router.read_connection() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute(sql, args)
+            return {user["user_id"]: user for user in cursor.fetchall()}
+        except (pymysql.Error, pymysql.Warning) as e:
+            logger.error(e)
+            return None
+
+
+# Delete the users with the given ids in one transaction, return the ids that existed and were deleted
+# or None if the deletion fails
+@timed("mysql")
+def delete_users_by_ids(ids):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    with router.write_connection() as conn, conn.cursor() as cursor:
+        try:
+            conn.begin()
+            # Lock the rows so the reported ids are exactly the deleted ones
+            cursor.execute(*create_select_by_ids_statement(user_table_name, ids, ["user_id"], for_update=True))
+            deleted = [row["user_id"] for row in cursor.fetchall()]
+            if deleted:
+                cursor.execute(*create_delete_by_ids_statement(user_table_name, deleted))
+            conn.commit()
+        except (pymysql.Error, pymysql.Warning) as e:
+            conn.rollback()
+            logger.error(e)
+            return None
+        finally:
+            for id in ids:
+                user_cache.invalidate(id)
+    return deleted
 
 
 # Delete a user by its id
+@timed("mysql")
 def delete_users_by_id(id):
-    sql = create_delete_by_id_statement(user_table_name, id)
-    conn = pymysql.connect(**c_info)
-    with conn.cursor() as cursor:
+    sql, args = create_delete_by_id_statement(user_table_name, id)
+    with router.write_connection() as conn, conn.cursor() as cursor:
         try:
-            cursor.execute(sql)
-            conn.commit()
+            cursor.execute(sql, args)
+            commit(conn)
+            user_cache.invalidate(id)
             return id
         except (pymysql.Error, pymysql.Warning) as e:
             logger.error(e)
             return None
-        finally:
-            conn.close()
@@ -0,0 +1,180 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# In-process store with LRU eviction once max_size entries are held
+class LocalBackend:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Return the value stored under key or None if it is missing or expired
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Store shared by several worker processes on the same host through a sqlite file.
+# Stand-in for a networked cache such as memcached or redis, values are pickled.
+class SqliteBackend:
+    def __init__(self, path, max_size=10000):
+        self.path = path
+        self.max_size = max_size
+        self.evictions = 0
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS user_cache (
+                                key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS user_cache_accessed_at ON user_cache (accessed_at)""")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT value, expires_at FROM user_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            conn.execute("DELETE FROM user_cache WHERE key = ? AND expires_at <= ?", (key, now))
+            return None
+        conn.execute("UPDATE user_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO user_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                     (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl, now))
+        count = conn.execute("SELECT COUNT(*) FROM user_cache").fetchone()[0]
+        if count > self.max_size:
+            evicted = conn.execute("""DELETE FROM user_cache WHERE key IN (
+                                          SELECT key FROM user_cache ORDER BY accessed_at LIMIT ?)""",
+                                   (count - self.max_size,)).rowcount
+            self.evictions += evicted
+
+    def delete(self, *keys):
+        if keys:
+            self._connection().execute("DELETE FROM user_cache WHERE key IN ({})".format(", ".join("?" * len(keys))),
+                                       keys)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM user_cache")
+
+
+# Read-through cache of user rows keyed by user_id, username and email.
+# Only found users are cached, so a new user can never be hidden behind a cached miss.
+class UserCache:
+    lookup_fields = ("user_id", "username", "email")
+
+    def __init__(self, backend, ttl=60.0):
+        self.backend = backend
+        self.ttl = ttl
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    # Return a copy of the cached rows for a lookup like ("email", "a@b.com"), None on a miss
+    def get(self, field, value):
+        if not self.enabled:
+            return None
+        rows = self.backend.get(self._key(field, value))
+        with self._lock:
+            if rows is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        return [dict(row) for row in rows]
+
+    # Cache the row of a single user under every lookup field
+    def set(self, rows):
+        if not self.enabled or not rows or len(rows) != 1:
+            return
+        row = rows[0]
+        keys = [self._key(field, row[field]) for field in self.lookup_fields if row.get(field) is not None]
+        for key in keys:
+            self.backend.set(key, rows, self.ttl)
+        if row.get("user_id") is not None:
+            # Remember the aliases so an invalidation by id also drops the username and email entries
+            self.backend.set(self._aliases_key(row["user_id"]), keys, self.ttl)
+
+    # Drop every entry of a user and any username or email that a write could have claimed
+    def invalidate(self, user_id=None, usernames=(), emails=()):
+        keys = [self._key("username", username) for username in usernames if username is not None]
+        keys += [self._key("email", email) for email in emails if email is not None]
+        if user_id is not None:
+            aliases_key = self._aliases_key(user_id)
+            keys += self.backend.get(aliases_key) or []
+            keys += [self._key("user_id", user_id), aliases_key]
+        self.backend.delete(*keys)
+
+    def metrics(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / total if total else 0.0,
+                "evictions": self.backend.evictions,
+            }
+
+    @staticmethod
+    def _key(field, value):
+        return "{}:{}".format(field, value)
+
+    @staticmethod
+    def _aliases_key(user_id):
+        return "aliases:{}".format(user_id)
+
+
+# Build the backend from a setting like "local" or "sqlite:/tmp/user_cache.db"
+def create_backend(setting, max_size):
+    if setting == "local":
+        return LocalBackend(max_size)
+    if setting.startswith("sqlite:"):
+        return SqliteBackend(setting[len("sqlite:"):], max_size)
+    raise ValueError("Unknown user cache backend {}".format(setting))
@@ -1,36 +1,60 @@
-import boto3
-import os
 import json
+from middlewares.sns_publisher import create_publisher
+from middlewares.notification_rules import Rule, RuleTable
+from settings import settings
 
-# Create an SNS client, Must specify region
-sns = boto3.client('sns', region_name='us-east-2')
 
-filters = {
-    "/api/registration": {
-        "method": ["POST"],
-        "status": 201,
-        "topic": os.environ['SNS_ARN']
-    }
-}
+# Create an SNS client, Must specify region. boto3 is only imported here, so startup does not pay for it
+def create_sns_client():
+    import boto3
+    return boto3.client('sns', region_name=settings.sns_region)
+
+
+# Messages are published in batches from a background thread, which builds the client before its first batch
+publisher = create_publisher(None,
+                             create_client=create_sns_client,
+                             max_queue_size=settings.sns_queue_size,
+                             max_retries=settings.sns_max_retries,
+                             dead_letter_path=settings.sns_dead_letter_path)
+
+user_event_fields = ["user_id", "role", "email"]
+filters = [
+    Rule("/api/registration", methods=["POST"], status=201, topics=[settings.sns_arn], fields=user_event_fields),
+]
+# Optional topic for every other change to a user
+if settings.sns_user_events_arn:
+    filters += [
+        Rule("/api/users", methods=["POST"], status=201, topics=[settings.sns_user_events_arn],
+             fields=user_event_fields),
+        Rule("/api/users/<user_id>", methods=["PUT", "DELETE"], status=200, topics=[settings.sns_user_events_arn],
+             fields=user_event_fields),
+    ]
+rule_table = RuleTable(filters)
+
+
+# Pick the event fields from the payload a handler attached to the response, falling back to the path parameters.
+# The serialized body is never parsed again
+def extract_event_data(rule, response, path_params):
+    payload = getattr(response, "payload", None)
+    record = payload.get("data") if isinstance(payload, dict) else None
+    if isinstance(record, list):
+        record = record[0] if record else None
+    if not isinstance(record, dict):
+        record = {}
+    return {field: record[field] if record.get(field) is not None else path_params.get(field)
+            for field in rule.fields}
 
 
 # Notify the sns client if it can pass the filter
 def notify(inputs, response):
-    filter = filters.get(inputs["path"], None)
-    print(response.status_code)
+    matches = rule_table.match(inputs["path"], inputs["method"], response.status_code)
     # Successful request will notify vai sns
-    if filter is not None and response.status_code == filter["status"]:
-        if inputs["method"] in filter["method"]:
-            user = json.loads(response.data.decode("utf-8"))["data"][0]
-            event = {
-                "resource": inputs["path"],
-                "method": inputs["method"],
-                "data": {"user_id": user["user_id"], "role": user["role"], "email": user["email"]}
-            }
-            print(event)
-            message = json.dumps(event, default=str)
-            response = sns.publish(
-                TopicArn=filter["topic"],
-                Message=message,
-            )
-            print(response)
+    for rule, path_params in matches:
+        event = {
+            "resource": inputs["path"],
+            "method": inputs["method"],
+            "data": extract_event_data(rule, response, path_params)
+        }
+        message = json.dumps(event, default=str)
+        for topic in rule.topics:
+            publisher.publish(topic, message)
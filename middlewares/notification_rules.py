@@ -0,0 +1,52 @@
+import re
+from functools import lru_cache
+
+# Route parameters like <id> or <int:id>, written the same way as flask routes
+route_param = re.compile(r"<(?:[a-z]+:)?([A-Za-z_][A-Za-z0-9_]*)>")
+
+
+class Rule:
+    def __init__(self, route, methods, status, topics, fields):
+        self.route = route
+        self.methods = frozenset(method.upper() for method in methods)
+        # A single status or an inclusive (low, high) range
+        self.status = (status, status) if isinstance(status, int) else tuple(status)
+        self.topics = tuple(topics)
+        self.fields = tuple(fields)
+        self.pattern = None
+        if route_param.search(route):
+            parts = route_param.split(route)
+            regex = "".join(re.escape(part) if i % 2 == 0 else "(?P<{}>[^/]+)".format(part)
+                            for i, part in enumerate(parts))
+            self.pattern = re.compile("^{}$".format(regex))
+
+    def accepts(self, status_code):
+        return self.status[0] <= status_code <= self.status[1]
+
+
+# Lookup table of notification rules by method and path.
+# Exact routes are a dict lookup, routes with parameters are regexes tried only for their methods,
+# and the result per (path, method) is memoized so repeated paths cost one cache hit.
+class RuleTable:
+    def __init__(self, rules, cache_size=1024):
+        self._exact = {}
+        self._patterns = {}
+        for rule in rules:
+            for method in rule.methods:
+                if rule.pattern is None:
+                    self._exact.setdefault((rule.route, method), []).append(rule)
+                else:
+                    self._patterns.setdefault(method, []).append(rule)
+        self._match_route = lru_cache(maxsize=cache_size)(self._match_route)
+
+    # Return [(rule, path_params)] of the rules matching a response
+    def match(self, path, method, status_code):
+        return [(rule, params) for rule, params in self._match_route(path, method) if rule.accepts(status_code)]
+
+    def _match_route(self, path, method):
+        matches = [(rule, {}) for rule in self._exact.get((path, method), ())]
+        for rule in self._patterns.get(method, ()):
+            found = rule.pattern.match(path)
+            if found:
+                matches.append((rule, found.groupdict()))
+        return tuple(matches)
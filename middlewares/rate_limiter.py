@@ -0,0 +1,209 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from settings import settings
+
+# Token buckets throttling login attempts per username and per client IP. A bucket holds up to burst tokens and
+# regains per_minute tokens a minute, every attempt takes one and a successful login gives it back, so only failed
+# attempts are throttled. A bucket that has refilled completely carries no information, so it is dropped and the
+# stores only hold keys that attempted recently.
+
+
+# Refill a bucket (tokens, updated_at) up to now and try to take a token.
+# Return the new bucket, the time it will be full again and the seconds to wait for a token (0 when allowed)
+def take_token(bucket, burst, rate, now):
+    tokens, updated_at = bucket if bucket is not None else (burst, now)
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    if tokens >= 1:
+        tokens -= 1
+        retry_after = 0.0
+    else:
+        retry_after = (1 - tokens) / rate
+    return (tokens, now), now + (burst - tokens) / rate, retry_after
+
+
+# Refill a bucket up to now and give back the token of an attempt that succeeded.
+# Return the new bucket and the time it will be full again
+def return_token(bucket, burst, rate, now):
+    tokens, updated_at = bucket
+    tokens = min(burst, tokens + (now - updated_at) * rate + 1)
+    return (tokens, now), now + (burst - tokens) / rate
+
+
+# In-process buckets, the least recently used are evicted once max_size keys are held
+class LocalBucketStore:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.evictions = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._buckets.get(key)
+            bucket, full_at, retry_after = take_token(entry[0] if entry else None, burst, rate, now)
+            self._buckets[key] = (bucket, full_at)
+            self._buckets.move_to_end(key)
+            # The oldest buckets are the first to be full again, drop a few of them on the way
+            for _ in range(2):
+                oldest_key, (_, oldest_full_at) = next(iter(self._buckets.items()))
+                if oldest_full_at > now or oldest_key == key:
+                    break
+                del self._buckets[oldest_key]
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        return retry_after
+
+    def refund(self, key, burst, rate):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._buckets.get(key)
+            if entry is not None:
+                self._buckets[key] = return_token(entry[0], burst, rate, now)
+
+    def size(self):
+        return len(self._buckets)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# Buckets shared by several worker processes on the same host through a sqlite file, see user_cache.SqliteBackend.
+# Each take runs in an immediate transaction so workers never both spend the last token.
+class SqliteBucketStore:
+    def __init__(self, path, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self.evictions = 0
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("""CREATE TABLE IF NOT EXISTS login_buckets (
+                            key TEXT PRIMARY KEY, tokens REAL, updated_at REAL, full_at REAL)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS login_buckets_full_at ON login_buckets (full_at)""")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, burst, rate):
+        # Wall clock time, workers do not share a monotonic clock
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM login_buckets WHERE key = ?", (key,)).fetchone()
+            bucket, full_at, retry_after = take_token(row, burst, rate, now)
+            conn.execute("INSERT OR REPLACE INTO login_buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+                         (key, bucket[0], bucket[1], full_at))
+            if row is None:
+                self._trim(conn, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return retry_after
+
+    def refund(self, key, burst, rate):
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM login_buckets WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                bucket, full_at = return_token(row, burst, rate, now)
+                conn.execute("UPDATE login_buckets SET tokens = ?, updated_at = ?, full_at = ? WHERE key = ?",
+                             (bucket[0], bucket[1], full_at, key))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _trim(self, conn, now):
+        conn.execute("DELETE FROM login_buckets WHERE full_at <= ?", (now,))
+        count = conn.execute("SELECT COUNT(*) FROM login_buckets").fetchone()[0]
+        if count > self.max_size:
+            self.evictions += conn.execute("""DELETE FROM login_buckets WHERE key IN (
+                                                  SELECT key FROM login_buckets ORDER BY full_at LIMIT ?)""",
+                                           (count - self.max_size,)).rowcount
+
+    def size(self):
+        return self._connection().execute("SELECT COUNT(*) FROM login_buckets").fetchone()[0]
+
+    def clear(self):
+        self._connection().execute("DELETE FROM login_buckets")
+
+
+class LoginRateLimiter:
+    # Longest username kept in a key, longer ones cannot exist and only waste memory
+    max_username_length = 128
+
+    def __init__(self, store, user_burst=5, user_per_minute=5, ip_burst=20, ip_per_minute=60):
+        self.store = store
+        # (key prefix, burst, tokens per second), a burst of 0 turns the limit off
+        self.limits = [(prefix, burst, per_minute / 60.0)
+                       for prefix, burst, per_minute in (("ip", ip_burst, ip_per_minute),
+                                                         ("user", user_burst, user_per_minute))
+                       if burst > 0 and per_minute > 0]
+        self.allowed = 0
+        self.rejected = 0
+
+    def key(self, prefix, username, ip):
+        if prefix == "ip":
+            return "ip:{}".format(ip or "unknown")
+        return "user:{}".format(str(username).strip().lower()[:self.max_username_length])
+
+    # Take a token for the client IP and then for the username, return the seconds to wait before
+    # retrying when one of them has none left, 0 when the attempt may go ahead
+    def check(self, username, ip):
+        for prefix, burst, rate in self.limits:
+            retry_after = self.store.take(self.key(prefix, username, ip), burst, rate)
+            if retry_after > 0:
+                self.rejected += 1
+                return retry_after
+        self.allowed += 1
+        return 0.0
+
+    # Give back the tokens check took for an attempt with the right password
+    def succeeded(self, username, ip):
+        for prefix, burst, rate in self.limits:
+            self.store.refund(self.key(prefix, username, ip), burst, rate)
+
+    def metrics(self):
+        return {"allowed": self.allowed, "rejected": self.rejected, "keys": self.store.size(),
+                "evictions": self.store.evictions}
+
+
+# Build the store from a setting like "local" or "sqlite:/tmp/login_rate_limit.db"
+def create_store(setting, max_size):
+    if setting == "local":
+        return LocalBucketStore(max_size)
+    if setting.startswith("sqlite:"):
+        return SqliteBucketStore(setting[len("sqlite:"):], max_size)
+    raise ValueError("Unknown rate limit backend {}".format(setting))
+
+
+# Behind a load balancer the client address is only known when TRUSTED_PROXIES says how many proxies there are,
+# otherwise every client would share the bucket of the proxy address. The IP limit is then off unless set explicitly
+def default_ip_burst(ip_burst, trusted_proxies):
+    if ip_burst is not None:
+        return ip_burst
+    return 20 if trusted_proxies else 0
+
+
+login_limiter = LoginRateLimiter(create_store(settings.login_rate_limit_backend, settings.login_rate_limit_max_keys),
+                                 user_burst=settings.login_rate_limit_user_burst,
+                                 user_per_minute=settings.login_rate_limit_user_per_minute,
+                                 ip_burst=default_ip_burst(settings.login_rate_limit_ip_burst,
+                                                           settings.trusted_proxies),
+                                 ip_per_minute=settings.login_rate_limit_ip_per_minute)
@@ -1,35 +1,114 @@
 import jwt
-import os
+import re
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import lru_cache
+import tools.instrumentation as instrumentation
+from settings import settings
 
 
 white_list = {"/api/login", "/api/registration", "/api/g_login", "/api/g_authorize"}
+# Roles allowed per path prefix and method, checked in order. Everything else needs the support role.
+# To enable user registration, the permission of update opens to any role.
+role_rules = [
+    (re.compile(r"/api/users"), {"PUT"}, frozenset({"support", "ip"})),
+]
+default_roles = frozenset({"support"})
 
-jwt_secret = os.environ['JWT_SECRET']
-jwt_algo = os.environ['JWT_ALGO']
-jwt_exp_delta_sec = float(os.environ['JWT_EXP'])
+jwt_secret = settings.jwt_secret
+jwt_algo = settings.jwt_algo
+jwt_exp_delta_sec = settings.jwt_exp
+jwt_cache_size = settings.jwt_cache_size
 
+# Payloads of already verified tokens keyed by the token digest, in LRU order
+verified_tokens = OrderedDict()
+verified_tokens_lock = threading.Lock()
+metrics = {
+    "authorizations": 0,
+    "verifications": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "authorize_time_total": 0.0,
+}
 
-# Authorize the request to check if the token in header corresponds to the one of roles
+
+# Return the roles allowed to call a path with a method
+@lru_cache(maxsize=1024)
+def roles_for(path, method):
+    for prefix, methods, roles in role_rules:
+        if method in methods and prefix.match(path):
+            return roles
+    return default_roles
+
+
+def authorizer_metrics():
+    with verified_tokens_lock:
+        res = dict(metrics)
+        res["cache_size"] = len(verified_tokens)
+    lookups = res["cache_hits"] + res["cache_misses"]
+    res["cache_hit_ratio"] = res["cache_hits"] / lookups if lookups else 0.0
+    res["authorize_time_avg"] = res["authorize_time_total"] / res["authorizations"] if res["authorizations"] else 0.0
+    return res
+
+
+# Decode a token, reusing the payload of a token verified before until it expires
+def decode_token(jwt_token):
+    digest = hashlib.sha256(jwt_token.encode("utf-8")).digest()
+    now = time.time()
+    with verified_tokens_lock:
+        cached = verified_tokens.get(digest)
+        if cached is not None and (cached[1] is None or cached[1] > now):
+            verified_tokens.move_to_end(digest)
+            metrics["cache_hits"] += 1
+            return cached[0]
+        if cached is not None:
+            del verified_tokens[digest]
+        metrics["cache_misses"] += 1
+        metrics["verifications"] += 1
+    with instrumentation.timer("jwt", "decode"):
+        payload = jwt.decode(jwt_token, jwt_secret, algorithms=[jwt_algo])
+    exp = payload.get("exp")
+    with verified_tokens_lock:
+        verified_tokens[digest] = (payload, float(exp) if exp is not None else None)
+        while len(verified_tokens) > jwt_cache_size:
+            verified_tokens.popitem(last=False)
+    return payload
+
+
+# Authorize the request to check if the token in header corresponds to the one of roles.
+# Without roles, the roles from role_rules for the path and method are used
 # For while_list path, return none
 # For error, return error message and status code in an array
 # For success, return payload which is a map like {"user_id": "123", "role": "ip", "email": "dada@dad.com"}
 # and 200 status code
-def authorize(inputs, roles):
+def authorize(inputs, roles=None):
     if inputs["path"] in white_list:
         return None
+    start = time.perf_counter()
+    try:
+        return check_token(inputs, roles)
+    finally:
+        elapsed = time.perf_counter() - start
+        with verified_tokens_lock:
+            metrics["authorizations"] += 1
+            metrics["authorize_time_total"] += elapsed
+
+
+def check_token(inputs, roles):
     header = inputs["headers"]
-    print(header)
     if "Authorization" not in header:
         return ["Not authenticated", 400]
     jwt_token = header["Authorization"]
     # For bearer token, remove the bearer part
     if jwt_token.startswith("Bearer "):
         jwt_token = jwt_token[7:]
+    if roles is None:
+        roles = roles_for(inputs["path"], inputs["method"])
     try:
-        payload = jwt.decode(jwt_token, jwt_secret,
-                             algorithms=[jwt_algo])
-        print(payload)
+        payload = decode_token(jwt_token)
         if payload["role"] not in roles:
             return ["Permission Denied", 403]
     except (jwt.DecodeError, jwt.ExpiredSignatureError):
@@ -45,4 +124,5 @@ def create_token(user):
         "email": user["email"],
         "exp": datetime.utcnow() + timedelta(seconds=jwt_exp_delta_sec)
     }
-    return jwt.encode(payload, jwt_secret, jwt_algo).decode('utf-8')
\ No newline at end of file
+    with instrumentation.timer("jwt", "encode"):
+        return jwt.encode(payload, jwt_secret, jwt_algo).decode('utf-8')
\ No newline at end of file
@@ -0,0 +1,212 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from tools.instrumentation import timed
+
+logger = logging.getLogger()
+
+# Limits of an SNS PublishBatch call
+max_batch_entries = 10
+max_batch_bytes = 256 * 1024
+
+_stop = object()
+
+
+# botocore is imported when a publish fails rather than at startup
+def client_errors():
+    from botocore.exceptions import BotoCoreError, ClientError
+    return BotoCoreError, ClientError
+
+
+# Publish SNS messages from a bounded in-memory queue on a background thread so requests never wait on AWS.
+# Messages are grouped per topic into PublishBatch calls, retried with exponential backoff and appended to a dead
+# letter file as json lines once retries are exhausted. Clients older than botocore 1.23 have no PublishBatch, their
+# messages are published one by one and a warning is logged.
+# Without a client, create_client builds one on the worker thread before the first batch is sent.
+class SnsPublisher:
+    def __init__(self, client, max_queue_size=10000, max_retries=3, backoff=0.2, dead_letter_path="sns_dead_letter.ndjson",
+                 create_client=None):
+        self.client = client
+        self.create_client = create_client
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.dead_letter_path = dead_letter_path
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = None
+        self._warned_single_publish = False
+        self._lock = threading.Lock()
+        self._metrics = {
+            "enqueued": 0,
+            "published": 0,
+            "dropped": 0,
+            "retries": 0,
+            "dead_lettered": 0,
+            "batches": 0,
+            "publish_latency_total": 0.0,
+            "publish_latency_max": 0.0,
+        }
+
+    # Queue a message for topic, return False if it was dropped because the queue is full
+    def publish(self, topic, message):
+        self._start()
+        try:
+            self._queue.put_nowait((topic, message))
+        except queue.Full:
+            self._count("dropped")
+            logger.error("SNS queue is full, drop message for {}".format(topic))
+            return False
+        self._count("enqueued")
+        return True
+
+    # Wait until every queued message has been published or dead lettered
+    def flush(self):
+        if self._thread is not None:
+            self._queue.join()
+
+    # Drain the queue and stop the worker, waiting at most timeout seconds
+    def close(self, timeout=10.0):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._queue.put(_stop)
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.error("SNS publisher did not drain within {}s".format(timeout))
+
+    # Build the client now instead of on the first batch
+    def warm(self):
+        return self._get_client()
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["queue_depth"] = self._queue.qsize()
+        return metrics
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sns-publisher", daemon=True)
+                self._thread.start()
+
+    def _get_client(self):
+        if self.client is None:
+            with self._lock:
+                if self.client is None:
+                    self.client = self.create_client()
+        return self.client
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._metrics[name] += value
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            items = [item]
+            # Take whatever else is already waiting, without blocking, to fill the batches
+            while item is not _stop and len(items) < max_batch_entries * 10:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                items.append(item)
+            messages = [item for item in items if item is not _stop]
+            try:
+                by_topic = {}
+                for topic, message in messages:
+                    by_topic.setdefault(topic, []).append(message)
+                for topic, topic_messages in by_topic.items():
+                    for batch in self._batches(topic_messages):
+                        self._publish_with_retry(topic, batch)
+            except Exception as e:
+                logger.error("SNS publisher failed: {}".format(e))
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if len(messages) != len(items):
+                return
+
+    # Split messages into batches within the entry count and payload size limits of PublishBatch
+    @staticmethod
+    def _batches(messages):
+        batch, size = [], 0
+        for message in messages:
+            message_size = len(message.encode("utf-8"))
+            if batch and (len(batch) == max_batch_entries or size + message_size > max_batch_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append(message)
+            size += message_size
+        if batch:
+            yield batch
+
+    def _publish_with_retry(self, topic, messages):
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self._count("retries", len(messages))
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+            start = time.perf_counter()
+            try:
+                messages, error = self._send(topic, messages)
+            except client_errors() as e:
+                error = str(e)
+            finally:
+                latency = time.perf_counter() - start
+                with self._lock:
+                    self._metrics["batches"] += 1
+                    self._metrics["publish_latency_total"] += latency
+                    self._metrics["publish_latency_max"] = max(self._metrics["publish_latency_max"], latency)
+            if not messages:
+                return
+        self._dead_letter(topic, messages, error)
+
+    # Send one batch and return the messages that failed with the last error
+    @timed("sns", "publish")
+    def _send(self, topic, messages):
+        client = self._get_client()
+        if not hasattr(client, "publish_batch"):
+            if not self._warned_single_publish:
+                self._warned_single_publish = True
+                logger.warning("SNS client has no publish_batch, messages are published one by one")
+            for i, message in enumerate(messages):
+                try:
+                    client.publish(TopicArn=topic, Message=message)
+                except client_errors() as e:
+                    return messages[i:], str(e)
+                self._count("published")
+            return [], None
+        entries = [{"Id": str(i), "Message": message} for i, message in enumerate(messages)]
+        response = client.publish_batch(TopicArn=topic, PublishBatchRequestEntries=entries)
+        failed = response.get("Failed", [])
+        self._count("published", len(messages) - len(failed))
+        if not failed:
+            return [], None
+        return [messages[int(entry["Id"])] for entry in failed], failed[0].get("Message", failed[0].get("Code"))
+
+    def _dead_letter(self, topic, messages, error):
+        self._count("dead_lettered", len(messages))
+        logger.error("Failed to publish {} SNS messages to {}: {}".format(len(messages), topic, error))
+        try:
+            with open(self.dead_letter_path, "a") as f:
+                for message in messages:
+                    f.write(json.dumps({"topic": topic, "message": message, "error": error,
+                                        "time": datetime.utcnow().isoformat()}) + "\n")
+        except OSError as e:
+            logger.error("Failed to write SNS dead letter file: {}".format(e))
+
+
+# Build a publisher that drains its queue when the process exits
+def create_publisher(client, **kwargs):
+    publisher = SnsPublisher(client, **kwargs)
+    atexit.register(publisher.close)
+    return publisher
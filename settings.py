@@ -0,0 +1,199 @@
+import base64
+import binascii
+import os
+
+# Every setting of the service, read from the environment once and validated together. Values that do not parse
+# fail at import with the full list of problems. Missing required values only fail when one of them is read, with the
+# list of every missing one, so tools using a part of the service need only the settings of that part.
+
+
+class SettingsError(Exception):
+    def __init__(self, problems):
+        super().__init__("Invalid settings: " + "; ".join(problems))
+        self.problems = problems
+
+
+def integer(minimum=None):
+    def parse(value):
+        number = int(value)
+        if minimum is not None and number < minimum:
+            raise ValueError("should be at least {}".format(minimum))
+        return number
+    return parse
+
+
+def number(minimum=None, maximum=None):
+    def parse(value):
+        parsed = float(value)
+        if minimum is not None and parsed < minimum:
+            raise ValueError("should be at least {}".format(minimum))
+        if maximum is not None and parsed > maximum:
+            raise ValueError("should be at most {}".format(maximum))
+        return parsed
+    return parse
+
+
+def boolean(value):
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError("should be true or false")
+
+
+def one_of(*choices):
+    def parse(value):
+        if value.upper() not in choices:
+            raise ValueError("should be one of {}".format(", ".join(choices)))
+        return value.upper()
+    return parse
+
+
+def store(value):
+    if value != "local" and not value.startswith("sqlite:"):
+        raise ValueError("should be local or sqlite:<path>")
+    return value
+
+
+def numbers(value):
+    bounds = tuple(float(bound) for bound in value.split(","))
+    if list(bounds) != sorted(bounds):
+        raise ValueError("should be increasing")
+    return bounds
+
+
+# Comma separated host or host:port, the port is None when left out
+def hosts(value):
+    parsed = []
+    for address in value.split(","):
+        host, _, port = address.strip().partition(":")
+        if not host:
+            raise ValueError("should be host or host:port, comma separated")
+        parsed.append((host, integer(1)(port) if port else None))
+    return tuple(parsed)
+
+
+# A Fernet key is 32 url-safe base64 encoded bytes
+def fernet_key(value):
+    try:
+        if len(base64.urlsafe_b64decode(value.encode("utf-8"))) != 32:
+            raise ValueError
+    except (ValueError, binascii.Error):
+        raise ValueError("should be a Fernet key") from None
+    return value.encode("utf-8")
+
+
+required = object()
+
+# (attribute, environment variable, parser, default)
+fields = [
+    ("catalog_url", "CATALOG_URL", str, required),
+    ("token_secret", "TOKEN_SECRET", fernet_key, required),
+    # Signs the session cookie, every worker needs the same one to read the sessions of the others
+    ("session_secret", "SESSION_SECRET", str, required),
+    ("oauth2_client_id", "OAUTH2_CLIENT_ID", str, required),
+    ("oauth2_client_secret", "OAUTH2_CLIENT_SECRET", str, required),
+    ("google_keys_ttl", "GOOGLE_KEYS_TTL", number(0), 3600.0),
+    ("default_page_size", "DEFAULT_PAGE_SIZE", integer(1), 20),
+    ("max_page_size", "MAX_PAGE_SIZE", integer(1), 1000),
+    ("max_batch_ids", "MAX_BATCH_IDS", integer(1), 100),
+    ("trusted_proxies", "TRUSTED_PROXIES", integer(0), 0),
+    ("warm_clients", "WARM_CLIENTS", boolean, False),
+
+    ("db_host", "USER_SERVICE_HOST", str, required),
+    ("db_user", "USER_SERVICE_USER", str, required),
+    ("db_password", "USER_SERVICE_PASSWORD", str, required),
+    ("db_port", "USER_SERVICE_PORT", integer(1), required),
+    ("pool_min_size", "USER_SERVICE_POOL_MIN_SIZE", integer(0), 1),
+    ("pool_max_size", "USER_SERVICE_POOL_MAX_SIZE", integer(1), 10),
+    ("pool_timeout", "USER_SERVICE_POOL_TIMEOUT", number(0), 5.0),
+    ("pool_idle_timeout", "USER_SERVICE_POOL_IDLE_TIMEOUT", number(0), 300.0),
+    ("statement_cache_size", "USER_SERVICE_STATEMENT_CACHE_SIZE", integer(1), 256),
+    ("rely_on_unique_index", "USER_SERVICE_RELY_ON_UNIQUE_INDEX", boolean, False),
+    # Read replicas, they use the user and password of the primary and its port unless given
+    ("db_replicas", "USER_SERVICE_REPLICAS", hosts, ()),
+    ("replica_max_lag", "USER_SERVICE_REPLICA_MAX_LAG", number(0), 5.0),
+    ("replica_sticky_seconds", "USER_SERVICE_REPLICA_STICKY_SECONDS", number(0), 5.0),
+    ("replica_lag_check_interval", "USER_SERVICE_REPLICA_LAG_CHECK_INTERVAL", number(0), 1.0),
+    ("replica_retry_interval", "USER_SERVICE_REPLICA_RETRY_INTERVAL", number(0), 10.0),
+    ("replica_status_statement", "USER_SERVICE_REPLICA_STATUS_STATEMENT", str, "SHOW SLAVE STATUS"),
+    ("user_cache_backend", "USER_CACHE_BACKEND", store, "local"),
+    ("user_cache_max_size", "USER_CACHE_MAX_SIZE", integer(1), 10000),
+    ("user_cache_ttl", "USER_CACHE_TTL", number(0), 60.0),
+
+    ("jwt_secret", "JWT_SECRET", str, required),
+    ("jwt_algo", "JWT_ALGO", str, required),
+    ("jwt_exp", "JWT_EXP", number(1), required),
+    ("jwt_cache_size", "JWT_CACHE_SIZE", integer(0), 1024),
+    ("login_rate_limit_backend", "LOGIN_RATE_LIMIT_BACKEND", store, "local"),
+    ("login_rate_limit_max_keys", "LOGIN_RATE_LIMIT_MAX_KEYS", integer(1), 100000),
+    ("login_rate_limit_user_burst", "LOGIN_RATE_LIMIT_USER_BURST", integer(0), 5),
+    ("login_rate_limit_user_per_minute", "LOGIN_RATE_LIMIT_USER_PER_MINUTE", number(0), 5.0),
+    # 20 when TRUSTED_PROXIES is set and 0 (off) otherwise, see rate_limiter.default_ip_burst
+    ("login_rate_limit_ip_burst", "LOGIN_RATE_LIMIT_IP_BURST", integer(0), None),
+    ("login_rate_limit_ip_per_minute", "LOGIN_RATE_LIMIT_IP_PER_MINUTE", number(0), 60.0),
+
+    ("sns_arn", "SNS_ARN", str, required),
+    ("sns_user_events_arn", "SNS_USER_EVENTS_ARN", str, None),
+    ("sns_region", "SNS_REGION", str, "us-east-2"),
+    ("sns_queue_size", "SNS_QUEUE_SIZE", integer(1), 10000),
+    ("sns_max_retries", "SNS_MAX_RETRIES", integer(0), 3),
+    ("sns_dead_letter_path", "SNS_DEAD_LETTER_PATH", str, "sns_dead_letter.ndjson"),
+
+    ("smarty_auth_id", "SMARTY_AUTH_ID", str, required),
+    ("smarty_auth_token", "SMARTY_AUTH_TOKEN", str, required),
+    ("address_cache_ttl", "ADDRESS_CACHE_TTL", number(0), 86400.0),
+    ("address_cache_negative_ttl", "ADDRESS_CACHE_NEGATIVE_TTL", number(0), 3600.0),
+    ("address_cache_max_size", "ADDRESS_CACHE_MAX_SIZE", integer(1), 10000),
+
+    # None keeps the passlib default rounds
+    ("password_hash_pool_size", "PASSWORD_HASH_POOL_SIZE", integer(0), 0),
+    ("password_hash_rounds", "PASSWORD_HASH_ROUNDS", integer(1000), None),
+    ("bulk_import_chunk_size", "BULK_IMPORT_CHUNK_SIZE", integer(1), 500),
+
+    ("response_compression", "RESPONSE_COMPRESSION", boolean, True),
+    ("response_compression_min_size", "RESPONSE_COMPRESSION_MIN_SIZE", integer(0), 1024),
+
+    ("log_level", "LOG_LEVEL", one_of("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"), "INFO"),
+    ("request_log_sample_rate", "REQUEST_LOG_SAMPLE_RATE", number(0, 1), 1.0),
+    ("metrics_enabled", "METRICS_ENABLED", boolean, True),
+    ("metrics_buckets", "METRICS_BUCKETS", numbers, (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                                                     2.5, 5.0, 10.0)),
+    ("profile_sample_rate", "PROFILE_SAMPLE_RATE", number(0, 1), 0.0),
+    ("profile_slow_ms", "PROFILE_SLOW_MS", number(0), 500.0),
+    ("profile_dir", "PROFILE_DIR", str, "profiles"),
+]
+
+
+class Settings:
+    def __init__(self, environ=None):
+        environ = os.environ if environ is None else environ
+        problems = []
+        self.missing = {}
+        for attribute, variable, parse, default in fields:
+            value = environ.get(variable)
+            if value is None or value == "":
+                if default is required:
+                    self.missing[attribute] = variable
+                else:
+                    setattr(self, attribute, default)
+                continue
+            try:
+                setattr(self, attribute, parse(value))
+            except ValueError as e:
+                problems.append("{}: {}".format(variable, e or "invalid value"))
+        if problems:
+            raise SettingsError(problems)
+
+    # Only reached for the attributes that were not set, the missing required ones
+    def __getattr__(self, attribute):
+        if attribute in self.__dict__.get("missing", {}):
+            self.require_all()
+        raise AttributeError(attribute)
+
+    def require_all(self):
+        if self.missing:
+            raise SettingsError(["{}: required".format(variable) for variable in self.missing.values()])
+
+
+settings = Settings()
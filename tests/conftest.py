@@ -0,0 +1,36 @@
+import pytest
+from benchmarks import stand_ins
+
+# settings reads the environment when first imported, so the stand-in values are set before any test module imports
+# the application
+stand_ins.set_default_environment()
+
+
+# The Flask application against fresh stand-ins, see stand_ins.install
+@pytest.fixture
+def server():
+    import application
+    return stand_ins.install(application)
+
+
+@pytest.fixture
+def client(server):
+    import application
+    return application.app.test_client()
+
+
+# Rows for user_access.create_users, n users named user0, user1, ... with password "password"
+def user_rows(n, **fields):
+    from tools import password_hashing
+    password_hash = password_hashing.hash_password("password")
+    return [dict({"username": "user{}".format(i), "password": password_hash, "email": "user{}@example.com".format(i),
+                  "phone": "2125550100", "slack_id": "U{}".format(i), "role": "ip", "status": "active",
+                  "address": "1 Main St"}, **fields) for i in range(n)]
+
+
+# Bearer token of a support user, allowed on every endpoint
+@pytest.fixture
+def support_headers(server):
+    import middlewares.security as security
+    return {"Authorization": "Bearer " + security.create_token({"user_id": 0, "role": "support",
+                                                                  "email": "support@example.com"})}
@@ -0,0 +1,104 @@
+import threading
+import time
+import pytest
+from smartystreets_python_sdk.exceptions import SmartyException
+from benchmarks.stand_ins import StubSmartyClient
+from database_access.user_cache import LocalBackend
+from tools import address_verification
+
+
+# The stand-in SmartyStreets client, counting the lookups it answers. Lookups wait for release when gated and raise
+# while failures are left
+class CountingSmartyClient(StubSmartyClient):
+    def __init__(self, gate=False, failures=0):
+        super().__init__()
+        self.lookups = []
+        self.batches = []
+        self.failures = failures
+        self.release = threading.Event()
+        if not gate:
+            self.release.set()
+
+    def send_lookup(self, lookup):
+        self.release.wait(5)
+        self.lookups.append(lookup.street)
+        if self.failures:
+            self.failures -= 1
+            raise SmartyException("Service unavailable")
+        super().send_lookup(lookup)
+
+    def send_batch(self, batch):
+        self.batches.append([lookup.street for lookup in batch])
+        super().send_batch(batch)
+
+
+@pytest.fixture
+def smarty(monkeypatch):
+    client = CountingSmartyClient()
+    monkeypatch.setattr(address_verification, "client", client)
+    monkeypatch.setattr(address_verification, "cache", LocalBackend(100))
+    monkeypatch.setattr(address_verification, "metrics", dict.fromkeys(address_verification.metrics, 0))
+    return client
+
+
+def test_results_are_cached_by_normalized_address(smarty):
+    assert address_verification.verify("1 Main St, New York NY")
+    assert address_verification.verify("  1 main st ,new york   ny ")
+    assert smarty.lookups == ["1 Main St"]
+    assert address_verification.metrics["cache_hits"] == 1
+
+
+def test_invalid_addresses_are_cached_for_the_negative_ttl(smarty, monkeypatch):
+    monkeypatch.setattr(address_verification, "negative_cache_ttl", 0.05)
+    assert not address_verification.verify("1 Invalid St, New York NY")
+    assert not address_verification.verify("1 Invalid St, New York NY")
+    assert len(smarty.lookups) == 1
+    time.sleep(0.1)
+    assert not address_verification.verify("1 Invalid St, New York NY")
+    assert len(smarty.lookups) == 2
+
+
+def test_valid_addresses_expire_after_the_ttl(smarty, monkeypatch):
+    monkeypatch.setattr(address_verification, "cache_ttl", 0.05)
+    assert address_verification.verify("1 Main St, New York NY")
+    time.sleep(0.1)
+    assert address_verification.verify("1 Main St, New York NY")
+    assert len(smarty.lookups) == 2
+
+
+def test_lookup_errors_are_not_cached(smarty):
+    smarty.failures = 1
+    assert not address_verification.verify("1 Main St, New York NY")
+    assert address_verification.verify("1 Main St, New York NY")
+    assert len(smarty.lookups) == 2 and address_verification.metrics["errors"] == 1
+
+
+def test_malformed_addresses_are_rejected_without_a_lookup(smarty):
+    assert not address_verification.verify("no comma here")
+    assert smarty.lookups == []
+
+
+def test_concurrent_lookups_of_one_address_are_coalesced(smarty):
+    smarty.release.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(address_verification.verify("1 Main St, New York NY")))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while address_verification.metrics["coalesced"] < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    smarty.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [True] * 5
+    assert smarty.lookups == ["1 Main St"]
+    assert address_verification.metrics["coalesced"] == 4
+
+
+def test_verify_many_batches_only_unknown_addresses(smarty):
+    address_verification.verify("1 Main St, New York NY")
+    addresses = ["1 Main St, New York NY", "2 Main St, New York NY", "2 main st, new york ny",
+                 "3 Invalid St, New York NY", "bad"]
+    assert address_verification.verify_many(addresses) == [True, True, True, False, False]
+    assert smarty.batches == [["2 Main St", "3 Invalid St"]]
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import subprocess
+import sys
+import pytest
+import database_access.async_user_access as async_user_access
+import database_access.user_access as user_access
+from database_access.replica_routing import ReplicaRouter
+
+
+def test_asgi_entry_point_does_not_build_the_flask_application():
+    code = "import sys, asgi_application; print('application' in sys.modules, 'flask' in sys.modules)"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, env=dict(os.environ, PYTHONPATH=root),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.split() == ["False", "False"]
+
+
+class FakePool:
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+# Each event loop, like one per hypercorn worker or per test, gets a pool and a lock of its own
+def test_pool_is_created_once_per_event_loop(monkeypatch):
+    created = []
+
+    async def create_pool(c_info):
+        await asyncio.sleep(0.01)
+        created.append(FakePool())
+        return created[-1]
+    monkeypatch.setattr(async_user_access, "create_pool", create_pool)
+
+    async def concurrent_checkouts():
+        pools = await asyncio.gather(*[async_user_access.get_pool() for _ in range(3)])
+        await async_user_access.close_pool()
+        return pools
+
+    for loop_count in (1, 2):
+        pools = asyncio.run(concurrent_checkouts())
+        assert len(created) == loop_count and all(pool is created[-1] for pool in pools)
+
+
+# An aiomysql pool holding size of its maxsize connections, free of them idle, whose acquire never gets one when it
+# hangs
+class FakeAcquirePool:
+    def __init__(self, connection=None, size=1, maxsize=1, free=1, hangs=False):
+        self.connection = connection
+        self.size = size
+        self.maxsize = maxsize
+        self.freesize = free
+        self.hangs = hangs
+
+    def acquire(self):
+        return FakeAcquireContext(self)
+
+
+class FakeAcquireContext:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        if self.pool.hangs:
+            await asyncio.Event().wait()
+        return self.pool.connection
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def read_with(monkeypatch, replica_pool):
+    router = ReplicaRouter(user_access.pool, {"replica": None})
+    monkeypatch.setattr(user_access, "router", router)
+    monkeypatch.setattr(user_access.pool, "timeout", 0.01)
+
+    async def get_replica_pool(name):
+        return replica_pool
+
+    async def get_pool():
+        return FakeAcquirePool("primary")
+    monkeypatch.setattr(async_user_access, "get_replica_pool", get_replica_pool)
+    monkeypatch.setattr(async_user_access, "get_pool", get_pool)
+
+    async def read():
+        router.start_request()
+        async with async_user_access.read_connection() as conn:
+            return conn
+    return asyncio.run(read()), router.metrics()
+
+
+# A saturated replica times out like the sync pool does, the read goes to the primary and the replica stays up
+def test_a_busy_replica_is_skipped_without_marking_it_down(monkeypatch):
+    conn, metrics = read_with(monkeypatch, FakeAcquirePool(size=1, free=0, hangs=True))
+    assert conn == "primary"
+    assert metrics["busy"] == 1 and metrics["failures"] == 0
+
+
+# A pool with room for a connection times out opening it, as on an unreachable replica
+@pytest.mark.parametrize("size,free", [(0, 0), (1, 0)])
+def test_a_replica_timing_out_on_connect_is_marked_down(monkeypatch, size, free):
+    conn, metrics = read_with(monkeypatch, FakeAcquirePool(size=size, maxsize=2, free=free, hangs=True))
+    assert conn == "primary"
+    assert metrics["busy"] == 0 and metrics["failures"] == 1
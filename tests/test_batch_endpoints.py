@@ -0,0 +1,80 @@
+import database_access.user_access as user_access
+from settings import settings
+from tests.conftest import user_rows
+
+
+def create_users(n):
+    user_access.create_users(user_rows(n))
+
+
+def test_batch_lookup_follows_the_order_of_ids(server, client, support_headers):
+    create_users(4)
+    response = client.post("/api/users/batch_lookup", json={"ids": [3, 99, 1, 3]}, headers=support_headers)
+    assert response.status_code == 200
+    data = response.get_json()["data"]
+    assert [user.get("username") for user in data] == ["user2", None, "user0", "user2"]
+    assert data[1] == {"user_id": 99, "missing": True}
+
+
+def test_batch_lookup_selects_fields(server, client, support_headers):
+    create_users(2)
+    response = client.post("/api/users/batch_lookup?fields=username", json={"ids": [2, 5]}, headers=support_headers)
+    assert response.get_json()["data"] == [{"user_id": 2, "username": "user1"}, {"user_id": 5, "missing": True}]
+
+
+def test_ids_in_the_query_string_are_looked_up_the_same_way(server, client, support_headers):
+    create_users(2)
+    response = client.get("/api/users?ids=2,7,1&fields=username", headers=support_headers)
+    assert response.get_json()["data"] == [{"user_id": 2, "username": "user1"}, {"user_id": 7, "missing": True},
+                                           {"user_id": 1, "username": "user0"}]
+
+
+def test_batches_are_limited_to_max_batch_ids(server, client, support_headers):
+    ids = list(range(1, settings.max_batch_ids + 1))
+    for path in ("/api/users/batch_lookup", "/api/users/batch_delete"):
+        assert client.post(path, json={"ids": ids}, headers=support_headers).status_code == 200
+        response = client.post(path, json={"ids": ids + [settings.max_batch_ids + 1]}, headers=support_headers)
+        assert response.status_code == 400
+        assert response.get_json()["message"] == \
+            "ids should be a list of at most {} user ids".format(settings.max_batch_ids)
+
+
+def test_invalid_ids_are_rejected(server, client, support_headers):
+    for body in ({"ids": []}, {"ids": ["a"]}, {"ids": [0]}, {"ids": "1,2"}, {}, [1, 2]):
+        for path in ("/api/users/batch_lookup", "/api/users/batch_delete"):
+            assert client.post(path, json=body, headers=support_headers).status_code == 400
+
+
+def test_batch_delete_reports_each_id_and_keeps_the_others(server, client, support_headers):
+    create_users(4)
+    response = client.post("/api/users/batch_delete", json={"ids": [2, 99, 4]}, headers=support_headers)
+    assert response.status_code == 200
+    assert response.get_json()["data"] == [{"user_id": 2, "deleted": True}, {"user_id": 99, "deleted": False},
+                                           {"user_id": 4, "deleted": True}]
+    assert [row[0] for row in server.db.execute("SELECT user_id FROM signals.users ORDER BY user_id")] == [1, 3]
+
+
+def test_batch_delete_invalidates_the_cached_users(server, client, support_headers):
+    create_users(3)
+    assert client.get("/api/users/2", headers=support_headers).get_json()["data"][0]["username"] == "user1"
+    assert client.get("/api/users?username=user1", headers=support_headers).get_json()["data"]
+    assert user_access.user_cache.get("user_id", 2) is not None
+    assert user_access.user_cache.get("username", "user1") is not None
+
+    client.post("/api/users/batch_delete", json={"ids": [2]}, headers=support_headers)
+
+    assert user_access.user_cache.get("user_id", 2) is None
+    assert user_access.user_cache.get("username", "user1") is None
+    assert client.get("/api/users/2", headers=support_headers).get_json()["data"] == []
+    assert client.get("/api/users?username=user1", headers=support_headers).get_json()["data"] == []
+    response = client.post("/api/users/batch_lookup", json={"ids": [2]}, headers=support_headers)
+    assert response.get_json()["data"] == [{"user_id": 2, "missing": True}]
+
+
+def test_a_failed_batch_delete_deletes_nothing(server, client, support_headers, monkeypatch):
+    create_users(2)
+    monkeypatch.setattr(user_access, "create_delete_by_ids_statement",
+                        lambda table_name, ids: ("DELETE FROM missing_table", ()))
+    response = client.post("/api/users/batch_delete", json={"ids": [1, 2]}, headers=support_headers)
+    assert response.status_code == 500
+    assert server.db.execute("SELECT COUNT(*) FROM signals.users").fetchone()[0] == 2
@@ -0,0 +1,70 @@
+import json
+from database_access.connection_pool import PoolTimeoutError
+import database_access.user_access as user_access
+from tools import bulk_import
+
+
+def record(i, **fields):
+    return dict({"username": "bulk{}".format(i), "password": "password", "email": "bulk{}@example.com".format(i),
+                 "phone": "2125550100", "slack_id": "U{}".format(i), "role": "ip", "status": "pending",
+                 "address": "{} Main St, New York NY".format(i)}, **fields)
+
+
+def post_ndjson(client, headers, records):
+    body = "".join(json.dumps(item) + "\n" for item in records)
+    response = client.post("/api/users/bulk", data=body, content_type="application/x-ndjson", headers=headers)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_malformed_fields_fail_their_row_only(client, support_headers):
+    results = post_ndjson(client, support_headers, [
+        record(0), record(1, username=["x"]), record(2, password=123), record(3, email=""), record(4)])
+
+    assert [(result["line"], result["status"], result.get("message")) for result in results[:-1]] == [
+        (1, "created", None), (2, "error", "Invalid data"), (3, "error", "Invalid data"),
+        (4, "error", "Invalid data"), (5, "created", None)]
+    assert results[-1] == {"summary": {"created": 2, "failed": 3}}
+    assert [user["username"] for user in user_access.query_users({}, ["username"])] == ["bulk0", "bulk4"]
+
+
+def test_a_failing_chunk_is_reported_and_the_import_goes_on(client, support_headers, monkeypatch):
+    monkeypatch.setattr(bulk_import, "chunk_size", 2)
+    find_existing = user_access.find_existing_usernames_and_emails
+    calls = []
+
+    def time_out_once(usernames, emails):
+        calls.append(usernames)
+        if len(calls) == 1:
+            raise PoolTimeoutError("Timed out waiting for a database connection")
+        return find_existing(usernames, emails)
+    monkeypatch.setattr(user_access, "find_existing_usernames_and_emails", time_out_once)
+
+    results = post_ndjson(client, support_headers, [record(i) for i in range(5)])
+
+    assert [result["status"] for result in results[:-1]] == ["error", "error", "created", "created", "created"]
+    assert results[0]["message"] == "Internal Server Error"
+    assert results[-1] == {"summary": {"created": 3, "failed": 2}}
+
+
+def test_invalid_bytes_fail_their_row_only(client, support_headers):
+    body = b"".join([(json.dumps(record(0)) + "\n").encode(), b'{"username": "\xff\xfe"}\n',
+                     (json.dumps(record(2)) + "\n").encode()])
+    response = client.post("/api/users/bulk", data=body, content_type="application/x-ndjson", headers=support_headers)
+    results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert [(result["line"], result["status"], result.get("message")) for result in results[:-1]] == [
+        (1, "created", None), (2, "error", "Invalid data"), (3, "created", None)]
+    assert results[-1] == {"summary": {"created": 2, "failed": 1}}
+
+
+def test_invalid_bytes_in_csv_fail_their_row_only(client, support_headers):
+    fields = ["username", "password", "email", "phone", "slack_id", "role", "status", "address"]
+    rows = [",".join(fields)] + [",".join('"{}"'.format(record(i)[field]) for field in fields) for i in range(3)]
+    body = "\n".join(rows).encode().replace(b"bulk1@", b"bulk1\xff@") + b"\n"
+    response = client.post("/api/users/bulk", data=body, content_type="text/csv", headers=support_headers)
+    results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert [(result["line"], result["status"], result.get("message")) for result in results[:-1]] == [
+        (2, "created", None), (3, "error", "Invalid data"), (4, "created", None)]
+    assert results[-1] == {"summary": {"created": 2, "failed": 1}}
@@ -0,0 +1,56 @@
+import time
+import pymysql
+import pytest
+from database_access.connection_pool import ConnectionPool, PoolTimeoutError
+
+
+class FakeConnection:
+    def __init__(self):
+        self.healthy = True
+        self.open = True
+
+    def ping(self, reconnect=False):
+        if not self.healthy:
+            raise pymysql.OperationalError(2006, "MySQL server has gone away")
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+def create_pool(**kwargs):
+    created = []
+
+    def connect(**connect_kwargs):
+        created.append(FakeConnection())
+        return created[-1]
+    return ConnectionPool({}, connect=connect, **kwargs), created
+
+
+def test_unhealthy_connections_are_replaced_in_one_checkout():
+    pool, created = create_pool(min_size=0, max_size=2, health_check_interval=0)
+    with pool.connection(), pool.connection():
+        pass
+    for conn in created:
+        conn.healthy = False
+    with pool.connection() as conn:
+        assert conn is created[-1] and conn.healthy
+    metrics = pool.metrics()
+    assert metrics["checkouts"] == 3
+    assert metrics["health_check_failures"] == 2
+    assert metrics["size"] == 1
+    assert not created[0].open and not created[1].open
+
+
+def test_timeout_keeps_the_original_deadline():
+    pool, _ = create_pool(min_size=0, max_size=1, timeout=0.2)
+    with pool.connection():
+        start = time.monotonic()
+        with pytest.raises(PoolTimeoutError):
+            with pool.connection():
+                pass
+        assert time.monotonic() - start < 0.5
+    metrics = pool.metrics()
+    assert metrics["checkouts"] == 2 and metrics["timeouts"] == 1 and metrics["in_use"] == 0
@@ -0,0 +1,68 @@
+import time
+import pytest
+from benchmarks.stand_ins import FakeIdentityProvider
+import database_access.user_access as user_access
+from tools import google_identity
+from tools.google_identity import IdentityError
+
+client_id = "benchmark"
+
+
+@pytest.fixture
+def provider(server):
+    import application
+    return application.google_client().provider
+
+
+def verify(id_token, nonce=None, audience=client_id):
+    return google_identity.verify_id_token({"id_token": id_token, "access_token": "stand-in"}, audience, nonce)
+
+
+def test_a_valid_token_is_verified(provider):
+    claims = verify(provider.id_token("ann@example.com", nonce="n1"), nonce="n1")
+    assert claims["email"] == "ann@example.com"
+
+
+@pytest.mark.parametrize("overrides, nonce, audience", [
+    ({}, None, "another-client"),
+    ({"nonce": "n1"}, "n2", client_id),
+    ({}, "n1", client_id),
+    ({"email_verified": False}, None, client_id),
+    ({"iss": "https://accounts.example.com"}, None, client_id),
+    ({"exp": int(time.time()) - 600, "iat": int(time.time()) - 4200}, None, client_id),
+], ids=["audience", "nonce", "missing nonce", "unverified email", "issuer", "expired"])
+def test_untrusted_tokens_are_rejected(provider, overrides, nonce, audience):
+    before = google_identity.metrics["rejected"]
+    with pytest.raises(IdentityError):
+        verify(provider.id_token("ann@example.com", **overrides), nonce, audience)
+    assert google_identity.metrics["rejected"] == before + 1
+
+
+def test_a_token_signed_with_another_key_is_rejected(provider):
+    forger = FakeIdentityProvider(client_id)
+    with pytest.raises(IdentityError):
+        verify(forger.id_token("ann@example.com"))
+
+
+def test_unknown_keys_refetch_at_most_once_a_minute(provider):
+    verify(provider.id_token("ann@example.com"))
+    fetches = provider.fetches
+    provider.kid = "rotated"
+    with pytest.raises(IdentityError):
+        verify(provider.id_token("ann@example.com"))
+    assert provider.fetches == fetches
+
+
+def test_google_login_creates_the_user_once(client, provider):
+    assert client.get("/api/g_login").status_code == 302
+    response = client.get("/api/g_authorize?code=ann@example.com")
+    assert response.status_code == 302 and "?token=" in response.location
+    client.get("/api/g_login")
+    assert client.get("/api/g_authorize?code=ann@example.com").status_code == 302
+    users = user_access.query_users({"email": "ann@example.com"}, cached=False)
+    assert [(user["username"], user["status"]) for user in users] == [("ann@example.com", "active")]
+
+
+def test_google_login_without_the_session_nonce_is_rejected(client, provider):
+    assert client.get("/api/g_authorize?code=ann@example.com").status_code == 401
+    assert not user_access.query_users({"email": "ann@example.com"}, cached=False)
@@ -0,0 +1,27 @@
+import database_access.user_access as user_access
+from tools import password_hashing
+from tests.conftest import user_rows
+
+
+def login(client, password):
+    return client.post("/api/login", json={"username": "user0", "password": password})
+
+
+# Another worker changing the row only invalidates its own cache, login has to see the change anyway
+def test_login_reads_password_and_status_from_the_database(server, client):
+    user_access.create_users(user_rows(1, status="pending"))
+    assert login(client, "password").get_json()["message"] == "User is not activated via email"
+    assert user_access.user_cache.get("username", "user0")
+
+    server.db.execute("UPDATE signals.users SET status = 'active', password = ? WHERE username = 'user0'",
+                      (password_hashing.hash_password("changed"),))
+    assert login(client, "password").get_json()["message"] == "Password is incorrect"
+    response = login(client, "changed")
+    assert response.status_code == 200 and "token" in response.get_json()
+
+
+def test_duplicate_check_ignores_cached_rows(server):
+    user_access.create_users(user_rows(1))
+    assert user_access.query_users({"username": "user0"})
+    server.db.execute("UPDATE signals.users SET username = 'renamed' WHERE username = 'user0'")
+    assert user_access.find_duplicate_user_fields({"username": "user0", "email": "user0@example.com"}) == ["email"]
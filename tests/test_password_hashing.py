@@ -0,0 +1,35 @@
+import asyncio
+import os
+import signal
+import pytest
+from tools import password_hashing
+
+
+@pytest.fixture
+def hashing_pool():
+    password_hashing.configure(new_pool_size=1)
+    yield
+    password_hashing.configure(new_pool_size=0)
+
+
+def kill_workers():
+    for process in list(password_hashing.get_executor()._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+        process.join(5)
+
+
+def test_workers_are_not_forked_from_the_application(hashing_pool):
+    assert password_hashing.get_executor()._mp_context.get_start_method() in ("forkserver", "spawn")
+
+
+def test_a_dead_worker_does_not_break_hashing(hashing_pool):
+    password_hash = password_hashing.hash_password("secret")
+    broken = password_hashing.get_executor()
+    kill_workers()
+
+    assert password_hashing.verify_password("secret", password_hash) == (True, None)
+    assert password_hashing.get_executor() is not broken
+    kill_workers()
+    assert len(password_hashing.hash_passwords(["a", "b", "c"])) == 3
+    kill_workers()
+    assert asyncio.run(password_hashing.verify_password_async("secret", password_hash)) == (True, None)
@@ -0,0 +1,53 @@
+import pytest
+from middlewares import rate_limiter
+from middlewares.rate_limiter import LoginRateLimiter, LocalBucketStore, SqliteBucketStore
+import database_access.user_access as user_access
+from tests.conftest import user_rows
+
+
+@pytest.fixture(params=["local", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "local":
+        return LocalBucketStore()
+    return SqliteBucketStore(str(tmp_path / "buckets.db"))
+
+
+def test_only_failed_attempts_spend_tokens(store):
+    limiter = LoginRateLimiter(store, user_burst=2, user_per_minute=0.001, ip_burst=4, ip_per_minute=0.001)
+    for _ in range(10):
+        assert limiter.check("ann", "10.0.0.1") == 0
+        limiter.succeeded("ann", "10.0.0.1")
+    assert limiter.check("ann", "10.0.0.1") == 0
+    assert limiter.check("ann", "10.0.0.1") == 0
+    assert limiter.check("ann", "10.0.0.1") > 0
+    # The username is out of tokens, the address still has one for another user
+    assert limiter.check("bob", "10.0.0.1") == 0
+    assert limiter.check("carl", "10.0.0.1") > 0
+
+
+def test_a_refund_never_exceeds_the_burst(store):
+    limiter = LoginRateLimiter(store, user_burst=1, user_per_minute=0.001, ip_burst=0)
+    limiter.succeeded("ann", None)
+    limiter.succeeded("ann", None)
+    assert limiter.check("ann", None) == 0
+    limiter.succeeded("ann", None)
+    limiter.succeeded("ann", None)
+    assert limiter.check("ann", None) == 0
+    assert limiter.check("ann", None) > 0
+
+
+def test_ip_limit_is_off_without_trusted_proxies():
+    assert rate_limiter.default_ip_burst(None, 0) == 0
+    assert rate_limiter.default_ip_burst(None, 1) == 20
+    assert rate_limiter.default_ip_burst(5, 0) == 5
+
+
+def test_successful_logins_are_not_throttled(client, monkeypatch):
+    monkeypatch.setattr(rate_limiter, "login_limiter",
+                        LoginRateLimiter(LocalBucketStore(), user_burst=2, user_per_minute=0.001, ip_burst=0))
+    user_access.create_users(user_rows(1))
+    for _ in range(5):
+        assert client.post("/api/login", json={"username": "user0", "password": "password"}).status_code == 200
+    statuses = [client.post("/api/login", json={"username": "user0", "password": "wrong"}).status_code
+                for _ in range(3)]
+    assert statuses == [400, 400, 429]
@@ -0,0 +1,113 @@
+import time
+import pytest
+from benchmarks import stand_ins
+import database_access.user_access as user_access
+from tests.conftest import user_rows
+
+
+# install replaces user_access.router with one over the replicas, the tests that follow get the primary only router
+# back
+@pytest.fixture
+def replicated(support_headers, monkeypatch):
+    import application
+    monkeypatch.setattr(user_access, "router", user_access.router)
+    server = stand_ins.install(application, replicas=2)
+    user_access.create_users(user_rows(10))
+    router = user_access.router
+    router.start_request()
+    router.lag_check_interval = 0
+    yield server, router
+    router.close()
+
+
+def statements(server):
+    return [server.statements] + [replica.statements for replica in server.replicas.values()]
+
+
+def read(client, headers):
+    response = client.get("/api/users?limit=2", headers=headers)
+    assert response.status_code == 200
+    return response
+
+
+def test_reads_are_spread_over_the_replicas(replicated, client, support_headers):
+    server, router = replicated
+    primary = server.statements
+    for _ in range(4):
+        read(client, support_headers)
+    replica_statements = statements(server)[1:]
+    assert server.statements == primary
+    assert replica_statements[0] > 0 and replica_statements[0] == replica_statements[1]
+    assert router.metrics()["replica_reads"] == 4
+
+
+def test_a_client_reads_its_own_writes_from_the_primary(replicated, client, support_headers):
+    import application
+    from settings import settings
+    server, router = replicated
+    assert application.app.secret_key == settings.session_secret
+    response = client.put("/api/users/3", json={"phone": "2125550199"}, headers=support_headers)
+    assert response.status_code == 200
+    before = statements(server)
+    assert client.get("/api/users?username=user2", headers=support_headers).get_json()["data"][0]["phone"] == \
+        "2125550199"
+    after = statements(server)
+    assert after[0] > before[0] and after[1:] == before[1:]
+
+    # Another client has not written and still reads from the replicas
+    other = application.app.test_client()
+    read(other, support_headers)
+    assert statements(server)[0] == after[0]
+
+
+def test_lagging_replicas_fall_back_to_the_primary(replicated, client, support_headers):
+    server, router = replicated
+    for replica in server.replicas.values():
+        replica.lag = router.max_lag + 1
+    before = statements(server)
+    read(client, support_headers)
+    after = statements(server)
+    assert after[0] > before[0]
+    assert router.metrics()["lagging"] == 2
+
+    for replica in server.replicas.values():
+        replica.lag = 0
+    read(client, support_headers)
+    assert statements(server)[0] == after[0]
+
+
+def test_a_down_replica_is_skipped(replicated, client, support_headers):
+    server, router = replicated
+    down, up = server.replicas.values()
+    down.down = True
+    for _ in range(4):
+        read(client, support_headers)
+    metrics = router.metrics()
+    assert metrics["replicas_down"] == 1 and metrics["failures"] == 1
+    assert up.statements > 0
+
+    up.down = True
+    primary = server.statements
+    read(client, support_headers)
+    assert server.statements > primary
+
+
+def test_a_busy_replica_is_not_marked_down(replicated):
+    server, router = replicated
+    for pool in router.replicas.values():
+        pool.max_size = 1
+        pool.timeout = 0.01
+    with router.read_connection(), router.read_connection(), router.read_connection():
+        pass
+    metrics = router.metrics()
+    assert metrics["busy"] == 2 and metrics["replicas_down"] == 0
+    assert metrics["replica_reads"] == 2 and metrics["primary_reads"] == 1
+
+
+def test_writes_go_to_the_primary(replicated):
+    server, router = replicated
+    before = statements(server)
+    user_access.update_password_hash(1, "hash")
+    after = statements(server)
+    assert after[0] > before[0] and after[1:] == before[1:]
+    assert router.primary_until() > time.time()
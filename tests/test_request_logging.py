@@ -0,0 +1,28 @@
+import logging
+from tools import request_logging
+from tools.request_logging import redacted
+
+
+def test_secrets_are_redacted_by_key_substring():
+    body = {"username": "ann", "new_password": "p", "tokens": [{"access_token": "a", "refresh_token": "r"}],
+            "client_secret": "s", "profile": {"id_token": "i", "email": "ann@example.com"}}
+    assert request_logging.redact(body) == {
+        "username": "ann", "new_password": redacted, "tokens": redacted, "client_secret": redacted,
+        "profile": {"id_token": redacted, "email": "ann@example.com"}}
+    assert request_logging.redact([{"Password": "p", "role": "ip"}]) == [{"Password": redacted, "role": "ip"}]
+
+
+def test_oauth_parameters_and_credentials_are_not_logged(caplog, monkeypatch):
+    monkeypatch.setattr(request_logging, "request_log_sample_rate", 1.0)
+    caplog.set_level(logging.INFO, logger=request_logging.request_logger.name)
+    request_logging.log_request({
+        "path": "/api/g_authorize",
+        "method": "GET",
+        "query_params": {"code": "4/0AX4XfWh", "state": "xyz", "scope": "email"},
+        "headers": {"Authorization": "Bearer abc", "Cookie": "session=1", "X-Api-Key": "k", "Accept": "*/*"},
+        "body": None,
+    })
+    context = caplog.records[-1].context
+    assert context["query_params"] == {"code": redacted, "state": redacted, "scope": "email"}
+    assert context["headers"] == {"Authorization": redacted, "Cookie": redacted, "X-Api-Key": redacted,
+                                  "Accept": "*/*"}
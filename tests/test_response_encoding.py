@@ -0,0 +1,96 @@
+import gzip
+import json
+import types
+import pytest
+import database_access.user_access as user_access
+from tests.conftest import user_rows
+from tools import response_encoding
+
+
+@pytest.fixture
+def users(server):
+    user_access.create_users(user_rows(20))
+
+
+def test_a_matching_etag_gets_an_empty_304(users, client, support_headers):
+    response = client.get("/api/users/1", headers=support_headers)
+    etag = response.headers["ETag"]
+    assert response.status_code == 200 and etag.startswith('W/"')
+
+    for if_none_match in (etag, etag[2:], 'W/"other", ' + etag, "*"):
+        cached = client.get("/api/users/1", headers=dict(support_headers, **{"If-None-Match": if_none_match}))
+        assert cached.status_code == 304 and cached.get_data() == b""
+        assert cached.headers["ETag"] == etag and cached.headers["Vary"] == "Accept-Encoding, Cookie"
+
+
+def test_a_stale_etag_gets_the_body(users, client, support_headers):
+    etag = client.get("/api/users/1", headers=support_headers).headers["ETag"]
+    assert client.put("/api/users/1", json={"phone": "2125550199"}, headers=support_headers).status_code == 200
+
+    response = client.get("/api/users/1", headers=dict(support_headers, **{"If-None-Match": etag}))
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert response.get_json()["data"][0]["phone"] == "2125550199"
+
+
+def test_writes_have_no_etag(server, client, support_headers):
+    response = client.post("/api/users", json={"username": "new", "password": "password", "email": "new@example.com",
+                                                "phone": "2125550100", "slack_id": "U1", "role": "ip",
+                                                "status": "pending", "address": "1 Main St, New York NY"},
+                           headers=dict(support_headers, **{"If-None-Match": "*"}))
+    assert response.status_code == 201 and "ETag" not in response.headers
+
+
+def list_users(client, headers, **extra):
+    return client.get("/api/users?limit=20&offset=0", headers=dict(headers, **extra))
+
+
+def test_large_bodies_are_gzipped_for_clients_accepting_it(users, client, support_headers):
+    plain = list_users(client, support_headers)
+    assert len(plain.get_data()) >= response_encoding.compression_min_size
+    assert "Content-Encoding" not in plain.headers and "Accept-Encoding" in plain.headers["Vary"]
+
+    compressed = list_users(client, support_headers, **{"Accept-Encoding": "gzip, deflate"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(compressed.get_data()) == plain.get_data()
+    # Weak, the same for both encodings
+    assert compressed.headers["ETag"] == plain.headers["ETag"]
+
+
+@pytest.mark.parametrize("accept_encoding", ["deflate", "identity", "gzip;q=0", "br"])
+def test_bodies_are_not_compressed_without_an_accepted_encoding(users, client, support_headers, accept_encoding):
+    response = list_users(client, support_headers, **{"Accept-Encoding": accept_encoding})
+    assert "Content-Encoding" not in response.headers
+    assert len(response.get_json()["data"]) == 20
+
+
+def test_br_is_preferred_when_brotli_is_installed(users, client, support_headers, monkeypatch):
+    monkeypatch.setattr(response_encoding, "brotli", types.SimpleNamespace(compress=lambda body, quality: b"br" + body))
+    monkeypatch.setattr(response_encoding, "encodings", ["br", "gzip"])
+    plain = list_users(client, support_headers).get_data()
+
+    response = list_users(client, support_headers, **{"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "br" and response.get_data() == b"br" + plain
+    response = list_users(client, support_headers, **{"Accept-Encoding": "gzip, br;q=0"})
+    assert response.headers["Content-Encoding"] == "gzip"
+
+
+def test_small_bodies_are_not_compressed(users, client, support_headers):
+    response = client.get("/api/users/1", headers=dict(support_headers, **{"Accept-Encoding": "gzip"}))
+    assert len(response.get_data()) < response_encoding.compression_min_size
+    assert "Content-Encoding" not in response.headers and response.get_json()["data"][0]["user_id"] == 1
+
+
+def test_password_hashes_are_never_sent(users, client, support_headers):
+    responses = [
+        client.get("/api/users/1", headers=support_headers),
+        list_users(client, support_headers),
+        client.post("/api/users/batch_lookup", json={"ids": [1, 2]}, headers=support_headers),
+        client.put("/api/users/1", json={"password": "changed"}, headers=support_headers),
+        client.post("/api/users", json={"username": "new", "password": "password", "email": "new@example.com",
+                                        "phone": "2125550100", "slack_id": "U1", "role": "ip", "status": "pending",
+                                        "address": "1 Main St, New York NY"}, headers=support_headers),
+    ]
+    assert [response.status_code for response in responses] == [200, 200, 200, 200, 201]
+    for response in responses:
+        assert "password" not in response.get_data(as_text=True)
+    assert client.get("/api/users?fields=username,password", headers=support_headers).status_code == 400
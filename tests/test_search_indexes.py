@@ -0,0 +1,65 @@
+import os
+import re
+import pytest
+import database_access.user_access as user_access
+
+database_access = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database_access")
+migrations = os.path.join(database_access, "migrations")
+
+
+def columns_of(text):
+    return [column.strip() for column in text.split(",")]
+
+
+# The keys of signals.users in database_access/schema.sql and the indexes its migrations add, as column lists
+def indexes():
+    with open(os.path.join(database_access, "schema.sql")) as f:
+        sql = f.read()
+    found = [columns_of(columns) for columns in re.findall(r"(?:PRIMARY|UNIQUE) KEY (?:\w+ )?\(([^)]*)\)", sql,
+                                                            re.IGNORECASE)]
+    for name in sorted(os.listdir(migrations)):
+        with open(os.path.join(migrations, name)) as f:
+            sql = f.read()
+        found.extend(columns_of(columns)
+                     for columns in re.findall(r"ADD (?:UNIQUE )?INDEX \w+ \(([^)]*)\)", sql, re.IGNORECASE))
+    return found
+
+
+# Whether an index reads rows in the order of columns. InnoDB appends the primary key to every secondary index
+def index_starts_with(columns):
+    return any((index + ["user_id"])[:len(columns)] == columns for index in indexes())
+
+
+def test_the_schema_keys_are_read():
+    assert ["user_id"] in indexes() and ["username"] in indexes() and ["email"] in indexes()
+
+
+# A filter or sort column without an index starting with it sends its searches to a full table scan
+@pytest.mark.parametrize("column", sorted({column for _, column, _ in user_access.search_filters} |
+                                          set(user_access.search_sort_fields)))
+def test_every_search_filter_and_sort_leads_an_index(column):
+    assert index_starts_with([column])
+
+
+# A role or status filter picks rows with one value of its column, an index on the column followed by the sort reads
+# them already ordered. Without one MySQL sorts the whole role or status range before returning the first page.
+# A range filter, such as a prefix or a created_date bound, cannot share an index with a sort on another column
+@pytest.mark.parametrize("column,sort", [(column, sort) for _, column, kind in user_access.search_filters
+                                         if kind == "in" for sort in user_access.search_sort_fields])
+def test_in_filters_are_followed_by_every_sort(column, sort):
+    assert index_starts_with([column, sort])
+
+
+# Both in filters together are followed by created_date, see database_access/migrations/0001_user_search_indexes.sql
+def test_role_and_status_are_followed_by_created_date():
+    assert index_starts_with(["role", "status", "created_date"])
+
+
+# EXPLAIN every search on the MySQL in the USER_SERVICE_* settings, loaded with production sized data and the
+# migrations applied, see benchmarks/explain_search.py. CI sets EXPLAIN_SEARCH against its MySQL service
+@pytest.mark.skipif(not os.environ.get("EXPLAIN_SEARCH"), reason="set EXPLAIN_SEARCH=1 to EXPLAIN against MySQL")
+def test_no_search_scans_the_whole_table():
+    from benchmarks.explain_search import full_scan_searches
+    cases, failures = full_scan_searches(len(user_access.search_filters))
+    assert cases > 0
+    assert failures == []
@@ -0,0 +1,67 @@
+import time
+import types
+from collections import OrderedDict
+import jwt
+import pytest
+import middlewares.security as security
+
+
+# Tokens minted in the same second for the same user are equal, one cached by an earlier test would be a hit here
+@pytest.fixture(autouse=True)
+def empty_token_cache(monkeypatch):
+    monkeypatch.setattr(security, "verified_tokens", OrderedDict())
+
+
+def support_token():
+    return security.create_token({"user_id": 0, "role": "support", "email": "support@example.com"})
+
+
+def get_user(client, token):
+    return client.get("/api/users/1", headers={"Authorization": "Bearer " + token})
+
+
+def test_a_verified_token_is_served_from_the_cache(server, client):
+    token = support_token()
+    before = security.authorizer_metrics()
+    assert get_user(client, token).status_code == 200
+    assert get_user(client, token).status_code == 200
+    metrics = security.authorizer_metrics()
+    assert metrics["verifications"] == before["verifications"] + 1
+    assert metrics["cache_hits"] == before["cache_hits"] + 1
+
+
+# The cached payload must not outlive the token, the same request is refused once exp has passed
+def test_a_cached_token_is_refused_after_it_expires(server, client, monkeypatch):
+    monkeypatch.setattr(security, "jwt_exp_delta_sec", 1)
+    token = support_token()
+    exp = jwt.decode(token, verify=False)["exp"]
+    assert get_user(client, token).status_code == 200
+    assert get_user(client, token).status_code == 200
+    before = security.authorizer_metrics()
+
+    # PyJWT compares whole seconds, a token is expired for it from the second after exp
+    while time.time() < exp + 1:
+        time.sleep(0.05)
+    assert get_user(client, token).status_code == 401
+    metrics = security.authorizer_metrics()
+    assert metrics["cache_hits"] == before["cache_hits"]
+    assert metrics["cache_misses"] == before["cache_misses"] + 1
+
+
+# Only the clock of the cache moves: the payload is not returned from the cache but verified again
+def test_an_expired_cache_entry_is_verified_again(server, client, monkeypatch):
+    token = support_token()
+    exp = jwt.decode(token, verify=False)["exp"]
+    assert get_user(client, token).status_code == 200
+    before = security.authorizer_metrics()
+
+    monkeypatch.setattr(security, "time", types.SimpleNamespace(time=lambda: exp + 1, perf_counter=time.perf_counter))
+    decoded = []
+
+    def expired_decode(*args, **kwargs):
+        decoded.append(args[0])
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    monkeypatch.setattr(security.jwt, "decode", expired_decode)
+    assert get_user(client, token).status_code == 401
+    assert decoded == [token]
+    assert security.authorizer_metrics()["cache_hits"] == before["cache_hits"]
@@ -0,0 +1,138 @@
+import json
+import threading
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from middlewares.sns_publisher import SnsPublisher, max_batch_bytes
+
+
+# Records every PublishBatch call. The first call waits for release so tests can queue messages behind it, calls
+# raise while errors are left and entries whose message is in rejected are reported as failed
+class RecordingSns:
+    def __init__(self, errors=0, rejected=(), gate=False):
+        self.batches = []
+        self.errors = errors
+        self.rejected = set(rejected)
+        self.release = threading.Event()
+        if not gate:
+            self.release.set()
+        self.started = threading.Event()
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.started.set()
+        self.release.wait(5)
+        if self.errors:
+            self.errors -= 1
+            raise ClientError({"Error": {"Code": "Throttling", "Message": "Rate exceeded"}}, "PublishBatch")
+        self.batches.append((TopicArn, [entry["Message"] for entry in PublishBatchRequestEntries]))
+        failed = [{"Id": entry["Id"], "Code": "InternalError", "Message": "rejected"}
+                  for entry in PublishBatchRequestEntries if entry["Message"] in self.rejected]
+        return {"Successful": [], "Failed": failed}
+
+
+# A client from before PublishBatch
+class SinglePublishSns:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message):
+        self.messages.append((TopicArn, Message))
+
+
+def create_publisher(client, tmp_path, **kwargs):
+    kwargs.setdefault("backoff", 0)
+    return SnsPublisher(client, dead_letter_path=str(tmp_path / "dead_letter.ndjson"), **kwargs)
+
+
+def test_queued_messages_are_sent_in_batches_per_topic(tmp_path):
+    client = RecordingSns(gate=True)
+    publisher = create_publisher(client, tmp_path)
+    publisher.publish("topic-a", "first")
+    assert client.started.wait(5)
+    for i in range(25):
+        publisher.publish("topic-a", "a{}".format(i))
+    publisher.publish("topic-b", "b0")
+    client.release.set()
+    publisher.flush()
+    publisher.close()
+
+    assert [(topic, len(messages)) for topic, messages in client.batches] == \
+        [("topic-a", 1), ("topic-a", 10), ("topic-a", 10), ("topic-a", 5), ("topic-b", 1)]
+    assert [message for _, messages in client.batches[1:4] for message in messages] == \
+        ["a{}".format(i) for i in range(25)]
+    metrics = publisher.metrics()
+    assert metrics["published"] == 27 and metrics["enqueued"] == 27 and metrics["queue_depth"] == 0
+
+
+def test_batches_stay_within_the_payload_limit():
+    message = "x" * (max_batch_bytes // 3 + 1)
+    assert [len(batch) for batch in SnsPublisher._batches([message] * 5)] == [2, 2, 1]
+
+
+def test_failed_calls_are_retried(tmp_path):
+    client = RecordingSns(errors=2)
+    publisher = create_publisher(client, tmp_path, max_retries=3)
+    publisher.publish("topic", "message")
+    publisher.flush()
+
+    assert client.batches == [("topic", ["message"])]
+    metrics = publisher.metrics()
+    assert metrics["retries"] == 2 and metrics["published"] == 1 and metrics["dead_lettered"] == 0
+    assert not (tmp_path / "dead_letter.ndjson").exists()
+
+
+def test_only_failed_entries_are_retried_then_dead_lettered(tmp_path):
+    client = RecordingSns(rejected=["bad"], gate=True)
+    publisher = create_publisher(client, tmp_path, max_retries=2)
+    publisher.publish("topic", "warm-up")
+    assert client.started.wait(5)
+    publisher.publish("topic", "good")
+    publisher.publish("topic", "bad")
+    client.release.set()
+    publisher.flush()
+
+    assert client.batches == [("topic", ["warm-up"]), ("topic", ["good", "bad"]), ("topic", ["bad"]),
+                              ("topic", ["bad"])]
+    lines = [json.loads(line) for line in (tmp_path / "dead_letter.ndjson").read_text().splitlines()]
+    assert [(line["topic"], line["message"], line["error"]) for line in lines] == [("topic", "bad", "rejected")]
+    metrics = publisher.metrics()
+    assert metrics["published"] == 2 and metrics["dead_lettered"] == 1 and metrics["retries"] == 2
+
+
+def test_messages_are_dropped_when_the_queue_is_full(tmp_path):
+    client = RecordingSns(gate=True)
+    publisher = create_publisher(client, tmp_path, max_queue_size=1)
+    publisher.publish("topic", "in flight")
+    assert client.started.wait(5)
+    assert publisher.publish("topic", "queued")
+    assert not publisher.publish("topic", "dropped")
+    client.release.set()
+    publisher.flush()
+    assert publisher.metrics()["dropped"] == 1
+    assert [messages for _, messages in client.batches] == [["in flight"], ["queued"]]
+
+
+def test_clients_without_publish_batch_publish_one_by_one(tmp_path):
+    client = SinglePublishSns()
+    publisher = create_publisher(client, tmp_path)
+    publisher.publish("topic", "one")
+    publisher.publish("topic", "two")
+    publisher.flush()
+    assert client.messages == [("topic", "one"), ("topic", "two")]
+    assert publisher.metrics()["published"] == 2
+
+
+def test_the_pinned_sns_client_publishes_in_batches(tmp_path):
+    client = boto3.client("sns", region_name="us-east-1", aws_access_key_id="key", aws_secret_access_key="secret")
+    topic = "arn:aws:sns:us-east-1:123456789012:topic"
+    entries = {"TopicArn": topic, "PublishBatchRequestEntries": [{"Id": "0", "Message": "message"}]}
+    with Stubber(client) as stubber:
+        stubber.add_response("publish_batch", {"Successful": [], "Failed": [
+            {"Id": "0", "Code": "InternalError", "SenderFault": False, "Message": "rejected"}]}, entries)
+        stubber.add_response("publish_batch", {"Successful": [{"Id": "0", "MessageId": "id"}], "Failed": []}, entries)
+        publisher = create_publisher(client, tmp_path)
+        publisher.publish(topic, "message")
+        publisher.flush()
+        stubber.assert_no_pending_responses()
+    metrics = publisher.metrics()
+    assert metrics["published"] == 1 and metrics["retries"] == 1 and metrics["dead_lettered"] == 0
@@ -0,0 +1,50 @@
+import pytest
+import database_access.user_access as user_access
+from tests.conftest import user_rows
+
+
+# With USER_SERVICE_RELY_ON_UNIQUE_INDEX the duplicate checks are skipped and the 1062 of the unique indexes, which
+# the stand-in raises like MySQL, becomes the 400 of the colliding field
+@pytest.fixture
+def unique_index(server, monkeypatch):
+    monkeypatch.setattr(user_access, "rely_on_unique_index", True)
+
+    def no_duplicate_check(*args, **kwargs):
+        raise AssertionError("duplicates are left to the unique indexes")
+    monkeypatch.setattr(user_access, "find_duplicate_user_fields", no_duplicate_check)
+    monkeypatch.setattr(user_access, "exist_duplicate_user_with_field", no_duplicate_check)
+    user_access.create_users(user_rows(2))
+    return server
+
+
+def new_user(**fields):
+    return dict({"username": "new", "password": "password", "email": "new@example.com", "phone": "2125550100",
+                 "slack_id": "U9", "role": "ip", "status": "pending", "address": "1 Main St, New York NY"}, **fields)
+
+
+@pytest.mark.parametrize("fields,message", [({"username": "user0"}, "Username is duplicate"),
+                                            ({"email": "user1@example.com"}, "Email is duplicate")])
+def test_a_duplicate_create_is_a_400(unique_index, client, support_headers, fields, message):
+    response = client.post("/api/users", json=new_user(**fields), headers=support_headers)
+    assert response.status_code == 400 and response.get_json() == {"message": message}
+    assert unique_index.db.execute("SELECT COUNT(*) FROM signals.users").fetchone()[0] == 2
+
+
+def test_a_unique_create_succeeds(unique_index, client, support_headers):
+    response = client.post("/api/users", json=new_user(), headers=support_headers)
+    assert response.status_code == 201 and response.get_json()["data"][0]["username"] == "new"
+
+
+@pytest.mark.parametrize("fields,message", [({"username": "user0"}, "Username is duplicate"),
+                                            ({"email": "user0@example.com"}, "Email is duplicate")])
+def test_a_duplicate_update_is_a_400(unique_index, client, support_headers, fields, message):
+    response = client.put("/api/users/2", json=fields, headers=support_headers)
+    assert response.status_code == 400 and response.get_json() == {"message": message}
+    assert unique_index.db.execute("SELECT username, email FROM signals.users WHERE user_id = 2").fetchone() == \
+        ("user1", "user1@example.com")
+
+
+def test_a_unique_update_succeeds(unique_index, client, support_headers):
+    response = client.put("/api/users/2", json={"username": "renamed"}, headers=support_headers)
+    assert response.status_code == 200
+    assert unique_index.db.execute("SELECT username FROM signals.users WHERE user_id = 2").fetchone() == ("renamed",)
@@ -0,0 +1,113 @@
+import asyncio
+from contextlib import asynccontextmanager
+import database_access.async_user_access as async_user_access
+import database_access.user_access as user_access
+from tests.conftest import user_rows
+
+
+def test_an_exported_stream_returns_its_connection(server):
+    user_access.create_users(user_rows(3))
+    before = user_access.pool.metrics()
+    assert [user["username"] for user in user_access.stream_users({}, ["username"])] == ["user0", "user1", "user2"]
+    metrics = user_access.pool.metrics()
+    assert metrics["closed"] == before["closed"] and metrics["in_use"] == 0
+
+
+# Closing the cursor of an abandoned stream would read the rest of the result, its connection is closed instead
+def test_an_abandoned_stream_discards_its_connection(server, monkeypatch):
+    user_access.create_users(user_rows(3))
+    drained = []
+    connect = server.connect
+
+    def recording_connect(**kwargs):
+        conn = connect(**kwargs)
+        cursor = conn.cursor
+
+        def recording_cursor(cursor_class=None):
+            created = cursor(cursor_class)
+            close = created.close
+
+            def recording_close():
+                if created.connection is not None and created.rows:
+                    drained.extend(created.rows)
+                close()
+            created.close = recording_close
+            return created
+        conn.cursor = recording_cursor
+        return conn
+    monkeypatch.setattr(user_access.pool, "_connect", recording_connect)
+    user_access.pool.close()
+    before = user_access.pool.metrics()
+
+    rows = user_access.stream_users({}, ["username"])
+    assert next(rows)["username"] == "user0"
+    rows.close()
+
+    metrics = user_access.pool.metrics()
+    assert drained == []
+    assert metrics["closed"] == before["closed"] + 1 and metrics["in_use"] == 0
+
+
+class FakeAsyncCursor:
+    def __init__(self, rows):
+        self._connection = True
+        self.rows = list(rows)
+        self.drained = []
+
+    async def execute(self, sql, args):
+        pass
+
+    async def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    async def close(self):
+        if self._connection is not None:
+            self.drained.extend(self.rows)
+        self._connection = None
+
+
+class FakeAsyncConnection:
+    def __init__(self, rows):
+        self.cursors = []
+        self.rows = rows
+        self.closed = False
+
+    async def cursor(self, cursor_class):
+        self.cursors.append(FakeAsyncCursor(self.rows))
+        return self.cursors[-1]
+
+    def close(self):
+        self.closed = True
+
+
+def test_an_abandoned_async_stream_closes_its_connection(monkeypatch):
+    conn = FakeAsyncConnection([{"user_id": i} for i in range(3)])
+
+    @asynccontextmanager
+    async def read_connection():
+        yield conn
+    monkeypatch.setattr(async_user_access, "read_connection", read_connection)
+
+    async def read_one():
+        rows = await async_user_access.stream_users({})
+        first = await rows.__anext__()
+        await rows.aclose()
+        return first
+
+    assert asyncio.run(read_one()) == {"user_id": 0}
+    assert conn.closed and conn.cursors[0].drained == []
+
+
+def test_a_finished_async_stream_keeps_its_connection(monkeypatch):
+    conn = FakeAsyncConnection([{"user_id": i} for i in range(3)])
+
+    @asynccontextmanager
+    async def read_connection():
+        yield conn
+    monkeypatch.setattr(async_user_access, "read_connection", read_connection)
+
+    async def read_all():
+        return [row async for row in await async_user_access.stream_users({})]
+
+    assert asyncio.run(read_all()) == [{"user_id": i} for i in range(3)]
+    assert not conn.closed
@@ -1,26 +1,63 @@
-import os
-from smartystreets_python_sdk import StaticCredentials, exceptions, ClientBuilder
-from smartystreets_python_sdk.us_street import Lookup as StreetLookup
+import re
+import logging
+import threading
+from database_access.user_cache import LocalBackend
+from tools.instrumentation import timed
+from settings import settings
 
-auth_id = os.environ['SMARTY_AUTH_ID']
-auth_token = os.environ['SMARTY_AUTH_TOKEN']
+# The SmartyStreets SDK, and requests with it, is imported by the functions that need it rather than at startup
 
+logger = logging.getLogger()
 
-# Verify the validity of ab address with format [street, city state].
-def verify(address):
-    print(address)
-    credentials = StaticCredentials(auth_id, auth_token)
-    client = ClientBuilder(credentials).build_us_street_api_client()
-    # Documentation for input fields can be found at:
-    # https://smartystreets.com/docs/us-street-api#input-fields
+auth_id = settings.smarty_auth_id
+auth_token = settings.smarty_auth_token
+
+# Results per normalized address. Invalid addresses are cached too, lookup errors are not
+cache_ttl = settings.address_cache_ttl
+negative_cache_ttl = settings.address_cache_negative_ttl
+cache = LocalBackend(settings.address_cache_max_size)
+
+client = None
+client_lock = threading.Lock()
+# Lookups being sent right now by normalized address, so identical concurrent requests wait for one answer
+in_flight = {}
+in_flight_lock = threading.Lock()
+metrics = {"lookups": 0, "cache_hits": 0, "coalesced": 0, "batches": 0, "errors": 0}
+
+
+class InFlightLookup:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = False
+
+
+# The SmartyStreets client is built once and reused
+def get_client():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                from smartystreets_python_sdk import StaticCredentials, ClientBuilder
+                credentials = StaticCredentials(auth_id, auth_token)
+                client = ClientBuilder(credentials).build_us_street_api_client()
+    return client
+
+
+def normalize(address):
+    return re.sub(r"\s*,\s*", ", ", re.sub(r"\s+", " ", address.strip())).lower()
+
+
+# Split an address with format [street, city state] into a lookup, None if the format is wrong
+def create_lookup(address):
+    from smartystreets_python_sdk.us_street import Lookup as StreetLookup
     address_info = address.split(",")
     if len(address_info) != 2:
-        return False
+        return None
     street = address_info[0]
     city_state = address_info[1].strip()
     city_state_splitted = city_state.rsplit(" ", 1)
     if len(city_state_splitted) != 2:
-        return False
+        return None
     city = city_state_splitted[0]
     state = city_state_splitted[1]
     lookup = StreetLookup()
@@ -28,17 +65,97 @@ def verify(address):
     lookup.city = city
     lookup.state = state
     lookup.match = "invalid"
+    return lookup
 
-    try:
-        client.send_lookup(lookup)
-    except exceptions.SmartyException as err:
-        print(err)
-        return False
 
+# Result is not none and there is at least one zipcode for the address
+def is_valid(lookup):
     result = lookup.result
-    # Result is not none and there is at least one zipcode for the address
-    if not result or not result[0].components.zipcode:
-        print("No candidates. This means the address is not valid.")
+    return bool(result and result[0].components.zipcode)
+
+
+def cache_result(key, valid):
+    cache.set(key, valid, cache_ttl if valid else negative_cache_ttl)
+
+
+# Verify the validity of ab address with format [street, city state].
+@timed("smartystreets", "verify")
+def verify(address):
+    key = normalize(address)
+    cached = cache.get(key)
+    if cached is not None:
+        metrics["cache_hits"] += 1
+        return cached
+    from smartystreets_python_sdk.exceptions import SmartyException
+    # Documentation for input fields can be found at:
+    # https://smartystreets.com/docs/us-street-api#input-fields
+    lookup = create_lookup(address)
+    if lookup is None:
         return False
 
-    return True
+    with in_flight_lock:
+        pending = in_flight.get(key)
+        owner = pending is None
+        if owner:
+            pending = in_flight[key] = InFlightLookup()
+    if not owner:
+        metrics["coalesced"] += 1
+        pending.done.wait()
+        return pending.result
+
+    try:
+        metrics["lookups"] += 1
+        get_client().send_lookup(lookup)
+        pending.result = is_valid(lookup)
+        cache_result(key, pending.result)
+    except SmartyException as err:
+        metrics["errors"] += 1
+        logger.error("Address verification failed: {}".format(err))
+    finally:
+        with in_flight_lock:
+            del in_flight[key]
+        pending.done.set()
+    return pending.result
+
+
+# Verify many addresses with as few requests as possible, return the results in the same order.
+# Cached and duplicate addresses are not sent again and the rest go out in batches of up to 100 lookups
+@timed("smartystreets", "verify_many")
+def verify_many(addresses):
+    from smartystreets_python_sdk import Batch
+    from smartystreets_python_sdk.exceptions import SmartyException
+    results = {}
+    lookups = {}
+    for address in addresses:
+        key = normalize(address)
+        if key in results or key in lookups:
+            continue
+        cached = cache.get(key)
+        if cached is not None:
+            metrics["cache_hits"] += 1
+            results[key] = cached
+            continue
+        lookup = create_lookup(address)
+        if lookup is None:
+            results[key] = False
+        else:
+            lookups[key] = lookup
+    keys = list(lookups)
+    for start in range(0, len(keys), Batch.MAX_BATCH_SIZE):
+        batch = Batch()
+        for key in keys[start:start + Batch.MAX_BATCH_SIZE]:
+            batch.add(lookups[key])
+        try:
+            metrics["batches"] += 1
+            metrics["lookups"] += len(batch)
+            get_client().send_batch(batch)
+        except SmartyException as err:
+            metrics["errors"] += 1
+            logger.error("Address verification failed: {}".format(err))
+            for key in keys[start:start + Batch.MAX_BATCH_SIZE]:
+                results[key] = False
+            continue
+        for key in keys[start:start + Batch.MAX_BATCH_SIZE]:
+            results[key] = is_valid(lookups[key])
+            cache_result(key, results[key])
+    return [results[normalize(address)] for address in addresses]
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import httpx
+import tools.address_verification as address_verification
+from tools.address_verification import normalize, create_lookup, cache, cache_result, metrics
+from tools.instrumentation import timed
+
+# Address verification for the ASGI application. It calls the SmartyStreets US Street API over an async http client
+# and shares the result cache of tools.address_verification.
+
+logger = logging.getLogger()
+
+street_api_url = "https://us-street.api.smartystreets.com/street-address"
+
+client = None
+# Lookups being sent right now by normalized address, so identical concurrent requests await one answer
+in_flight = {}
+
+
+def get_client():
+    global client
+    if client is None:
+        client = httpx.AsyncClient(timeout=10.0)
+    return client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+# Verify the validity of an address with format [street, city state].
+@timed("smartystreets", "verify")
+async def verify(address):
+    key = normalize(address)
+    cached = cache.get(key)
+    if cached is not None:
+        metrics["cache_hits"] += 1
+        return cached
+    lookup = create_lookup(address)
+    if lookup is None:
+        return False
+    pending = in_flight.get(key)
+    if pending is not None:
+        metrics["coalesced"] += 1
+        return await asyncio.shield(pending)
+    pending = in_flight[key] = asyncio.ensure_future(send_lookup(key, lookup))
+    try:
+        return await asyncio.shield(pending)
+    finally:
+        in_flight.pop(key, None)
+
+
+async def send_lookup(key, lookup):
+    metrics["lookups"] += 1
+    params = {
+        "auth-id": address_verification.auth_id,
+        "auth-token": address_verification.auth_token,
+        "street": lookup.street,
+        "city": lookup.city,
+        "state": lookup.state,
+        "match": lookup.match,
+    }
+    try:
+        response = await get_client().get(street_api_url, params=params)
+        response.raise_for_status()
+        candidates = response.json()
+    except (httpx.HTTPError, ValueError) as err:
+        metrics["errors"] += 1
+        logger.error("Address verification failed: {}".format(err))
+        return False
+    # There is at least one zipcode for the address
+    valid = bool(candidates and candidates[0].get("components", {}).get("zipcode"))
+    cache_result(key, valid)
+    return valid
@@ -0,0 +1,137 @@
+import csv
+import io
+import json
+import logging
+import pymysql
+import database_access.user_access as user_access
+import tools.address_verification as address_verification
+import tools.password_hashing as password_hashing
+from settings import settings
+
+logger = logging.getLogger()
+
+chunk_size = settings.bulk_import_chunk_size
+
+
+# Yield (line, user or None, error) for every record of an NDJSON stream
+def read_ndjson(stream):
+    for line, data in enumerate(iter(stream.readline, b""), start=1):
+        # Lines are decoded one by one so an invalid byte fails its record and not the whole stream
+        try:
+            text = data.decode("utf-8")
+        except UnicodeDecodeError:
+            yield line, None, "Invalid data"
+            continue
+        if not text.strip():
+            continue
+        try:
+            user = json.loads(text)
+        except ValueError:
+            yield line, None, "Invalid JSON"
+            continue
+        if not isinstance(user, dict):
+            yield line, None, "Invalid data"
+            continue
+        yield line, user, None
+
+
+# Yield (line, user or None, error) for every record of a CSV stream with a header row
+def read_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline=""))
+    for user in reader:
+        user = {field: value for field, value in user.items() if field is not None}
+        # Invalid bytes are decoded as replacement characters, the rows holding them are rejected
+        invalid = any(isinstance(value, str) and "\ufffd" in value for value in user.values())
+        yield reader.line_num, user, "Invalid data" if invalid else None
+
+
+def chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Validate, de-duplicate and insert a chunk of records, return a result per record in the same order
+def import_chunk(records):
+    errors = {}
+    valid = []
+    usernames, emails = set(), set()
+    for i, (line, user, error) in enumerate(records):
+        if error is None and not user_access.required_field_exist(user):
+            error = "Some fields are missing"
+        elif error is None and not all(isinstance(user[field], str) and user[field]
+                                       for field in user_access.required_user_fields):
+            error = "Invalid data"
+        elif error is None and user["username"] in usernames:
+            error = "Username is duplicate"
+        elif error is None and user["email"] in emails:
+            error = "Email is duplicate"
+        if error is not None:
+            errors[i] = error
+            continue
+        usernames.add(user["username"])
+        emails.add(user["email"])
+        valid.append(i)
+    # Rows of earlier chunks are already committed, so one set-based query also catches duplicates across chunks
+    try:
+        taken_usernames, taken_emails = user_access.find_existing_usernames_and_emails(usernames, emails)
+    except (pymysql.Error, pymysql.Warning) as e:
+        logger.error(e)
+        taken_usernames, taken_emails = usernames, emails
+    remaining = []
+    for i in valid:
+        user = records[i][1]
+        if user["username"] in taken_usernames:
+            errors[i] = "Username is duplicate"
+        elif user["email"] in taken_emails:
+            errors[i] = "Email is duplicate"
+        else:
+            remaining.append(i)
+    verified = address_verification.verify_many([records[i][1]["address"] for i in remaining])
+    valid, remaining = remaining, []
+    for i, address_valid in zip(valid, verified):
+        if address_valid:
+            remaining.append(i)
+        else:
+            errors[i] = "Address is invalid"
+    password_hashes = password_hashing.hash_passwords([records[i][1]["password"] for i in remaining])
+    users = [dict(records[i][1], password=password_hash) for i, password_hash in zip(remaining, password_hashes)]
+    for i, error in zip(remaining, user_access.create_users(users)):
+        if error is not None:
+            errors[i] = error
+    results = []
+    for i, (line, user, _) in enumerate(records):
+        result = {"line": line, "status": "error" if i in errors else "created"}
+        if user is not None and user.get("username"):
+            result["username"] = user["username"]
+        if i in errors:
+            result["message"] = errors[i]
+        results.append(result)
+    return results
+
+
+# Import every record of a stream chunk by chunk and yield one NDJSON result line per record, then a summary.
+# Only one chunk is held in memory whatever the size of the input
+def import_users(stream, content_type):
+    records = read_csv(stream) if content_type == "text/csv" else read_ndjson(stream)
+    created, failed = 0, 0
+    for chunk in chunks(records, chunk_size):
+        try:
+            results = import_chunk(chunk)
+        except Exception as e:
+            # A chunk that cannot be imported, e.g. the pool timing out, fails its records and the import goes on
+            logger.exception("Bulk import of lines {} to {} failed: {}".format(chunk[0][0], chunk[-1][0], e))
+            results = [{"line": line, "status": "error", "message": "Internal Server Error"}
+                       for line, _, _ in chunk]
+        for result in results:
+            if result["status"] == "created":
+                created += 1
+            else:
+                failed += 1
+            yield json.dumps(result) + "\n"
+    yield json.dumps({"summary": {"created": created, "failed": failed}}) + "\n"
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from settings import settings
+
+# Verify Google ID tokens locally instead of asking the userinfo endpoint about every login. The discovery document
+# is read once and the signing keys are kept for keys_ttl seconds, a token signed with an unknown key refetches them
+# early since Google rotates its keys. authlib and requests are imported on first use like the other clients.
+
+logger = logging.getLogger()
+
+discovery_url = "https://accounts.google.com/.well-known/openid-configuration"
+issuers = ["https://accounts.google.com", "accounts.google.com"]
+keys_ttl = settings.google_keys_ttl
+# Unknown key ids refetch the keys at most this often, so forged tokens cannot make us hammer Google
+unknown_key_refetch_interval = 60.0
+# Seconds of clock skew accepted on exp and iat
+leeway = 120
+
+session = None
+jwks_uri = None
+key_set = None
+fetched_at = None
+# Held while fetching, so one thread refetches the keys and the others wait for it
+keys_lock = threading.Lock()
+metrics = {"verified": 0, "rejected": 0, "key_fetches": 0, "key_fetch_errors": 0}
+
+
+class IdentityError(Exception):
+    pass
+
+
+# The HTTP session is kept alive between fetches
+def fetch_json(url):
+    global session
+    if session is None:
+        import requests
+        session = requests.Session()
+    response = session.get(url, timeout=5)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_keys():
+    global jwks_uri, key_set, fetched_at
+    from authlib.jose import JsonWebKey
+    metrics["key_fetches"] += 1
+    if jwks_uri is None:
+        jwks_uri = fetch_json(discovery_url)["jwks_uri"]
+    key_set = JsonWebKey.import_key_set(fetch_json(jwks_uri))
+    fetched_at = time.monotonic()
+
+
+# Return the key with the given id, fetching the keys when they are stale or do not have it.
+# Stale keys keep being used while Google cannot be reached
+def signing_key(kid):
+    with keys_lock:
+        now = time.monotonic()
+        if key_set is not None:
+            age = now - fetched_at
+            try:
+                key = key_set.find_by_kid(kid)
+                if age < keys_ttl:
+                    return key
+            except ValueError:
+                if age < unknown_key_refetch_interval:
+                    raise IdentityError("Unknown signing key") from None
+        try:
+            fetch_keys()
+        except Exception as e:
+            metrics["key_fetch_errors"] += 1
+            if key_set is None:
+                raise IdentityError("Google signing keys are unavailable: {}".format(e)) from None
+            logger.warning("Refreshing the Google signing keys failed: {}".format(e))
+        try:
+            return key_set.find_by_kid(kid)
+        except ValueError:
+            raise IdentityError("Unknown signing key") from None
+
+
+# Fetch the keys before the first login needs them
+def warm():
+    with keys_lock:
+        if key_set is None:
+            fetch_keys()
+
+
+# Check the signature, issuer, audience, expiry and nonce of the id_token of a token response and return its claims.
+# The email has to be verified by Google. Raise IdentityError when the token cannot be trusted
+def verify_id_token(token, client_id, nonce=None):
+    from authlib.jose import JsonWebToken
+    from authlib.jose.errors import JoseError
+    from authlib.oidc.core import CodeIDToken
+    id_token = token.get("id_token") if token else None
+    if not id_token:
+        metrics["rejected"] += 1
+        raise IdentityError("No id_token in the token response")
+    try:
+        claims = JsonWebToken(["RS256"]).decode(
+            id_token, key=lambda header, payload: signing_key(header.get("kid")), claims_cls=CodeIDToken,
+            claims_options={"iss": {"essential": True, "values": issuers},
+                            "aud": {"essential": True, "value": client_id}},
+            claims_params={"nonce": nonce, "client_id": client_id, "access_token": token.get("access_token")})
+        claims.validate(leeway=leeway)
+    except (JoseError, ValueError) as e:
+        metrics["rejected"] += 1
+        raise IdentityError(str(e)) from None
+    except IdentityError:
+        metrics["rejected"] += 1
+        raise
+    if not claims.get("email") or claims.get("email_verified") not in (True, "true"):
+        metrics["rejected"] += 1
+        raise IdentityError("Google account has no verified email")
+    metrics["verified"] += 1
+    return claims
@@ -0,0 +1,177 @@
+import cProfile
+import functools
+import inspect
+import os
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from settings import settings
+
+# Latency histograms per route and per dependency call, rendered in the Prometheus text format by
+# application's /internal/metrics. Switched off with METRICS_ENABLED=0, timed returns the function itself and
+# timer a shared no-op context, so the instrumented code runs as if it was not instrumented.
+
+enabled = settings.metrics_enabled
+# Upper bounds in seconds, a last +Inf bucket is implied
+buckets = settings.metrics_buckets
+
+# A share of the requests is profiled and the profiles of the ones slower than profile_slow_ms are dumped
+profile_sample_rate = settings.profile_sample_rate
+profile_slow_ms = settings.profile_slow_ms
+profile_dir = settings.profile_dir
+# Only one profiler can be active in the process at a time
+profile_lock = threading.Lock()
+
+histograms = {}
+histograms_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.total
+
+
+def get_histogram(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    histogram = histograms.get(key)
+    if histogram is None:
+        with histograms_lock:
+            histogram = histograms.setdefault(key, Histogram(name, key[1]))
+    return histogram
+
+
+def observe_request(route, method, status, seconds):
+    get_histogram("http_request_seconds", route=route, method=method, status=str(status)).observe(seconds)
+
+
+# Decorator recording the duration of every call of a function (or coroutine function) as a dependency call
+def timed(dependency, operation=None):
+    def decorate(function):
+        if not enabled:
+            return function
+        name = operation or function.__name__
+        histogram = get_histogram("dependency_call_seconds", dependency=dependency, operation=name)
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def measure(histogram):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+class NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+no_timer = NoTimer()
+
+
+# Context manager recording the duration of a block as a dependency call
+def timer(dependency, operation):
+    if not enabled:
+        return no_timer
+    return measure(get_histogram("dependency_call_seconds", dependency=dependency, operation=operation))
+
+
+# Return a started profiler for a sampled share of the requests, None for the others
+def start_profile():
+    if profile_sample_rate <= 0 or random.random() >= profile_sample_rate:
+        return None
+    if not profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        profile_lock.release()
+        return None
+    return profiler
+
+
+# Stop a profiler from start_profile and dump its stats when the request was slow
+def stop_profile(profiler, route, seconds):
+    try:
+        profiler.disable()
+    finally:
+        profile_lock.release()
+    if seconds * 1000 < profile_slow_ms:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    name = "{}-{}.prof".format(re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root", int(time.time() * 1000))
+    profiler.dump_stats(os.path.join(profile_dir, name))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in labels) + "}"
+
+
+# Render the histograms and gauges {name: {labels tuple: value}} in the Prometheus text exposition format
+def render(gauges=None):
+    lines = []
+    with histograms_lock:
+        items = sorted(histograms.items())
+    current = None
+    for (name, labels), histogram in items:
+        if name != current:
+            lines.append("# TYPE {} histogram".format(name))
+            current = name
+        counts, total = histogram.snapshot()
+        cumulative = 0
+        for bound, count in zip(buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", le),)), cumulative))
+        lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+        lines.append("{}_count{} {}".format(name, format_labels(labels), cumulative))
+    for name, values in sorted((gauges or {}).items()):
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in values.items():
+            lines.append("{}{} {}".format(name, format_labels(labels), float(value)))
+    return "\n".join(lines) + "\n"
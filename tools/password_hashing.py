@@ -0,0 +1,146 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from passlib.hash import sha256_crypt
+from tools.instrumentation import timed
+from settings import settings
+
+# Hashing runs in a pool of worker processes so it neither blocks the request thread nor holds the GIL.
+# A pool size of 0 hashes inline on the calling thread.
+# Workers are started by a fork server (spawned where there is none) rather than forked from the application, whose
+# log listener, publisher and request threads could leave locks held in a forked child.
+
+logger = logging.getLogger()
+pool_size = settings.password_hash_pool_size
+rounds = settings.password_hash_rounds or sha256_crypt.default_rounds
+
+executor = None
+executor_pid = None
+executor_lock = threading.Lock()
+
+
+# Change the pool size and the rounds of new hashes, the running pool is replaced on next use
+def configure(new_pool_size=None, new_rounds=None):
+    global pool_size, rounds
+    if new_pool_size is not None:
+        pool_size = new_pool_size
+        shutdown()
+    if new_rounds is not None:
+        rounds = new_rounds
+
+
+def shutdown():
+    global executor
+    with executor_lock:
+        if executor is not None and executor_pid == os.getpid():
+            executor.shutdown()
+        executor = None
+
+
+# Hashes with fewer rounds than configured are flagged for rehash, hashes with more are left alone
+def hasher(hash_rounds):
+    return sha256_crypt.using(rounds=hash_rounds, min_desired_rounds=hash_rounds)
+
+
+def hash_in_worker(password, hash_rounds):
+    return hasher(hash_rounds).hash(password)
+
+
+# Return whether password matches and, if the hash is weaker than hash_rounds, a new hash for it
+def verify_in_worker(password, password_hash, hash_rounds):
+    if not sha256_crypt.verify(password, password_hash):
+        return False, None
+    if hasher(hash_rounds).needs_update(password_hash):
+        return True, hash_in_worker(password, hash_rounds)
+    return True, None
+
+
+def start_method():
+    return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+# Create the pool on first use in each process, a pool inherited through fork is unusable
+def get_executor():
+    global executor, executor_pid
+    if pool_size <= 0:
+        return None
+    with executor_lock:
+        if executor is None or executor_pid != os.getpid():
+            executor = ProcessPoolExecutor(max_workers=pool_size, mp_context=multiprocessing.get_context(start_method()))
+            executor_pid = os.getpid()
+        return executor
+
+
+# A pool stays broken once one of its workers dies, e.g. killed for memory, so the next get_executor replaces it
+def discard_executor(pool, error):
+    global executor
+    logger.warning("Password hashing pool is broken, starting a new one: {}".format(error))
+    with executor_lock:
+        if executor is pool:
+            executor = None
+    pool.shutdown(wait=False)
+
+
+# Return call(pool), calling it once more with a new pool when the first one is broken
+def with_executor(call):
+    pool = get_executor()
+    if pool is None:
+        return call(None)
+    try:
+        return call(pool)
+    except BrokenProcessPool as e:
+        discard_executor(pool, e)
+        return call(get_executor())
+
+
+def run(function, *args):
+    return with_executor(lambda pool: function(*args) if pool is None else pool.submit(function, *args).result())
+
+
+@timed("sha256_crypt", "hash")
+def hash_password(password):
+    return run(hash_in_worker, password, rounds)
+
+
+# Hash many passwords in parallel across the pool, keeping their order
+@timed("sha256_crypt", "hash_many")
+def hash_passwords(passwords):
+    def hash_all(pool):
+        if pool is None:
+            return [hash_in_worker(password, rounds) for password in passwords]
+        return list(pool.map(hash_in_worker, passwords, [rounds] * len(passwords), chunksize=8))
+    return with_executor(hash_all)
+
+
+# Verify password against password_hash, return (matched, new_hash) where new_hash is set when the stored hash
+# uses fewer rounds than configured and should be replaced
+@timed("sha256_crypt", "verify")
+def verify_password(password, password_hash):
+    return run(verify_in_worker, password, password_hash, rounds)
+
+
+# Run function in the pool, or in the default thread executor without one, without blocking the event loop
+async def run_async(function, *args):
+    # Imported here so the Flask application does not load asyncio at startup
+    import asyncio
+    pool = get_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+    except BrokenProcessPool as e:
+        if pool is None:
+            raise
+        discard_executor(pool, e)
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), function, *args)
+
+
+@timed("sha256_crypt", "hash")
+async def hash_password_async(password):
+    return await run_async(hash_in_worker, password, rounds)
+
+
+@timed("sha256_crypt", "verify")
+async def verify_password_async(password, password_hash):
+    return await run_async(verify_in_worker, password, password_hash, rounds)
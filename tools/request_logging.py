@@ -0,0 +1,90 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from settings import settings
+
+# Structured, leveled logging that never blocks the request thread: records go through a queue and are written
+# as json lines by a listener thread. Request logs are sampled and secrets are redacted before anything is logged.
+
+log_level = settings.log_level
+request_log_sample_rate = settings.request_log_sample_rate
+
+# Header, query and body keys never written to logs, compared in lower case: the OAuth parameters of g_authorize and
+# any key containing one of secret_key_parts, like access_token, client_secret or new_password
+secret_keys = {"code", "state", "nonce"}
+secret_key_parts = ("token", "secret", "password", "authorization", "cookie", "api-key", "api_key", "credential")
+redacted = "[REDACTED]"
+
+request_logger = logging.getLogger("user_service.requests")
+listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        context = getattr(record, "context", None)
+        if context is not None:
+            entry["context"] = context
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Route every record of the root logger through a queue drained by a background thread
+def configure_logging(stream=sys.stdout):
+    global listener
+    if listener is not None:
+        return
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(log_level)
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def is_secret(key):
+    key = str(key).lower()
+    return key in secret_keys or any(part in key for part in secret_key_parts)
+
+
+def redact(values):
+    if isinstance(values, list):
+        return [redact(value) for value in values]
+    if not isinstance(values, dict):
+        return values
+    return {key: redacted if is_secret(key) else redact(value) for key, value in values.items()}
+
+
+# Log the inputs of a sampled share of the requests, the redacted copy is only built for the ones logged
+def log_request(inputs):
+    if not request_logger.isEnabledFor(logging.INFO):
+        return
+    if request_log_sample_rate < 1.0 and random.random() >= request_log_sample_rate:
+        return
+    request_logger.info("request", extra={"context": {
+        "path": inputs["path"],
+        "method": inputs["method"],
+        "query_params": redact(inputs["query_params"]),
+        "headers": redact(dict(inputs["headers"])),
+        "body": redact(inputs["body"]),
+    }})
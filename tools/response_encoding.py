@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import json
+from datetime import datetime
+from settings import settings
+
+# JSON responses for both applications: rows go through the field plan of their model, which drops secrets and
+# converts the values json cannot encode, and are encoded with orjson when it is installed. Bodies of at least
+# compression_min_size bytes are compressed with br or gzip when the client accepts it, and responses with an ETag
+# answer a matching If-None-Match with an empty 304.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compression = settings.response_compression
+compression_min_size = settings.response_compression_min_size
+gzip_level = 5
+brotli_quality = 4
+# Preferred first when the client accepts several
+encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+# Values json has no type for, like the datetime of created_date, are encoded as str(value) by both backends
+if orjson is not None:
+    def dumps(value):
+        return orjson.dumps(value, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+else:
+    def dumps(value):
+        return json.dumps(value, default=str).encode("utf-8")
+
+
+# The text str() gives for a datetime, without going through str
+def datetime_text(value):
+    return value.isoformat(" ") if isinstance(value, datetime) else str(value)
+
+
+# How the rows of a model are output: secret fields are left out and converters maps a field to the function turning
+# its value into one json can encode. Fields the plan does not know are output as they are
+class FieldPlan:
+    def __init__(self, secret_fields=(), converters=None):
+        self.secret_fields = tuple(secret_fields)
+        self.converters = tuple((converters or {}).items())
+
+    def apply(self, row):
+        clean = dict(row)
+        for field in self.secret_fields:
+            clean.pop(field, None)
+        for field, convert in self.converters:
+            value = clean.get(field)
+            if value is not None:
+                clean[field] = convert(value)
+        return clean
+
+    # Apply the plan to the row or rows in the data of a payload like {"data": [...], "message": "..."}
+    def apply_payload(self, payload):
+        data = payload.get("data") if isinstance(payload, dict) else None
+        if isinstance(data, dict):
+            return dict(payload, data=self.apply(data))
+        if isinstance(data, list):
+            return dict(payload, data=[self.apply(row) if isinstance(row, dict) else row for row in data])
+        return payload
+
+
+# The first of encodings the Accept-Encoding header accepts, None if it accepts none
+def accepted_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level)
+
+
+# Weak, so it stays the same whatever the content encoding
+def create_etag(body):
+    return 'W/"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:]
+    return any(candidate.strip().replace("W/", "", 1) == opaque for candidate in if_none_match.split(","))
+
+
+# Return the (body, status, headers) answering a request with the given headers with payload. With etag, a 200
+# carries an ETag of its body and becomes a 304 without body when If-None-Match matches it
+def encode_response(payload, status, request_headers, plan=None, etag=False):
+    body = dumps(plan.apply_payload(payload) if plan is not None else payload)
+    headers = {}
+    # Also on a 304, which carries the Vary the 200 would have
+    if compression:
+        headers["Vary"] = "Accept-Encoding"
+    if etag and status == 200:
+        headers["ETag"] = create_etag(body)
+        if etag_matches(request_headers.get("If-None-Match"), headers["ETag"]):
+            return b"", 304, headers
+    if compression and len(body) >= compression_min_size:
+        encoding = accepted_encoding(request_headers.get("Accept-Encoding"))
+        if encoding is not None:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+    return body, status, headers